@@ -5,4 +5,13 @@ __licence__     = "GPLv2"
 __version__     = "0.1"
 
 from .opcodes import *
+from .context import *
 from .vm import *
+from .engine import *
+from .optimizer import *
+from .compiler import *
+from .jit import *
+from .parallel import *
+from .batch import *
+from .lanes import *
+from .aio import *
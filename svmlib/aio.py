@@ -0,0 +1,62 @@
+
+import asyncio
+
+from .opcodes import *
+from .vm import *
+from .vm import _vm_link_program
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+#
+# asyncio runner.
+#
+# External functions may be coroutines or return awaitables: the calling
+# thread is parked in WAIT_CALL and the other threads keep running. The
+# runner awaits the pending calls concurrently and resumes every thread
+# as soon as its call completes, with the result of the call on top of
+# its registers.
+#
+# An exception raised by an awaited call is raised by the runner, like an
+# exception raised by a synchronous external function.
+#
+
+async def vm_run_async(vm_run_state, program, engine=ENGINE_SWITCH, quantum=None):
+
+    awaiting  = vm_run_state['awaiting']
+    offloaded = vm_run_state['offloaded']
+    threads   = vm_run_state['threads']
+
+    tasks = {}                           # task -> thread id
+
+    program = _vm_link_program(program, engine)
+
+    try:
+        while True:
+
+            vm_run_all_threads(vm_run_state, program, engine, quantum, wait_calls=False)
+
+            for tid, awaitable in awaiting.items():
+                tasks[ asyncio.ensure_future(awaitable) ] = tid
+            awaiting.clear()
+
+            # Calls offloaded to a pool of threads (see vm_offload)
+            for future, tid in offloaded.items():
+                tasks[ asyncio.wrap_future(future) ] = tid
+            offloaded.clear()
+
+            if not tasks:
+                break
+
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                tid = tasks.pop(task)
+                vm_thread_resume( threads[tid], task.result() )
+
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    return
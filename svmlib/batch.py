@@ -0,0 +1,82 @@
+
+from .opcodes import *
+from .vm import *
+from .engine import vm_load_program
+from .context import _freeze
+from . import parallel
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+#
+# Batch execution of one program on many events.
+#
+# Every event runs in a VM of its own. The program is linked once (and
+# the code compiled by the engines is reused by all the events), the
+# base context is shared by all the VMs. With inputs=True the initial
+# context is frozen once per call (once per chunk on a pool) and shared
+# by the VMs of the events. The result of an event is the result of its
+# main thread (top of the registers).
+#
+# With a pool (vm_create_pool) the events are sent to the workers in
+# chunks and run with the program and the base context sent to the
+# workers when the pool was created.
+#
+
+VM_BATCH_CHUNKSIZE = 256
+
+def _run_events(program, events, engine, context, base_context, inputs):
+
+    results = []
+
+    if inputs and context:
+        context = _freeze(dict(context).items())
+
+    for event in events:
+
+        if inputs:
+            vm = vm_create(context, base_context=base_context)
+            vm_thread_set_input(vm['threads'][0], event)
+        else:
+            vm = vm_create(event, base_context=base_context)
+
+        vm_run_all_threads(vm, program, engine)
+
+        results.append( vm_thread_result(vm['threads'][0]) )
+
+    return results
+
+def _worker_run_events(events, engine, context, inputs):
+    return _run_events(parallel._worker_program, events, engine, context, parallel._worker_base, inputs)
+
+def vm_run_many(program, events, engine=ENGINE_SWITCH, context=None, base_context=None, inputs=False, pool=None, chunksize=VM_BATCH_CHUNKSIZE):
+
+    #
+    # events: the initial contexts of the VMs or, with inputs=True, the
+    # input of the main thread (the VMs start from 'context').
+    #
+    # With a pool, 'program' must be the program of the pool and the base
+    # context is the one of the pool.
+    #
+    # Returns the list of the results, in the order of the events.
+    #
+    if pool is None:
+        return _run_events(vm_load_program(program), events, engine, context, base_context, inputs)
+
+    if list(program) != pool.program:
+        raise VMInvalidOperation("The pool runs another program: create the pool with this program")
+
+    if base_context is not None and base_context is not pool.base_context:
+        raise VMInvalidOperation("The pool has another base context: create the pool with vm_create_pool(program, base_context=...)")
+
+    events = list(events)
+    chunks = [ events[i : i + chunksize] for i in range(0, len(events), chunksize) ]
+
+    futures = [ pool.submit(_worker_run_events, chunk, engine, context, inputs) for chunk in chunks ]
+
+    results = []
+    for future in futures:
+        results.extend( future.result() )
+
+    return results
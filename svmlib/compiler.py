@@ -0,0 +1,409 @@
+from .opcodes import *
+from .vm import *
+from .engine import OPCODE_HANDLERS, ThreadSuspend, vm_load_program
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+#
+# Compiling execution engine.
+#
+# The program is split in basic blocks (a block ends before a jump/fork
+# target and after a jump). Every block is translated into the source of
+# a Python function, compiled once and cached in the linked program:
+#
+#     block(vm_run_state, program, thread, stack) -> pc
+#
+# Values pushed and popped inside a block live in Python local variables
+# and only the values left on the register stack are written back to it.
+#
+# Opcodes without a translation call the handler of the table engine, so
+# pause points (STOP, INPUT, FORK, StopException raised by external
+# functions) keep working: the handler raises ThreadSuspend with the pc
+# to resume from. A thread resuming in the middle of a block gets a new
+# block compiled from that address.
+#
+# With run_loop_count a thread is suspended at the end of the block that
+# exceeds the instruction count.
+#
+
+ENGINE_COMPILED = "compiled"
+
+_BINARY_OPERATORS = {
+    OP_CODE_REGSUM    : '+',
+    OP_CODE_REGSUB    : '-',
+    OP_CODE_REGMUL    : '*',
+    OP_CODE_REGDIV    : '/',
+    OP_CODE_REGMOD    : '%',
+    OP_CODE_REGPOW    : '**',
+    OP_CODE_REGLSHIFT : '<<',
+    OP_CODE_REGRSHIFT : '>>',
+    OP_CODE_REGBITAND : '&',
+    OP_CODE_REGBITXOR : '^',
+    OP_CODE_REGBITOR  : '|',
+    OP_CODE_REGEQ     : '==',
+    OP_CODE_REGNEQ    : '!=',
+    OP_CODE_REGLT     : '<',
+    OP_CODE_REGLTE    : '<=',
+    OP_CODE_REGGT     : '>',
+    OP_CODE_REGGTE    : '>=',
+}
+
+_UNARY_OPERATORS = {
+    OP_CODE_REGNEG    : '-',
+    OP_CODE_REGBITONE : '~',
+    OP_CODE_REGNOT    : 'not ',
+}
+
+_JUMPS = (OP_CODE_JUMP, OP_CODE_JUMPR, OP_CODE_IFTRUE, OP_CODE_IFFALSE)
+
+_LITERAL_TYPES = (int, str, bool, type(None))
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+class _BlockBuilder(object):
+
+    def __init__(self, start):
+        self.start     = start
+        self.lines     = []
+        self.symbolic  = []          # Expressions on top of the real stack
+        self.namespace = {}
+        self.temps     = 0
+
+    def const(self, value):
+        if type(value) in _LITERAL_TYPES:
+            return '(%r)' % (value, )
+        name = '_k%s' % (len(self.namespace), )
+        self.namespace[name] = value
+        return name
+
+    def bind(self, prefix, value):
+        name = '%s%s' % (prefix, len(self.namespace))
+        self.namespace[name] = value
+        return name
+
+    def emit(self, line):
+        self.lines.append(line)
+
+    def temp(self, expression):
+        name = '_t%s' % (self.temps, )
+        self.temps += 1
+        self.emit('%s = %s' % (name, expression))
+        return name
+
+    def push(self, expression):
+        self.symbolic.append(expression)
+
+    def pop(self):
+        if self.symbolic:
+            return self.symbolic.pop()
+        return self.temp('stack.pop()')
+
+    def flush(self):
+        if len(self.symbolic) == 1:
+            self.emit('stack.append(%s)' % (self.symbolic[0], ))
+        elif self.symbolic:
+            self.emit('stack.extend((%s, ))' % (', '.join(self.symbolic), ))
+        self.symbolic = []
+
+    def source(self, loop=False):
+        args   = ''.join([ ', %s=%s' % (name, name) for name in self.namespace ])
+        indent = '        ' if loop else '    '
+        header = [ 'def _block(vm_run_state, program, thread, stack%s):' % (args, ),
+                   '    context = thread.context' ]
+        if loop:
+            header.append('    while True:')
+        return '\n'.join(header + [ indent + line for line in self.lines ]) + '\n'
+
+    def build(self, name, loop=False):
+        namespace = dict(self.namespace)
+        namespace['ThreadSuspend'] = ThreadSuspend
+        namespace['_own']          = vm_context_own
+
+        source = self.source(loop)
+
+        exec(compile(source, '<svmlib %s>' % (name, ), 'exec'), namespace)
+
+        function = namespace['_block']
+        function.source = source
+
+        return function
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+def _leaders(program):
+
+    leaders = set([0])
+
+    for pc, (opcode, params) in enumerate(program):
+        if opcode == OP_CODE_JUMP:
+            leaders.add(params)
+        elif opcode in (OP_CODE_JUMPR, OP_CODE_IFTRUE, OP_CODE_IFFALSE):
+            leaders.add(pc + 1 + params)
+        elif opcode == OP_CODE_FORK:
+            leaders.update(params)
+
+    return leaders
+
+def _emit_instruction(b, opcode, params, pc):
+
+    #
+    # Translate a straight-line instruction. 'pc' is the address of the
+    # next instruction. Jumps are not translated: return False.
+    #
+
+    if opcode == OP_CODE_PASS:
+        pass
+
+    elif opcode == OP_CODE_SET:
+        b.push( b.const(params) )
+
+    elif opcode in (OP_CODE_REGFLUSH, OP_CODE_FLUSHSET):
+        n = params if opcode == OP_CODE_REGFLUSH else params[0]
+        if not n:
+            b.symbolic = []
+            b.emit('del stack[:]')
+        elif n <= len(b.symbolic):
+            del b.symbolic[-n:]
+        else:
+            b.flush()
+            b.emit('del stack[-%s:]' % (n, ))
+        if opcode == OP_CODE_FLUSHSET:
+            b.push( b.const(params[1]) )
+
+    elif opcode in _BINARY_OPERATORS:
+        v2 = b.pop()
+        v1 = b.pop()
+        b.push( b.temp('%s %s %s' % (v1, _BINARY_OPERATORS[opcode], v2)) )
+
+    elif opcode == OP_CODE_REGOPC and params[0] in _BINARY_OPERATORS:
+        v1 = b.pop()
+        b.push( b.temp('%s %s %s' % (v1, _BINARY_OPERATORS[params[0]], b.const(params[1]))) )
+
+    elif opcode in _UNARY_OPERATORS:
+        v = b.pop()
+        b.push( b.temp('%s%s' % (_UNARY_OPERATORS[opcode], v)) )
+
+    elif opcode == OP_CODE_CREATETUPLE:
+        if params <= len(b.symbolic):
+            elements = [ b.pop() for i in range(params) ] if params > 0 else []
+            elements.reverse()
+            b.push( b.temp('(%s)' % (''.join([ e + ', ' for e in elements ]), )) )
+        else:
+            # Like the interpreter: a short stack gives a short tuple
+            b.flush()
+            t = b.temp('tuple(stack[-%s:])' % (params, ))
+            b.emit('del stack[-%s:]' % (params, ))
+            b.push(t)
+
+    elif opcode == OP_CODE_CREATEDICT:
+        b.push( b.temp('{}') )
+
+    elif opcode == OP_CODE_DICTSETK:
+        v = b.pop()
+        k = b.pop()
+        d = b.pop()
+        # The aliases of the dict are moved to the copy on the stack
+        b.flush()
+        d = b.temp('_own(context, %s, stack)' % (d, ))
+        b.emit('%s[%s] = %s' % (d, k, v))
+        b.push(d)
+
+    elif opcode == OP_CODE_LOADSYM:
+        symbol = b.pop()
+        b.push( b.temp('context[%s]' % (symbol, )) )
+
+    elif opcode == OP_CODE_LOADSYMC:
+        b.push( b.temp('context[%s]' % (b.const(params), )) )
+
+    elif opcode == OP_CODE_LOADSYMLV:
+        symbol = b.pop()
+        b.push( b.temp('(None, %s)' % (symbol, )) )
+
+    elif opcode == OP_CODE_STORESYM:
+        val = b.pop()
+        ref = b.pop()
+        b.emit('_c, _s = %s' % (ref, ))
+        b.emit('if _c is None: _c = context')
+        b.emit('_c[_s] = %s' % (val, ))
+        b.push(val)
+
+    elif opcode == OP_CODE_GETATTR:
+        v2 = b.pop()
+        v1 = b.pop()
+        b.push( b.temp('%s[%s]' % (v1, v2)) )
+
+    elif opcode == OP_CODE_GETATTRLV:
+        sym2 = b.pop()
+        ref  = b.pop()
+        b.flush()
+        b.emit('_c, _s = %s' % (ref, ))
+        b.emit('_v = _own(context, context[_s], stack) if _c is None else _c[_s]')
+        b.push( b.temp('(_v, %s)' % (sym2, )) )
+
+    elif opcode == OP_CODE_OUTPUT:
+        v = b.pop()
+        b.emit('thread.output.append(%s)' % (v, ))
+
+    elif opcode in _JUMPS:
+        return False
+
+    #
+    # Any other opcode: call the handler of the table engine
+    #
+    else:
+        handler = b.bind('_h', OPCODE_HANDLERS[opcode])
+        operand = b.bind('_p', params)
+        b.flush()
+        b.emit('%s(vm_run_state, program, thread, stack, %s, %s)' % (handler, operand, pc))
+        b.emit('context = thread.context')
+
+    return True
+
+def _compile_block(program, leaders, start):
+
+    b = _BlockBuilder(start)
+
+    program_len = len(program)
+
+    pc = start
+
+    while True:
+
+        if pc >= program_len:
+            b.flush()
+            b.emit('raise ThreadSuspend(%s, %r)' % (pc, THREAD_TERMINATED))
+            break
+
+        if pc != start and pc in leaders:
+            b.flush()
+            b.emit('return %s' % (pc, ))
+            break
+
+        opcode, params = program[pc]
+
+        pc += 1
+
+        if _emit_instruction(b, opcode, params, pc):
+            continue
+
+        #
+        # Jumps: end of the block
+        #
+        if opcode == OP_CODE_JUMP:
+            b.flush()
+            b.emit('return %s' % (params, ))
+            break
+
+        elif opcode == OP_CODE_JUMPR:
+            b.flush()
+            b.emit('return %s' % (pc + params, ))
+            break
+
+        elif opcode in (OP_CODE_IFTRUE, OP_CODE_IFFALSE):
+            b.flush()
+            b.emit('if %sstack[-1]: return %s' % ('' if opcode == OP_CODE_IFTRUE else 'not ', pc + params))
+            b.emit('return %s' % (pc, ))
+            break
+
+    return b.build('block %s' % (start, )), pc - start
+
+def _compiled(program):
+
+    compiled = program.cache.get(ENGINE_COMPILED)
+
+    if compiled is None:
+        compiled = {
+            'leaders': _leaders(program),
+            'blocks' : [None] * (len(program) + 1),
+            'sizes'  : [0]    * (len(program) + 1),
+        }
+        program.cache[ENGINE_COMPILED] = compiled
+
+    return compiled
+
+def vm_compile_block(program, pc):
+
+    compiled = _compiled(program)
+
+    block = compiled['blocks'][pc]
+
+    if block is None:
+        block, size = _compile_block(program, compiled['leaders'], pc)
+        compiled['blocks'][pc] = block
+        compiled['sizes' ][pc] = size
+
+    return block
+
+#----------------------------------------------------------------------#
+# THREAD EXECUTION                                                     #
+#----------------------------------------------------------------------#
+
+def vm_run_thread_compiled(vm_run_state, program, thread, run_loop_count=None):
+
+    if __debug__:
+        DEBUG("\tTHREAD: id=%(id)s  state=%(state)s  pc=%(pc)s  clock=%(clock)s  regstack=%(regstack)s  input=%(input)s" % thread)
+
+    #
+    # Compiled blocks are cached in linked programs only: load the
+    # program once with vm_load_program() to reuse them between runs.
+    #
+    program = vm_load_program(program)
+
+    compiled = _compiled(program)
+    blocks   = compiled['blocks']
+    sizes    = compiled['sizes']
+
+    thread_state    = thread.state
+    pc              = thread.pc
+    thread_regstack = thread.regstack
+
+    try:
+        if pc > len(program):
+            raise ThreadSuspend(pc, THREAD_TERMINATED)
+
+        if run_loop_count is None:
+
+            while True:
+                block = blocks[pc]
+                if block is None:
+                    block = vm_compile_block(program, pc)
+                pc = block(vm_run_state, program, thread, thread_regstack)
+
+        else:
+            remaining = run_loop_count + 1
+
+            while remaining > 0:
+                block = blocks[pc]
+                if block is None:
+                    block = vm_compile_block(program, pc)
+                remaining -= sizes[pc]
+                pc = block(vm_run_state, program, thread, thread_regstack)
+
+    except ThreadSuspend as ts:
+        pc, thread_state = ts.args
+
+    #
+    # Update thread state
+    #
+
+    thread.pc       = pc
+    thread.state    = thread_state
+    thread.regstack = thread_regstack
+
+    if __debug__ and thread_state == THREAD_TERMINATED:
+        DEBUG("THREAD TERMINATED")
+        DEBUG('    pc       = %s' % ( thread.pc ) )
+        DEBUG('    state    = %s' % ( thread.state ) )
+        DEBUG('    regstack = %s' % ( thread.regstack ) )
+        DEBUG('    context  = %s' % ( thread.context ) )
+
+    return
+
+VM_ENGINES[ENGINE_COMPILED] = vm_run_thread_compiled
+VM_LINKERS[ENGINE_COMPILED] = vm_load_program
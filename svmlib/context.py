@@ -0,0 +1,432 @@
+import copy
+import types
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+#
+# Copy-on-write thread contexts.
+#
+# A VMContext is a dictionary (the thread's own variables) on top of a
+# chain of frozen layers shared with other threads. Reading a variable
+# of the layers does not copy it: the thread gets the shared value.
+#
+# A shared value is copied when the thread is about to change it in
+# place (vm_context_own): DICTSETK, STORESYM on an attribute (GETATTRLV),
+# CONTEXT_LPUSH/LPOP. The whole variable holding the value is copied
+# once, the variables (read or not) and the registers of the thread
+# pointing into it are moved to the copy.
+#
+# Every frozen layer indexes the objects it contains (id -> variable),
+# so finding out whether a value is shared costs a lookup per layer.
+#
+# On FORK the variables of the parent become a new frozen layer for the
+# children: forking costs a copy of the mutable variables the parent has
+# changed, once per FORK, whatever the number of children and the size
+# of the inherited layers. The parent keeps its own dictionary.
+#
+# The frozen layers are never written. Before an external function is
+# called the thread gets its own copy of the variables of the layers
+# (once: the thread has no layers left), so the function can change its
+# arguments and thread['context'] in place like on a private context.
+#
+# A function wrapped by vm_readonly() (or vm_pure()) promises not to
+# change its arguments nor the context in place: it gets the shared
+# values, without copies. Code outside the VM reading a context gets
+# shared values too: to change a value in place, get the copy of the
+# thread first:
+#
+#     lst = vm_context_own(thread['context'], thread['context']['lst'])
+#     lst.append(1)
+#
+# A base context (external functions, constants, lookup tables) is the
+# bottom layer: its values are shared by all the threads of all the VMs
+# using it and are never copied. The program can shadow a base symbol
+# but must not change a base value in place.
+#
+
+CONTEXT_MAX_DEPTH = 16
+
+# Values shared between layers and threads without copies
+_ATOMIC_TYPES = frozenset([
+    int, float, complex, str, bytes, bool, type(None), range,
+    types.FunctionType, types.BuiltinFunctionType, type,
+])
+
+def _copy_value(v, memo):
+    if type(v) in _ATOMIC_TYPES:
+        return v
+    return copy.deepcopy(v, memo)
+
+class _Layer(dict):
+
+    # Frozen layer: 'index' maps the id of every object of the layer to
+    # the variable holding it
+    __slots__ = ('index', )
+
+    def __reduce__(self):
+        # Pickled once per pickle, shared by all the contexts using it
+        return (_restore_layer, (dict(self), ))
+
+class _IndexMemo(dict):
+
+    #
+    # deepcopy memo recording the variable of every copied object: the
+    # copy (frozen layers) or the original (layers restored by pickle)
+    #
+    __slots__ = ('index', 'key', 'originals')
+
+    def __setitem__(self, k, v):
+        dict.__setitem__(self, k, v)
+        if k != id(self):               # deepcopy keep-alive list
+            self.index[k if self.originals else id(v)] = self.key
+
+def _freeze(items):
+
+    #
+    # Build a frozen layer with copies of the (key, value) pairs. The
+    # values share one memo: aliases between variables are kept.
+    #
+    layer = _Layer()
+    layer.index = {}
+
+    memo = _IndexMemo()
+    memo.index     = layer.index
+    memo.originals = False
+
+    for k, v in items:
+        memo.key = k
+        layer[k] = _copy_value(v, memo)
+
+    return layer
+
+def _restore_layer(data):
+
+    # The unpickled values are the layer: the copies only build the index
+    layer = _Layer(data)
+    layer.index = {}
+
+    memo = _IndexMemo()
+    memo.index     = layer.index
+    memo.originals = True
+
+    for k, v in data.items():
+        memo.key = k
+        _copy_value(v, memo)
+
+    return layer
+
+def _merge_layers(layers):
+
+    flat = _Layer()
+    flat.index = {}
+
+    for layer in reversed(layers):
+        flat.update(layer)
+
+    # Objects of shadowed variables are not reachable anymore
+    for layer in layers:
+        flat.index.update([ (i, k) for i, k in layer.index.items() if flat[k] is layer[k] ])
+
+    return flat
+
+def _as_layer(layer):
+    if isinstance(layer, _Layer):
+        return layer
+    return _freeze(layer.items())
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+class VMContext(dict):
+
+    __slots__ = ('_parents', '_base', '_copies')
+
+    def __init__(self, data=(), parents=(), base=None):
+        dict.__init__(self, data)
+        self._parents = tuple([ _as_layer(layer) for layer in parents ])
+        self._base    = base
+        self._copies  = None            # id(shared variable) -> deepcopy memo
+
+    #
+    # Lookup in the frozen layers: the value is shared, not copied
+    #
+    def __missing__(self, key):
+        for layer in self._parents:
+            if key in layer:
+                v = layer[key]
+                dict.__setitem__(self, key, v)
+                return v
+        if self._base is not None and key in self._base:
+            v = self._base[key]
+            dict.__setitem__(self, key, v)
+            return v
+        raise KeyError(key)
+
+    def _own(self, value, regstack):
+
+        i = id(value)
+
+        for layer in self._parents:
+            key = layer.index.get(i)
+            if key is not None:
+                break
+        else:
+            return value
+
+        shared = layer[key]
+
+        if self._copies is None:
+            self._copies = {}
+
+        memo = self._copies.get(id(shared))
+
+        if memo is None:
+
+            memo = {}
+            copy.deepcopy(shared, memo)
+            self._copies[id(shared)] = memo
+
+            # Move the variables and the registers to the copy: the
+            # variables of the layers aliasing the copied objects are
+            # read first
+            for layer in self._parents:
+                for k, v in layer.items():
+                    if id(v) in memo and not dict.__contains__(self, k):
+                        self[k]
+            for k, v in dict.items(self):
+                if id(v) in memo:
+                    dict.__setitem__(self, k, memo[id(v)])
+            if regstack:
+                for n, v in enumerate(regstack):
+                    if id(v) in memo:
+                        regstack[n] = memo[id(v)]
+
+        return memo.get(i, value)
+
+    def _isolate(self, regstack, args, kwargs):
+
+        #
+        # Copy the variables of the layers read by the thread and the
+        # shared values of its registers and of 'args' and 'kwargs' (one
+        # memo: aliases are kept). The thread has no layers left.
+        #
+        parents = self._parents
+        memo    = {}
+
+        def private(v):
+            if type(v) in _ATOMIC_TYPES:
+                return v
+            i = id(v)
+            if i in memo:
+                return memo[i]
+            for layer in parents:
+                if i in layer.index:
+                    return copy.deepcopy(v, memo)
+            return v
+
+        for layer in parents:
+            for k in layer:
+                if not dict.__contains__(self, k):
+                    self[k]
+
+        for k, v in dict.items(self):
+            dict.__setitem__(self, k, private(v))
+
+        if regstack:
+            for n, v in enumerate(regstack):
+                regstack[n] = private(v)
+
+        for n, v in enumerate(args):
+            args[n] = private(v)
+
+        for k, v in kwargs.items():
+            kwargs[k] = private(v)
+
+        self._parents = ()
+        self._copies  = None
+
+    def _merged(self):
+        # Read only view of all the variables
+        merged = dict(self._base) if self._base is not None else {}
+        for layer in reversed(self._parents):
+            merged.update(layer)
+        merged.update(dict.items(self))
+        return merged
+
+    def _flatten(self):
+        if self._parents or self._base is not None:
+            memo = {}
+            for key in self.keys():
+                v = self[key]
+                if self._shared(key, v):
+                    dict.__setitem__(self, key, _copy_value(v, memo))
+            self._parents = ()
+            self._base    = None
+            self._copies  = None
+
+    def _shared(self, key, v):
+        # True if the variable is the value of the frozen layers
+        for layer in self._parents:
+            if key in layer:
+                return layer[key] is v
+        return False
+
+    def _inherited(self, key, v):
+        # True if the variable is the value of the layers or of the base
+        for layer in self._parents:
+            if key in layer:
+                return layer[key] is v
+        return self._base is not None and key in self._base and self._base[key] is v
+
+    #
+    # dict interface
+    #
+    def __contains__(self, key):
+        if dict.__contains__(self, key):
+            return True
+        for layer in self._parents:
+            if key in layer:
+                return True
+        return self._base is not None and key in self._base
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self[key] = default
+        return default
+
+    def __delitem__(self, key):
+        self._flatten()
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        self._flatten()
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        self._flatten()
+        return dict.popitem(self)
+
+    def clear(self):
+        dict.clear(self)
+        self._parents = ()
+        self._base    = None
+        self._copies  = None
+
+    def keys(self):
+        if not self._parents and self._base is None:
+            return dict.keys(self)
+        return self._merged().keys()
+
+    def items(self):
+        self._flatten()
+        return dict.items(self)
+
+    def values(self):
+        self._flatten()
+        return dict.values(self)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def copy(self):
+        return VMContext(dict.copy(self), self._parents, self._base)
+
+    def __eq__(self, other):
+        if isinstance(other, VMContext):
+            other = other._merged()
+        return self._merged() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._merged())
+
+    #
+    # The layers and the base are pickled as objects: pickle keeps one
+    # copy of them for all the contexts of a pickle. The variables read
+    # from them are not pickled again.
+    #
+    def __reduce__(self):
+        data = dict([ (k, v) for k, v in dict.items(self) if not self._inherited(k, v) ])
+        return (VMContext, (data, self._parents, self._base))
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+def vm_context_create(context=None, base_context=None):
+
+    #
+    # The initial variables become the first frozen layer. A frozen layer
+    # (_freeze) is used as is: the contexts created from it share it.
+    #
+    if not context:
+        return VMContext(base=base_context)
+
+    if not isinstance(context, _Layer):
+        context = _freeze(dict(context).items())
+
+    return VMContext(parents=(context, ), base=base_context)
+
+def vm_context_fork(context, n):
+
+    #
+    # Create the contexts of n children of a thread: the variables of the
+    # thread (copied once) on top of its own layers
+    #
+    if not isinstance(context, VMContext):
+        layers = (_freeze(dict(context).items()), )
+        return [ VMContext(parents=layers) for i in range(n) ]
+
+    layers = context._parents
+    base   = context._base
+
+    if dict.__len__(context):
+        # Values read from the layers and base values are already shared
+        changed = [ (k, v) for k, v in dict.items(context) if not context._inherited(k, v) ]
+        if changed:
+            layers = (_freeze(changed), ) + layers
+
+    if len(layers) > CONTEXT_MAX_DEPTH:
+        layers = (_merge_layers(layers), )
+
+    return [ VMContext(parents=layers, base=base) for i in range(n) ]
+
+def vm_context_own(context, value, regstack=None):
+
+    #
+    # 'value' (read from the context) is going to be changed in place:
+    # return the copy of the thread. The variable holding a shared value
+    # is copied once and the variables and the registers (regstack) of
+    # the thread pointing into it are moved to the copy.
+    #
+    if type(value) in _ATOMIC_TYPES or type(context) is not VMContext or not context._parents:
+        return value
+
+    return context._own(value, regstack)
+
+def _own_arguments(context, fun, args, kwargs, regstack):
+
+    #
+    # Arguments of an external function: unless it is read only, it can
+    # change them and the context in place
+    #
+    if type(context) is not VMContext or not context._parents or getattr(fun, 'vm_readonly', False):
+        return
+
+    context._isolate(regstack, args, kwargs)
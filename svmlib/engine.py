@@ -0,0 +1,785 @@
+
+from .opcodes import *
+from .vm import *
+from .vm import _thread_clock
+from .utils import BINARY_OPERATORS
+from .context import _own_arguments
+
+import sys
+
+from inspect import isawaitable
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+#
+# Table-driven execution engine.
+#
+# Every opcode is implemented by a small handler function. Handlers are
+# stored in a dispatch table indexed by opcode number so decoding an
+# instruction costs a single lookup instead of a walk along the if/elif
+# ladder of vm_run_thread().
+#
+# Handler signature:
+#
+#     handler(vm_run_state, program, thread, regstack, params, pc) -> pc
+#
+# 'pc' is already pointing to the next instruction. The handler returns
+# the address of the next instruction to execute. The register stack is
+# always modified in place.
+#
+# A handler that must suspend the thread (STOP, INPUT without data,
+# SLEEP, a StopException raised by an external function, an awaitable
+# returned by an external function) raises ThreadSuspend with the pc
+# and the state to save in the thread.
+#
+
+ENGINE_TABLE = "table"
+
+class ThreadSuspend(Exception):
+    pass
+
+#----------------------------------------------------------------------#
+# BASE                                                                 #
+#----------------------------------------------------------------------#
+
+def _op_pass(vm_run_state, program, thread, regstack, params, pc):
+    return pc
+
+def _op_stop(vm_run_state, program, thread, regstack, params, pc):
+    regstack[:] = [params]
+    raise ThreadSuspend(pc, THREAD_TERMINATED)
+
+#----------------------------------------------------------------------#
+# REGISTRY                                                             #
+#----------------------------------------------------------------------#
+
+def _op_regflush(vm_run_state, program, thread, regstack, params, pc):
+    if params:
+        del regstack[-params:]
+    else:
+        del regstack[:]
+    return pc
+
+def _op_set(vm_run_state, program, thread, regstack, params, pc):
+    regstack.append(params)
+    return pc
+
+def _op_flushset(vm_run_state, program, thread, regstack, params, pc):
+    n, val = params
+    if n:
+        del regstack[-n:]
+    else:
+        del regstack[:]
+    regstack.append(val)
+    return pc
+
+#----------------------------------------------------------------------#
+# TUPLE / DICTS                                                        #
+#----------------------------------------------------------------------#
+
+def _op_createtuple(vm_run_state, program, thread, regstack, params, pc):
+    if params > 0:
+        args_tuple = tuple(regstack[-params:])
+        del regstack[-params:]
+    else:
+        args_tuple = tuple()
+    regstack.append(args_tuple)
+    return pc
+
+def _op_createdict(vm_run_state, program, thread, regstack, params, pc):
+    regstack.append({})
+    return pc
+
+def _op_dictsetk(vm_run_state, program, thread, regstack, params, pc):
+    v = regstack.pop()
+    k = regstack.pop()
+    vm_context_own(thread.context, regstack[-1], regstack)[k] = v
+    return pc
+
+#----------------------------------------------------------------------#
+# Operators                                                            #
+#----------------------------------------------------------------------#
+
+def _op_regsum(vm_run_state, program, thread, regstack, params, pc):
+    v2 = regstack.pop()
+    regstack[-1] = regstack[-1] + v2
+    return pc
+
+def _op_regsub(vm_run_state, program, thread, regstack, params, pc):
+    v2 = regstack.pop()
+    regstack[-1] = regstack[-1] - v2
+    return pc
+
+def _op_regmul(vm_run_state, program, thread, regstack, params, pc):
+    v2 = regstack.pop()
+    regstack[-1] = regstack[-1] * v2
+    return pc
+
+def _op_regdiv(vm_run_state, program, thread, regstack, params, pc):
+    v2 = regstack.pop()
+    regstack[-1] = regstack[-1] / v2
+    return pc
+
+def _op_regmod(vm_run_state, program, thread, regstack, params, pc):
+    v2 = regstack.pop()
+    regstack[-1] = regstack[-1] % v2
+    return pc
+
+def _op_regpow(vm_run_state, program, thread, regstack, params, pc):
+    v2 = regstack.pop()
+    regstack[-1] = regstack[-1] ** v2
+    return pc
+
+def _op_regneg(vm_run_state, program, thread, regstack, params, pc):
+    regstack[-1] = -regstack[-1]
+    return pc
+
+def _op_regbitone(vm_run_state, program, thread, regstack, params, pc):
+    regstack[-1] = ~regstack[-1]
+    return pc
+
+def _op_regnot(vm_run_state, program, thread, regstack, params, pc):
+    regstack[-1] = not regstack[-1]
+    return pc
+
+def _op_reglshift(vm_run_state, program, thread, regstack, params, pc):
+    v2 = regstack.pop()
+    regstack[-1] = regstack[-1] << v2
+    return pc
+
+def _op_regrshift(vm_run_state, program, thread, regstack, params, pc):
+    v2 = regstack.pop()
+    regstack[-1] = regstack[-1] >> v2
+    return pc
+
+def _op_regbitand(vm_run_state, program, thread, regstack, params, pc):
+    v2 = regstack.pop()
+    regstack[-1] = regstack[-1] & v2
+    return pc
+
+def _op_regbitxor(vm_run_state, program, thread, regstack, params, pc):
+    v2 = regstack.pop()
+    regstack[-1] = regstack[-1] ^ v2
+    return pc
+
+def _op_regbitor(vm_run_state, program, thread, regstack, params, pc):
+    v2 = regstack.pop()
+    regstack[-1] = regstack[-1] | v2
+    return pc
+
+def _op_regeq(vm_run_state, program, thread, regstack, params, pc):
+    v2 = regstack.pop()
+    regstack[-1] = regstack[-1] == v2
+    return pc
+
+def _op_regneq(vm_run_state, program, thread, regstack, params, pc):
+    v2 = regstack.pop()
+    regstack[-1] = regstack[-1] != v2
+    return pc
+
+def _op_reglt(vm_run_state, program, thread, regstack, params, pc):
+    v2 = regstack.pop()
+    regstack[-1] = regstack[-1] < v2
+    return pc
+
+def _op_reglte(vm_run_state, program, thread, regstack, params, pc):
+    v2 = regstack.pop()
+    regstack[-1] = regstack[-1] <= v2
+    return pc
+
+def _op_reggt(vm_run_state, program, thread, regstack, params, pc):
+    v2 = regstack.pop()
+    regstack[-1] = regstack[-1] > v2
+    return pc
+
+def _op_reggte(vm_run_state, program, thread, regstack, params, pc):
+    v2 = regstack.pop()
+    regstack[-1] = regstack[-1] >= v2
+    return pc
+
+def _op_regopc(vm_run_state, program, thread, regstack, params, pc):
+    op, v2 = params
+    regstack[-1] = BINARY_OPERATORS[op](regstack[-1], v2)
+    return pc
+
+#----------------------------------------------------------------------#
+# SYMBOLS                                                              #
+#----------------------------------------------------------------------#
+
+def _op_loadsym(vm_run_state, program, thread, regstack, params, pc):
+    regstack[-1] = thread.context[ regstack[-1] ]
+    return pc
+
+def _op_loadsymc(vm_run_state, program, thread, regstack, params, pc):
+    regstack.append( thread.context[ params ] )
+    return pc
+
+def _op_loadsymlv(vm_run_state, program, thread, regstack, params, pc):
+    regstack[-1] = (None, regstack[-1])
+    return pc
+
+def _op_storesym(vm_run_state, program, thread, regstack, params, pc):
+    val = regstack.pop()
+    context1, symbol1 = regstack[-1]
+    if context1 is None:
+        context1 = thread.context
+    context1[symbol1] = val
+    regstack[-1] = val
+    return pc
+
+def _op_getattr(vm_run_state, program, thread, regstack, params, pc):
+    v2 = regstack.pop()
+    regstack[-1] = regstack[-1][v2]
+    return pc
+
+def _op_getattrlv(vm_run_state, program, thread, regstack, params, pc):
+    sym2 = regstack.pop()
+    context1, sym1 = regstack[-1]
+    if context1 is None:
+        regstack[-1] = (vm_context_own(thread.context, thread.context[sym1], regstack), sym2)
+    else:
+        regstack[-1] = (context1[sym1], sym2)
+    return pc
+
+def _op_context_lpush(vm_run_state, program, thread, regstack, params, pc):
+    symbol, value = params
+    thread_context = thread.context
+    vm_context_own(thread_context, thread_context.get(symbol, thread_context.setdefault(symbol, [])), regstack).append( value )
+    return pc
+
+def _op_context_lpop(vm_run_state, program, thread, regstack, params, pc):
+    vm_context_own(thread.context, thread.context[params], regstack).pop()
+    return pc
+
+#----------------------------------------------------------------------#
+# JUMPS                                                                #
+#----------------------------------------------------------------------#
+
+def _op_jump(vm_run_state, program, thread, regstack, params, pc):
+    if params >= len(program):
+        raise VMInvalidOperation("Invalid JUMP to %s (pc:%s)" % (params, pc))
+    return params
+
+def _op_jumpr(vm_run_state, program, thread, regstack, params, pc):
+    return pc + params
+
+def _op_iftrue(vm_run_state, program, thread, regstack, params, pc):
+    if regstack[-1]:
+        return pc + params
+    return pc
+
+def _op_iffalse(vm_run_state, program, thread, regstack, params, pc):
+    if not regstack[-1]:
+        return pc + params
+    return pc
+
+#----------------------------------------------------------------------#
+# THREADING                                                            #
+#----------------------------------------------------------------------#
+
+def _op_fork(vm_run_state, program, thread, regstack, params, pc):
+
+    vm_thread_fork( vm_run_state, thread, regstack, params )
+
+    return pc
+
+def _sleep(thread, clock, wakeup, pc):
+
+    if wakeup > clock:
+        thread._wakeup = wakeup
+        raise ThreadSuspend(pc, THREAD_SLEEP)
+
+    return pc
+
+def _op_sleep(vm_run_state, program, thread, regstack, params, pc):
+    clock = _thread_clock(thread, pc)
+    return _sleep(thread, clock, clock + regstack.pop(), pc)
+
+def _op_wait_until(vm_run_state, program, thread, regstack, params, pc):
+    return _sleep(thread, _thread_clock(thread, pc), regstack.pop(), pc)
+
+#----------------------------------------------------------------------#
+# FUNCTIONS                                                            #
+#----------------------------------------------------------------------#
+
+def _call(vm_run_state, thread, regstack, fun_callable, n_args, n_kwargs, pc):
+
+    stacked_params = regstack[-(n_args + n_kwargs): ]
+
+    del regstack[-(n_args + n_kwargs): ]
+
+    args   =      stacked_params[          : n_args ]  if n_args   else list()
+    kwargs = dict(stacked_params[ -n_kwargs:        ]) if n_kwargs else dict()
+
+    _own_arguments(thread.context, fun_callable, args, kwargs, regstack)
+
+    try:
+        ret = fun_callable(thread, *args, **kwargs)
+    except StopException as se:
+        raise ThreadSuspend(pc, THREAD_RUNNING)
+
+    if isawaitable(ret):
+        vm_thread_await(vm_run_state, thread, ret)
+        raise ThreadSuspend(pc, THREAD_WAIT_CALL)
+
+    regstack.append(ret)
+
+    return pc
+
+def _op_call(vm_run_state, program, thread, regstack, params, pc):
+    n_args, n_kwargs = params
+    fun_callable = regstack.pop()
+    return _call(vm_run_state, thread, regstack, fun_callable, n_args, n_kwargs, pc)
+
+def _op_call_sym(vm_run_state, program, thread, regstack, params, pc):
+    n_args, n_kwargs = params
+    fun_callable = thread.context[ regstack.pop() ]
+    return _call(vm_run_state, thread, regstack, fun_callable, n_args, n_kwargs, pc)
+
+def _op_call_symc(vm_run_state, program, thread, regstack, params, pc):
+    fun_sym, n_args, n_kwargs = params
+    fun_callable = thread.context[ fun_sym ]
+    return _call(vm_run_state, thread, regstack, fun_callable, n_args, n_kwargs, pc)
+
+def _op_call_native(vm_run_state, program, thread, regstack, params, pc):
+    fun_callable, n_args, n_kwargs = params
+    return _call(vm_run_state, thread, regstack, fun_callable, n_args, n_kwargs, pc)
+
+#----------------------------------------------------------------------#
+# IO                                                                   #
+#----------------------------------------------------------------------#
+
+def _op_output(vm_run_state, program, thread, regstack, params, pc):
+    thread.output.append( regstack.pop() )
+    return pc
+
+def _op_input(vm_run_state, program, thread, regstack, params, pc):
+
+    # Input? Try to consume it.
+    if not thread.input:
+
+        if thread.input_timeout is not None:
+            if thread.clock >= thread.input_timeout:
+                raise ThreadSuspend(pc, THREAD_TERMINATED)
+
+        raise ThreadSuspend(pc - 1, THREAD_WAIT_IO)
+
+    regstack.append( thread.input.popleft() )
+
+    return pc
+
+def _op_mailbox(vm_run_state, program, thread, regstack, params, pc):
+    vm_thread_set_mailbox( vm_run_state, thread, regstack.pop() )
+    return pc
+
+#----------------------------------------------------------------------#
+# Dispatch table                                                       #
+#----------------------------------------------------------------------#
+
+OPCODE_HANDLERS = {
+    OP_CODE_PASS          : _op_pass,
+    OP_CODE_STOP          : _op_stop,
+
+    OP_CODE_REGFLUSH      : _op_regflush,
+    OP_CODE_SET           : _op_set,
+    OP_CODE_FLUSHSET      : _op_flushset,
+
+    OP_CODE_CREATETUPLE   : _op_createtuple,
+    OP_CODE_CREATEDICT    : _op_createdict,
+    OP_CODE_DICTSETK      : _op_dictsetk,
+
+    OP_CODE_REGSUM        : _op_regsum,
+    OP_CODE_REGSUB        : _op_regsub,
+    OP_CODE_REGMUL        : _op_regmul,
+    OP_CODE_REGDIV        : _op_regdiv,
+    OP_CODE_REGMOD        : _op_regmod,
+    OP_CODE_REGPOW        : _op_regpow,
+    OP_CODE_REGNEG        : _op_regneg,
+    OP_CODE_REGBITONE     : _op_regbitone,
+    OP_CODE_REGNOT        : _op_regnot,
+    OP_CODE_REGLSHIFT     : _op_reglshift,
+    OP_CODE_REGRSHIFT     : _op_regrshift,
+    OP_CODE_REGBITAND     : _op_regbitand,
+    OP_CODE_REGBITXOR     : _op_regbitxor,
+    OP_CODE_REGBITOR      : _op_regbitor,
+    OP_CODE_REGEQ         : _op_regeq,
+    OP_CODE_REGNEQ        : _op_regneq,
+    OP_CODE_REGLT         : _op_reglt,
+    OP_CODE_REGLTE        : _op_reglte,
+    OP_CODE_REGGT         : _op_reggt,
+    OP_CODE_REGGTE        : _op_reggte,
+    OP_CODE_REGOPC        : _op_regopc,
+
+    OP_CODE_LOADSYM       : _op_loadsym,
+    OP_CODE_LOADSYMC      : _op_loadsymc,
+    OP_CODE_LOADSYMLV     : _op_loadsymlv,
+    OP_CODE_STORESYM      : _op_storesym,
+    OP_CODE_GETATTR       : _op_getattr,
+    OP_CODE_GETATTRLV     : _op_getattrlv,
+    OP_CODE_CONTEXT_LPUSH : _op_context_lpush,
+    OP_CODE_CONTEXT_LPOP  : _op_context_lpop,
+
+    OP_CODE_JUMP          : _op_jump,
+    OP_CODE_JUMPR         : _op_jumpr,
+    OP_CODE_IFTRUE        : _op_iftrue,
+    OP_CODE_IFFALSE       : _op_iffalse,
+
+    OP_CODE_FORK          : _op_fork,
+    OP_CODE_SLEEP         : _op_sleep,
+    OP_CODE_WAIT_UNTIL    : _op_wait_until,
+
+    OP_CODE_CALL          : _op_call,
+    OP_CODE_CALL_SYM      : _op_call_sym,
+    OP_CODE_CALL_SYMC     : _op_call_symc,
+    OP_CODE_CALL_NATIVE   : _op_call_native,
+
+    OP_CODE_OUTPUT        : _op_output,
+    OP_CODE_INPUT         : _op_input,
+    OP_CODE_MAILBOX       : _op_mailbox,
+}
+
+def _build_dispatch_table(handlers):
+
+    #
+    # Opcodes are small integers: use a dense list. In debug mode some
+    # opcodes are strings, so fall back to a dictionary.
+    #
+    if not all([ isinstance(opcode, int) for opcode in handlers ]):
+        return dict(handlers)
+
+    table = [None] * (max(handlers) + 1)
+
+    for opcode, handler in handlers.items():
+        table[opcode] = handler
+
+    return table
+
+DISPATCH_TABLE = _build_dispatch_table(OPCODE_HANDLERS)
+
+#----------------------------------------------------------------------#
+# Program loading                                                      #
+#----------------------------------------------------------------------#
+
+#
+# A linked program is an immutable tuple of validated instructions.
+#
+# It can be used everywhere a program is expected. It also carries the
+# pre-decoded form consumed by vm_run_thread_table():
+#
+#     program.code = ( (handler, params), ... , (end, None) )
+#
+# Jump targets are validated when the program is loaded so the linked
+# handlers do not check them again, and the trailing 'end' instruction
+# terminates the thread without a bounds check on every instruction.
+#
+# Other engines store the data they derive from the program (compiled
+# code, counters, ...) in program.cache.
+#
+
+class VMProgram(tuple):
+    pass
+
+def _is_int(v):
+    return isinstance(v, int) and not isinstance(v, bool)
+
+def _check_any(pc, params, program_len):
+    pass
+
+def _check_count(pc, params, program_len):
+    if params is not None and not (_is_int(params) and params >= 0):
+        raise VMInvalidOperation("Invalid count %r (pc:%s)" % (params, pc))
+
+def _check_size(pc, params, program_len):
+    if not _is_int(params):
+        raise VMInvalidOperation("Invalid size %r (pc:%s)" % (params, pc))
+
+def _check_pair(pc, params, program_len):
+    if not isinstance(params, (tuple, list)) or len(params) != 2:
+        raise VMInvalidOperation("Invalid operand %r (pc:%s)" % (params, pc))
+
+def _check_flushset(pc, params, program_len):
+    _check_pair(pc, params, program_len)
+    _check_count(pc, params[0], program_len)
+
+def _check_address(pc, addr, program_len):
+    if not _is_int(addr) or addr < 0 or addr > program_len:
+        raise VMInvalidOperation("Invalid address %r (pc:%s)" % (addr, pc))
+
+def _check_jump(pc, params, program_len):
+    if not _is_int(params) or params < 0 or params >= program_len:
+        raise VMInvalidOperation("Invalid JUMP to %r (pc:%s)" % (params, pc))
+
+def _check_relative(pc, params, program_len):
+    if not _is_int(params):
+        raise VMInvalidOperation("Invalid offset %r (pc:%s)" % (params, pc))
+    _check_address(pc, pc + 1 + params, program_len)
+
+def _check_fork(pc, params, program_len):
+    if not isinstance(params, (tuple, list)):
+        raise VMInvalidOperation("Invalid FORK addresses %r (pc:%s)" % (params, pc))
+    for addr in params:
+        _check_address(pc, addr, program_len)
+
+def _check_arguments(pc, n, program_len):
+    if not (_is_int(n) and n >= 0):
+        raise VMInvalidOperation("Invalid number of arguments %r (pc:%s)" % (n, pc))
+
+def _check_call(pc, params, program_len):
+    _check_pair(pc, params, program_len)
+    for n in params:
+        _check_arguments(pc, n, program_len)
+
+def _check_regopc(pc, params, program_len):
+    _check_pair(pc, params, program_len)
+    if params[0] not in BINARY_OPERATORS:
+        raise VMInvalidOperation("Invalid operator %r (pc:%s)" % (params[0], pc))
+
+def _check_call_symc(pc, params, program_len):
+    if not isinstance(params, (tuple, list)) or len(params) != 3:
+        raise VMInvalidOperation("Invalid operand %r (pc:%s)" % (params, pc))
+    for n in params[1:]:
+        _check_arguments(pc, n, program_len)
+
+def _check_call_native(pc, params, program_len):
+    if not isinstance(params, (tuple, list)) or len(params) != 3:
+        raise VMInvalidOperation("Invalid operand %r (pc:%s)" % (params, pc))
+    if not callable(params[0]):
+        raise VMInvalidOperation("Object %r is not callable (pc:%s)" % (params[0], pc))
+    for n in params[1:]:
+        _check_arguments(pc, n, program_len)
+
+OPERAND_CHECKS = {
+    OP_CODE_REGFLUSH      : _check_count,
+    OP_CODE_FLUSHSET      : _check_flushset,
+    OP_CODE_CREATETUPLE   : _check_size,
+    OP_CODE_REGOPC        : _check_regopc,
+    OP_CODE_CONTEXT_LPUSH : _check_pair,
+    OP_CODE_JUMP          : _check_jump,
+    OP_CODE_JUMPR         : _check_relative,
+    OP_CODE_IFTRUE        : _check_relative,
+    OP_CODE_IFFALSE       : _check_relative,
+    OP_CODE_FORK          : _check_fork,
+    OP_CODE_CALL          : _check_call,
+    OP_CODE_CALL_SYM      : _check_call,
+    OP_CODE_CALL_SYMC     : _check_call_symc,
+    OP_CODE_CALL_NATIVE   : _check_call_native,
+}
+
+#
+# Handlers used in place of the generic ones once operands are validated
+#
+
+def _op_jump_linked(vm_run_state, program, thread, regstack, params, pc):
+    return params
+
+def _op_end(vm_run_state, program, thread, regstack, params, pc):
+    raise ThreadSuspend(pc - 1, THREAD_TERMINATED)
+
+def _op_regopc_linked(vm_run_state, program, thread, regstack, params, pc):
+    fun, v2 = params
+    regstack[-1] = fun(regstack[-1], v2)
+    return pc
+
+#
+# Symbol resolution.
+#
+# A constant symbol pushed with SET and consumed by the next instruction
+# (LOADSYM, LOADSYMLV, CALL_SYM) is fused into the superinstruction of
+# the optimizer (LOADSYMC, SET of the l-value, CALL_SYMC): both use the
+# rewrites of SYMBOL_SUPERINSTRUCTIONS. The optimizer removes the second
+# instruction; vm_load_program() keeps the addresses, so the linked SET
+# runs the handler of the superinstruction and skips the second one.
+#
+# When the second instruction is a jump or fork target, the pair is left
+# as is.
+#
+
+# second opcode -> (superinstruction opcode, operand(symbol, params))
+SYMBOL_SUPERINSTRUCTIONS = {
+    OP_CODE_LOADSYM       : (OP_CODE_LOADSYMC,  lambda symbol, params: symbol),
+    OP_CODE_LOADSYMLV     : (OP_CODE_SET,       lambda symbol, params: (None, symbol)),
+    OP_CODE_CALL_SYM      : (OP_CODE_CALL_SYMC, lambda symbol, params: (symbol, ) + tuple(params)),
+}
+
+def _skip_next(handler):
+
+    # The handler runs as if at the second instruction: a call suspended
+    # there resumes after the pair
+    def resolved(vm_run_state, program, thread, regstack, params, pc):
+        return handler(vm_run_state, program, thread, regstack, params, pc + 1)
+
+    return resolved
+
+RESOLVED_HANDLERS = dict([ (opcode, _skip_next(OPCODE_HANDLERS[superinstruction]))
+                           for opcode, (superinstruction, operand) in SYMBOL_SUPERINSTRUCTIONS.items() ])
+
+def _jump_targets(instructions):
+
+    targets = set()
+
+    for pc, (opcode, params) in enumerate(instructions):
+        if opcode == OP_CODE_JUMP:
+            targets.add(params)
+        elif opcode in (OP_CODE_JUMPR, OP_CODE_IFTRUE, OP_CODE_IFFALSE):
+            targets.add(pc + 1 + params)
+        elif opcode == OP_CODE_FORK:
+            targets.update(params)
+
+    return targets
+
+def _resolve_symbols(instructions, code):
+
+    targets = _jump_targets(instructions)
+
+    for pc in range(len(instructions) - 1):
+
+        opcode, symbol = instructions[pc]
+        opcode2, params2 = instructions[pc + 1]
+
+        if opcode != OP_CODE_SET or type(symbol) is not str:
+            continue
+        if opcode2 not in RESOLVED_HANDLERS or (pc + 1) in targets:
+            continue
+
+        superinstruction, operand = SYMBOL_SUPERINSTRUCTIONS[opcode2]
+
+        code[pc] = (RESOLVED_HANDLERS[opcode2], operand(sys.intern(symbol), params2))
+
+LINKED_HANDLERS = {
+    OP_CODE_JUMP          : _op_jump_linked,
+    OP_CODE_REGOPC        : _op_regopc_linked,
+}
+
+#
+# Operands rewritten for the linked handlers
+#
+LINKED_OPERANDS = {
+    OP_CODE_REGOPC        : lambda params: (BINARY_OPERATORS[params[0]], params[1]),
+}
+
+def vm_load_program(program):
+
+    if isinstance(program, VMProgram):
+        return program
+
+    program_len  = len(program)
+    instructions = []
+    code         = []
+
+    for pc, instruction in enumerate(program):
+
+        if not isinstance(instruction, (tuple, list)) or len(instruction) != 2:
+            raise VMInvalidOperation("Invalid instruction %r (pc:%s)" % (instruction, pc))
+
+        opcode, params = instruction
+
+        try:
+            handler = OPCODE_HANDLERS[opcode]
+        except (KeyError, TypeError):
+            raise VMException("Invalid opcode: %s (pc:%s)" % (opcode, pc))
+
+        OPERAND_CHECKS.get(opcode, _check_any)(pc, params, program_len)
+
+        instructions.append( (opcode, params) )
+
+        if opcode in LINKED_OPERANDS:
+            params = LINKED_OPERANDS[opcode](params)
+
+        code.append( (LINKED_HANDLERS.get(opcode, handler), params) )
+
+    _resolve_symbols(instructions, code)
+
+    code.append( (_op_end, None) )
+
+    linked = VMProgram(instructions)
+    linked.code  = tuple(code)
+    linked.cache = {}                    # Data derived by other engines
+
+    return linked
+
+#----------------------------------------------------------------------#
+# THREAD EXECUTION                                                     #
+#----------------------------------------------------------------------#
+
+def vm_run_thread_table(vm_run_state, program, thread, run_loop_count=None):
+
+    if __debug__:
+        DEBUG("\tTHREAD: id=%(id)s  state=%(state)s  pc=%(pc)s  clock=%(clock)s  regstack=%(regstack)s  input=%(input)s" % thread)
+
+    thread_state    = thread.state
+    pc              = thread.pc
+    thread_regstack = thread.regstack
+
+    # Number of instructions left: a negative value never reaches zero
+    remaining = run_loop_count + 1 if run_loop_count is not None else -1
+
+    try:
+        if isinstance(program, VMProgram):
+
+            #
+            # Linked program: operands are validated and the program ends
+            # with a terminating instruction.
+            #
+            code = program.code
+
+            if pc >= len(code):
+                raise ThreadSuspend(pc, THREAD_TERMINATED)
+
+            while remaining:
+
+                remaining -= 1
+
+                handler, params = code[pc]
+
+                pc = handler(vm_run_state, program, thread, thread_regstack, params, pc + 1)
+
+        else:
+            dispatch    = DISPATCH_TABLE
+            program_len = len(program)
+
+            while remaining:
+
+                remaining -= 1
+
+                if pc >= program_len:
+                    thread_state = THREAD_TERMINATED
+                    break
+
+                opcode, params = program[pc]
+
+                pc += 1
+
+                try:
+                    handler = dispatch[opcode]
+                except (IndexError, KeyError, TypeError):
+                    handler = None
+
+                # A negative opcode would index the dense table from the end
+                if handler is None or (not __debug__ and opcode < 0):
+                    raise VMException("Invalid opcode: %s (pc:%s)" % (opcode, pc))
+
+                pc = handler(vm_run_state, program, thread, thread_regstack, params, pc)
+
+    except ThreadSuspend as ts:
+        pc, thread_state = ts.args
+
+    #
+    # Update thread state
+    #
+
+    thread.pc       = pc
+    thread.state    = thread_state
+    thread.regstack = thread_regstack
+
+    if __debug__ and thread_state == THREAD_TERMINATED:
+        DEBUG("THREAD TERMINATED")
+        DEBUG('    pc       = %s' % ( thread.pc ) )
+        DEBUG('    state    = %s' % ( thread.state ) )
+        DEBUG('    regstack = %s' % ( thread.regstack ) )
+        DEBUG('    context  = %s' % ( thread.context ) )
+
+    return
+
+VM_ENGINES[ENGINE_TABLE] = vm_run_thread_table
@@ -0,0 +1,236 @@
+from .opcodes import *
+from .vm import *
+from .engine import ThreadSuspend, vm_load_program
+from .compiler import _BlockBuilder, _emit_instruction
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+#
+# Tracing JIT execution engine.
+#
+# The engine runs the linked program like the table engine, but the
+# backward jumps (JUMP, JUMPR, IFTRUE, IFFALSE whose target is not after
+# the jump itself) count how many times they reach their target, the
+# loop header.
+#
+# When a loop header gets hot (JIT_THRESHOLD), the next iteration is
+# executed while recording the addresses of the executed instructions.
+# The trace is compiled into a Python function that runs the loop body
+# again and again:
+#
+#     trace(vm_run_state, program, thread, stack) -> pc
+#
+# Every conditional jump of the trace becomes a guard: when the branch
+# goes the other way, the trace returns the address where the
+# interpreter continues. Pause points raise ThreadSuspend as usual.
+#
+# A trace longer than JIT_MAX_TRACE instructions (e.g. an outer loop
+# running an inner loop) is abandoned and the header is not traced
+# again.
+#
+# With run_loop_count the engine interprets the program and does not
+# enter the traces, so the instruction count stays exact.
+#
+
+ENGINE_JIT = "jit"
+
+JIT_THRESHOLD = 50
+JIT_MAX_TRACE = 1000
+
+_CONDITIONAL = (OP_CODE_IFTRUE, OP_CODE_IFFALSE)
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+def _jump_target(pc, opcode, params):
+    if opcode == OP_CODE_JUMP:
+        return params
+    if opcode in (OP_CODE_JUMPR, OP_CODE_IFTRUE, OP_CODE_IFFALSE):
+        return pc + 1 + params
+    return None
+
+def _jit(program):
+
+    jit = program.cache.get(ENGINE_JIT)
+
+    if jit is not None:
+        return jit
+
+    jit = {
+        'counters' : {},         # header -> number of backward jumps
+        'traces'   : {},         # header -> compiled trace
+        'blacklist': set(),      # headers not to trace
+    }
+
+    code = list(program.code)
+
+    for pc, (opcode, params) in enumerate(program):
+        target = _jump_target(pc, opcode, params)
+        if target is not None and target <= pc:
+            code[pc] = (_backward_jump(jit, code[pc][0], target), params)
+
+    jit['code'] = tuple(code)
+
+    program.cache[ENGINE_JIT] = jit
+
+    return jit
+
+def _backward_jump(jit, handler, header):
+
+    counters  = jit['counters']
+    traces    = jit['traces']
+    blacklist = jit['blacklist']
+
+    counters[header] = 0
+
+    def _op_backward_jump(vm_run_state, program, thread, regstack, params, pc):
+
+        pc = handler(vm_run_state, program, thread, regstack, params, pc)
+
+        if pc != header:
+            return pc
+
+        trace = traces.get(header)
+        if trace is not None:
+            return trace(vm_run_state, program, thread, regstack)
+
+        counters[header] += 1
+
+        if counters[header] < JIT_THRESHOLD or header in blacklist:
+            return pc
+
+        counters[header] = 0
+
+        return _record(jit, vm_run_state, program, thread, regstack, header)
+
+    return _op_backward_jump
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+def _record(jit, vm_run_state, program, thread, regstack, header):
+
+    #
+    # Execute one iteration of the loop recording the instructions
+    #
+    code  = program.code
+    pc    = header
+    trace = []
+
+    while True:
+
+        handler, params = code[pc]
+
+        next_pc = handler(vm_run_state, program, thread, regstack, params, pc + 1)
+
+        trace.append( (pc, next_pc) )
+
+        pc = next_pc
+
+        if pc == header:
+            jit['traces'][header] = vm_compile_trace(program, trace)
+            return pc
+
+        if len(trace) >= JIT_MAX_TRACE:
+            jit['blacklist'].add(header)
+            return pc
+
+def vm_compile_trace(program, trace):
+
+    #
+    # trace: list of (pc, next pc) starting and ending at the loop header
+    #
+    b = _BlockBuilder(trace[0][0])
+
+    for pc, next_pc in trace:
+
+        opcode, params = program[pc]
+
+        if _emit_instruction(b, opcode, params, pc + 1):
+            # A resolved symbol executes the next instruction too
+            for pc2 in range(pc + 1, next_pc):
+                opcode2, params2 = program[pc2]
+                _emit_instruction(b, opcode2, params2, pc2 + 1)
+            continue
+
+        if opcode in _CONDITIONAL:
+
+            fall_pc = pc + 1
+            jump_pc = pc + 1 + params
+
+            if fall_pc == jump_pc:
+                continue
+
+            taken   = (next_pc == jump_pc)
+            exit_pc = fall_pc if taken else jump_pc
+
+            # Does the recorded path need a true value on the stack?
+            truth = (taken == (opcode == OP_CODE_IFTRUE))
+
+            b.flush()
+            b.emit('if %sstack[-1]: return %s' % ('not ' if truth else '', exit_pc))
+
+    b.flush()
+
+    return b.build('trace %s' % (trace[0][0], ), loop=True)
+
+#----------------------------------------------------------------------#
+# THREAD EXECUTION                                                     #
+#----------------------------------------------------------------------#
+
+def vm_run_thread_jit(vm_run_state, program, thread, run_loop_count=None):
+
+    if __debug__:
+        DEBUG("\tTHREAD: id=%(id)s  state=%(state)s  pc=%(pc)s  clock=%(clock)s  regstack=%(regstack)s  input=%(input)s" % thread)
+
+    program = vm_load_program(program)
+
+    thread_state    = thread.state
+    pc              = thread.pc
+    thread_regstack = thread.regstack
+
+    if run_loop_count is None:
+        code      = _jit(program)['code']
+        remaining = -1
+    else:
+        code      = program.code
+        remaining = run_loop_count + 1
+
+    try:
+        if pc >= len(code):
+            raise ThreadSuspend(pc, THREAD_TERMINATED)
+
+        while remaining:
+
+            remaining -= 1
+
+            handler, params = code[pc]
+
+            pc = handler(vm_run_state, program, thread, thread_regstack, params, pc + 1)
+
+    except ThreadSuspend as ts:
+        pc, thread_state = ts.args
+
+    #
+    # Update thread state
+    #
+
+    thread.pc       = pc
+    thread.state    = thread_state
+    thread.regstack = thread_regstack
+
+    if __debug__ and thread_state == THREAD_TERMINATED:
+        DEBUG("THREAD TERMINATED")
+        DEBUG('    pc       = %s' % ( thread.pc ) )
+        DEBUG('    state    = %s' % ( thread.state ) )
+        DEBUG('    regstack = %s' % ( thread.regstack ) )
+        DEBUG('    context  = %s' % ( thread.context ) )
+
+    return
+
+VM_ENGINES[ENGINE_JIT] = vm_run_thread_jit
+VM_LINKERS[ENGINE_JIT] = vm_load_program
@@ -0,0 +1,363 @@
+
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .opcodes import *
+from .vm import *
+from .utils import BINARY_OPERATORS
+from .engine import vm_load_program
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+#
+# Data-parallel execution of one program over N records (lanes).
+#
+# The records are given by columns: { symbol: N values }. A group of
+# lanes runs the program together: a register holds a scalar (the same
+# value for every lane of the group) or a NumPy array with one value per
+# lane, and the REG* opcodes are evaluated element-wise.
+#
+# On a conditional jump whose condition differs between the lanes the
+# group is split with the condition mask: the lanes taking the jump and
+# the others continue as two groups.
+#
+# A group reaching an opcode without a vectorized form (STORESYM, CALL,
+# FORK, INPUT, ...) falls back to the scalar engine: every lane of the
+# group continues in a VM of its own from that instruction.
+#
+# The columns must be numeric (bool, signed int, float). Arithmetic on
+# lanes gives the results of the scalar engine: bools are added as ints,
+# and an instruction that NumPy cannot evaluate exactly (an operand that
+# is not a number, an int64 overflow, a division by zero, a shift out of
+# range) falls back to the scalar engine like an opcode without a
+# vectorized form. Without NumPy,
+# or with other columns, every lane runs on the scalar engine.
+#
+# The result of a lane is the top of its registers (None if empty).
+#
+
+_NUMERIC_KINDS = 'bif'
+
+_UNARY = {
+    OP_CODE_REGNEG    : operator.neg,
+    OP_CODE_REGBITONE : operator.invert,
+}
+
+# REGPOW: NumPy fails on integers with negative exponents
+_BINARY = dict([ (opcode, fun) for opcode, fun in BINARY_OPERATORS.items() if opcode != OP_CODE_REGPOW ])
+
+# Opcodes whose bool operands are ints (True + True == 2)
+_ARITHMETIC = set([
+    OP_CODE_REGSUM, OP_CODE_REGSUB, OP_CODE_REGMUL, OP_CODE_REGDIV, OP_CODE_REGMOD,
+    OP_CODE_REGLSHIFT, OP_CODE_REGRSHIFT, OP_CODE_REGNEG, OP_CODE_REGBITONE,
+])
+
+# Integer results checked with a float estimate
+_CHECKED = {
+    OP_CODE_REGSUM    : operator.add,
+    OP_CODE_REGSUB    : operator.sub,
+    OP_CODE_REGMUL    : operator.mul,
+    OP_CODE_REGLSHIFT : lambda v1, v2: v1 * 2.0 ** v2,
+}
+
+_SHIFTS = set([ OP_CODE_REGLSHIFT, OP_CODE_REGRSHIFT ])
+
+# Below 2**63 with the rounding of the float estimate
+_INT_LIMIT = 2.0 ** 62
+
+# Ints divided exactly as floats (Python rounds the exact quotient)
+_DIV_LIMIT = 2.0 ** 53
+
+class _Scalar(Exception):
+    # Raised when NumPy cannot evaluate an instruction exactly: the
+    # group continues on the scalar engine from that instruction
+    pass
+
+def _is_lanes(v):
+    return numpy is not None and isinstance(v, numpy.ndarray)
+
+def _is_int_lanes(v):
+    return _is_lanes(v) and v.dtype.kind == 'i'
+
+def _as_int(v):
+    if _is_lanes(v) and v.dtype.kind == 'b':
+        return v.astype(numpy.int64)
+    return v
+
+def _check_range(estimate):
+    if not (numpy.abs(estimate) < _INT_LIMIT).all():
+        raise _Scalar()
+
+# Values combined with lanes by NumPy like by Python
+_NUMERIC_TYPES = (bool, int, float)
+
+def _check_operands(*operands):
+    # NumPy broadcasts tuples, strings, ... unlike the scalar engine
+    if any([ _is_lanes(v) for v in operands ]):
+        for v in operands:
+            if _is_lanes(v):
+                if v.dtype.kind not in _NUMERIC_KINDS:
+                    raise _Scalar()
+            elif type(v) not in _NUMERIC_TYPES:
+                raise _Scalar()
+
+def _binary(opcode, v1, v2):
+
+    _check_operands(v1, v2)
+
+    if opcode in _ARITHMETIC:
+        v1 = _as_int(v1)
+        v2 = _as_int(v2)
+
+    if opcode in _SHIFTS and (_is_lanes(v1) or _is_lanes(v2)):
+        # Python raises on negative counts, NumPy wraps at 64 bits
+        counts = numpy.asarray(v2)
+        if not ((counts >= 0) & (counts < 64)).all():
+            raise _Scalar()
+
+    if opcode == OP_CODE_REGDIV:
+        for v in (v1, v2):
+            if _is_int_lanes(v) and not (numpy.abs(v) < _DIV_LIMIT).all():
+                raise _Scalar()
+
+    result = _BINARY[opcode](v1, v2)
+
+    if opcode in _CHECKED and _is_int_lanes(result):
+        _check_range(_CHECKED[opcode](numpy.asarray(v1, dtype=float), numpy.asarray(v2, dtype=float)))
+
+    return result
+
+def _unary(opcode, v):
+
+    _check_operands(v)
+
+    v = _as_int(v)
+
+    result = _UNARY[opcode](v)
+
+    if opcode == OP_CODE_REGNEG and _is_int_lanes(result):
+        _check_range(numpy.asarray(v, dtype=float))
+
+    return result
+
+def _item(v):
+    if numpy is not None and isinstance(v, numpy.generic):
+        return v.item()
+    return v
+
+def _lane_value(v, i):
+    if _is_lanes(v):
+        return v[i].item()
+    return v
+
+def _regnot(v):
+    if _is_lanes(v):
+        return numpy.logical_not(v)
+    return not v
+
+def _flush(stack, n):
+    if n:
+        del stack[-n:]
+    else:
+        del stack[:]
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+class _Lanes(object):
+
+    def __init__(self, program, columns, context, base_context, engine):
+        self.program      = program
+        self.columns      = columns
+        self.context      = context or {}
+        self.base_context = base_context
+        self.engine       = engine
+
+    def load(self, symbol, lanes):
+        if symbol in self.columns:
+            return self.columns[symbol][lanes]
+        if symbol in self.context:
+            return self.context[symbol]
+        if self.base_context is not None and symbol in self.base_context:
+            return self.base_context[symbol]
+        raise KeyError(symbol)
+
+    def lane_context(self, i):
+        context = dict(self.context)
+        for symbol, column in self.columns.items():
+            context[symbol] = _item(column[i])
+        return context
+
+    def run_scalar(self, pc, lanes, stack, results):
+
+        for n, i in enumerate(lanes):
+
+            vm     = vm_create(self.lane_context(i), base_context=self.base_context)
+            thread = vm['threads'][0]
+
+            thread.pc       = pc
+            thread.regstack = [ _lane_value(v, n) for v in stack ]
+
+            vm_run_all_threads(vm, self.program, self.engine)
+
+            results[i] = vm_thread_result(thread)
+
+    def run_group(self, pc, lanes, stack, groups, results):
+
+        # Overflows and divisions by zero raise instead of warning
+        with numpy.errstate(all='raise'):
+            pc, lanes, stack = self.run_vector(pc, lanes, stack, groups, results)
+
+        if pc is not None:
+            self.run_scalar(pc, lanes, stack, results)
+
+    def run_vector(self, pc, lanes, stack, groups, results):
+
+        #
+        # Returns (pc, lanes, stack) of the lanes continuing on the scalar
+        # engine, (None, None, None) when the group is done.
+        #
+        program     = self.program
+        program_len = len(program)
+
+        while True:
+
+            if pc >= program_len:
+                break
+
+            opcode, params = program[pc]
+
+            pc += 1
+
+            if opcode == OP_CODE_PASS:
+                pass
+
+            elif opcode == OP_CODE_STOP:
+                stack = [params]
+                break
+
+            elif opcode == OP_CODE_SET:
+                stack.append(params)
+
+            elif opcode == OP_CODE_REGFLUSH:
+                _flush(stack, params)
+
+            elif opcode == OP_CODE_FLUSHSET:
+                _flush(stack, params[0])
+                stack.append(params[1])
+
+            elif opcode in _BINARY:
+                try:
+                    v = _binary(opcode, stack[-2], stack[-1])
+                except (_Scalar, ArithmeticError, TypeError, ValueError):
+                    return pc - 1, lanes, stack
+                del stack[-2:]
+                stack.append(v)
+
+            elif opcode == OP_CODE_REGOPC and params[0] in _BINARY:
+                try:
+                    stack[-1] = _binary(params[0], stack[-1], params[1])
+                except (_Scalar, ArithmeticError, TypeError, ValueError):
+                    return pc - 1, lanes, stack
+
+            elif opcode in _UNARY:
+                try:
+                    stack[-1] = _unary(opcode, stack[-1])
+                except (_Scalar, ArithmeticError, TypeError, ValueError):
+                    return pc - 1, lanes, stack
+
+            elif opcode == OP_CODE_REGNOT:
+                stack.append( _regnot(stack.pop()) )
+
+            elif opcode == OP_CODE_LOADSYM:
+                if _is_lanes(stack[-1]):
+                    return pc - 1, lanes, stack
+                stack.append( self.load(stack.pop(), lanes) )
+
+            elif opcode == OP_CODE_LOADSYMC:
+                stack.append( self.load(params, lanes) )
+
+            elif opcode == OP_CODE_JUMP:
+                pc = params
+
+            elif opcode == OP_CODE_JUMPR:
+                pc += params
+
+            elif opcode == OP_CODE_IFTRUE or opcode == OP_CODE_IFFALSE:
+
+                v = stack[-1]
+
+                if not _is_lanes(v):
+                    if bool(v) == (opcode == OP_CODE_IFTRUE):
+                        pc += params
+                    continue
+
+                mask = v.astype(bool)
+                if opcode == OP_CODE_IFFALSE:
+                    mask = ~mask
+
+                if mask.all():
+                    pc += params
+                elif mask.any():
+                    # Divergent branch: the jumping lanes become a group
+                    groups.append( (pc + params, lanes[mask], [ s[mask] if _is_lanes(s) else s for s in stack ]) )
+                    keep  = ~mask
+                    lanes = lanes[keep]
+                    stack = [ s[keep] if _is_lanes(s) else s for s in stack ]
+
+            else:
+                return pc - 1, lanes, stack
+
+        top = stack[-1] if stack else None
+
+        for n, i in enumerate(lanes):
+            results[i] = _lane_value(top, n)
+
+        return None, None, None
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+def vm_run_lanes(program, columns, context=None, base_context=None, engine=ENGINE_SWITCH):
+
+    #
+    # columns: { symbol: values }, one value per record. Returns the list
+    # of the results, one per record.
+    #
+    program = vm_load_program(program)
+
+    sizes = set([ len(values) for values in columns.values() ])
+    if len(sizes) > 1:
+        raise VMException("Columns of different length: %s" % (sorted(sizes), ))
+
+    n = sizes.pop() if sizes else 1
+
+    results = [None] * n
+
+    vectorized = numpy is not None
+
+    if vectorized:
+        arrays = dict([ (symbol, numpy.asarray(values)) for symbol, values in columns.items() ])
+        vectorized = all([ a.dtype.kind in _NUMERIC_KINDS for a in arrays.values() ])
+
+    if not vectorized:
+        lanes = _Lanes(program, columns, context, base_context, engine)
+        lanes.run_scalar(0, range(n), [], results)
+        return results
+
+    lanes  = _Lanes(program, arrays, context, base_context, engine)
+    groups = [ (0, numpy.arange(n), []) ]
+
+    while groups:
+        pc, group, stack = groups.pop()
+        lanes.run_group(pc, group, stack, groups, results)
+
+    return results
@@ -289,6 +289,22 @@ OP_CODE_REGNEQ = 419
 def REGNEQ():
     return (OP_CODE_REGNEQ,None)
 
+#----------------------------------------------------------------------#
+
+#
+# a <op> <val>
+#
+# Equivalent to
+#      SET(val)
+#      <op>()
+#
+# where <op> is a binary operator opcode (OP_CODE_REGSUM, ...)
+#
+OP_CODE_REGOPC = 420
+
+def REGOPC(op, val):
+    return (OP_CODE_REGOPC, (op, val))
+
 
 #----------------------------------------------------------------------#
 #----------------------------------------------------------------------#
@@ -322,6 +338,18 @@ OP_CODE_LOADSYMLV = 502
 def LOADSYMLV():
     return ( OP_CODE_LOADSYMLV, None )
 
+#
+#  SYM
+#
+# Equivalent to
+#      SET(symbol)
+#      LOADSYM()
+#
+OP_CODE_LOADSYMC = 503
+
+def LOADSYMC(symbol):
+    return ( OP_CODE_LOADSYMC, symbol )
+
 #----------------------------------------------------------------------#
 
 #
@@ -472,6 +500,19 @@ if __debug__: OP_CODE_CALL_SYM = 'CALL_SYM'
 def CALL_SYM(n_args=0, n_kwargs=0):
     return ( OP_CODE_CALL_SYM, (n_args, n_kwargs) )
 
+#
+# CALL_SYMC  by constant symbol name
+#
+# Equivalent to
+#      SET(symbol)
+#      CALL_SYM(n_args, n_kwargs)
+#
+OP_CODE_CALL_SYMC = 811
+if __debug__: OP_CODE_CALL_SYMC = 'CALL_SYMC'
+
+def CALL_SYMC(symbol, n_args=0, n_kwargs=0):
+    return ( OP_CODE_CALL_SYMC, (symbol, n_args, n_kwargs) )
+
 #
 # CALL_NATIVE
 #
@@ -515,6 +556,24 @@ if __debug__: OP_CODE_FORK = 'FORK'
 def FORK(addresses):
     return ( OP_CODE_FORK, addresses )
 
+#
+# Suspend the thread for the number of seconds on top of the registers
+#
+OP_CODE_SLEEP = 710
+if __debug__: OP_CODE_SLEEP = 'SLEEP'
+
+def SLEEP():
+    return ( OP_CODE_SLEEP, None )
+
+#
+# Suspend the thread until the clock on top of the registers
+#
+OP_CODE_WAIT_UNTIL = 711
+if __debug__: OP_CODE_WAIT_UNTIL = 'WAIT_UNTIL'
+
+def WAIT_UNTIL():
+    return ( OP_CODE_WAIT_UNTIL, None )
+
 #----------------------------------------------------------------------#
 #----------------------------------------------------------------------#
 #----------------------------------------------------------------------#
@@ -541,5 +600,12 @@ if __debug__: OP_CODE_INPUT = 'INPUT'
 def INPUT():
     return (OP_CODE_INPUT, None)    
 
+#
+# Register the thread on the mailbox key on top of the registers
+# (None: unregister). vm_deliver() sends input to the threads of a key.
+#
+OP_CODE_MAILBOX = 910
+if __debug__: OP_CODE_MAILBOX = 'MAILBOX'
 
-
+def MAILBOX():
+    return (OP_CODE_MAILBOX, None)
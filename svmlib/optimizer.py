@@ -0,0 +1,293 @@
+from .opcodes import *
+from .utils import BINARY_OPERATORS, UNARY_OPERATORS
+from .engine import vm_load_program, SYMBOL_SUPERINSTRUCTIONS
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+#
+# Peephole optimizer.
+#
+# vm_optimize_program() rewrites a program into an equivalent one with
+# fewer instructions:
+#
+#   * constant folding:       SET(a) SET(b) REGSUM()  ->  SET(a+b)
+#                             SET(a) SET(b) CREATETUPLE(2)  ->  SET((a,b))
+#   * jump threading:         JUMP to a JUMP goes straight to the target
+#   * dead code removal:      PASS and jumps to the next instruction
+#   * superinstructions:      SET(x) LOADSYM()      ->  LOADSYMC(x)
+#                             SET(x) CALL_SYM(n,m)  ->  CALL_SYMC(x,n,m)
+#                             SET(x) REGSUM()       ->  REGOPC(REGSUM,x)
+#                             REGFLUSH(n) SET(x)    ->  FLUSHSET(n,x)
+#
+# Instructions are never merged across a jump/fork target. Addresses of
+# JUMP, JUMPR, IFTRUE, IFFALSE and FORK are remapped on the new program.
+#
+# Threads must start running the optimized program from scratch: a pc
+# saved on the original program is not valid on the optimized one.
+#
+
+_RELATIVE_JUMPS = (OP_CODE_JUMPR, OP_CODE_IFTRUE, OP_CODE_IFFALSE)
+_SINGLE_JUMPS   = (OP_CODE_JUMP, ) + _RELATIVE_JUMPS
+_GOTO           = (OP_CODE_JUMP, OP_CODE_JUMPR)
+_CONDITIONAL    = (OP_CODE_IFTRUE, OP_CODE_IFFALSE)
+
+# Operators that may build huge values at optimization time
+_NOT_FOLDED = (OP_CODE_REGPOW, OP_CODE_REGLSHIFT)
+
+_CONSTANT_TYPES = (int, float, complex, str, bytes, bool, type(None))
+
+def _is_constant(v):
+    if isinstance(v, _CONSTANT_TYPES):
+        return True
+    if type(v) is tuple:
+        return all([ _is_constant(e) for e in v ])
+    return False
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+def vm_optimize_program(program):
+
+    #
+    # Validate the program (and its jump targets)
+    #
+    program = list(vm_load_program(program))
+
+    n = len(program)
+
+    #
+    # Nodes: [opcode, params, target]. Targets are absolute addresses in
+    # the original program (n is the end of the program)
+    #
+    nodes = []
+    for pc, (opcode, params) in enumerate(program):
+        if opcode == OP_CODE_JUMP:
+            target = params
+        elif opcode in _RELATIVE_JUMPS:
+            target = pc + 1 + params
+        elif opcode == OP_CODE_FORK:
+            target = list(params)
+        else:
+            target = None
+        nodes.append( [opcode, params, target] )
+
+    live = [True] * n
+
+    def resolve(t):
+        # Removed instructions fall through to the next live one
+        while t < n and not live[t]:
+            t += 1
+        return t
+
+    def thread_jump(t, seen):
+        t = resolve(t)
+        while t < n and nodes[t][0] in _GOTO and t not in seen:
+            seen.add(t)
+            t = resolve(nodes[t][2])
+        return t
+
+    changed = True
+    while changed:
+        changed = False
+
+        #
+        # Jump threading
+        #
+        for i in range(n):
+            if not live[i]:
+                continue
+            opcode, params, target = nodes[i]
+            if opcode in _SINGLE_JUMPS:
+                t = thread_jump(target, set([i]))
+                if t != resolve(target):
+                    changed = True
+                nodes[i][2] = t
+            elif opcode == OP_CODE_FORK:
+                nodes[i][2] = [ thread_jump(t, set()) for t in target ]
+
+        #
+        # Dead code
+        #
+        for i in range(n):
+            if not live[i]:
+                continue
+            opcode, params, target = nodes[i]
+            if opcode == OP_CODE_PASS:
+                live[i] = False
+                changed = True
+            elif opcode in _SINGLE_JUMPS and resolve(target) == resolve(i + 1):
+                live[i] = False
+                changed = True
+
+        #
+        # Folding and superinstructions
+        #
+        targets = _jump_targets(nodes, live, resolve)
+
+        seq = [ i for i in range(n) if live[i] ]
+
+        k = 0
+        while k < len(seq):
+            removed = _fuse(nodes, seq, k, targets)
+            if removed is None:
+                k += 1
+                continue
+            for i in seq[k + 1 : k + 1 + removed]:
+                live[i] = False
+            del seq[k + 1 : k + 1 + removed]
+            changed = True
+            # The new instruction may fuse with the previous one
+            k = max(k - 1, 0)
+
+    #
+    # REGFLUSH(n) SET(x): last, so that SET(x) can be folded first
+    #
+    targets = _jump_targets(nodes, live, resolve)
+
+    for i in range(n - 1):
+        j = resolve(i + 1)
+        if live[i] and j < n and j not in targets:
+            if nodes[i][0] == OP_CODE_REGFLUSH and nodes[j][0] == OP_CODE_SET:
+                nodes[i][:] = [OP_CODE_FLUSHSET, (nodes[i][1], nodes[j][1]), None]
+                live[j] = False
+
+    #
+    # Layout
+    #
+    new_address = {}
+    for i in range(n):
+        if live[i]:
+            new_address[i] = len(new_address)
+
+    new_len = len(new_address)
+
+    def address(t):
+        t = resolve(t)
+        return new_address[t] if t < n else new_len
+
+    optimized = []
+    for i in range(n):
+        if not live[i]:
+            continue
+        opcode, params, target = nodes[i]
+        pc = new_address[i]
+        if opcode == OP_CODE_JUMP:
+            addr = address(target)
+            if addr < new_len:
+                optimized.append( JUMP(addr) )
+            else:
+                optimized.append( JUMPR(addr - (pc + 1)) )
+        elif opcode in _RELATIVE_JUMPS:
+            optimized.append( (opcode, address(target) - (pc + 1)) )
+        elif opcode == OP_CODE_FORK:
+            optimized.append( FORK([ address(t) for t in target ]) )
+        else:
+            optimized.append( (opcode, params) )
+
+    return optimized
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+def _jump_targets(nodes, live, resolve):
+
+    targets = set()
+
+    for i, (opcode, params, target) in enumerate(nodes):
+        if live[i]:
+            if opcode in _SINGLE_JUMPS:
+                targets.add(resolve(target))
+            elif opcode == OP_CODE_FORK:
+                targets.update([ resolve(t) for t in target ])
+
+    return targets
+
+def _fuse(nodes, seq, k, targets):
+
+    #
+    # Try to rewrite the instructions starting at seq[k]. The result is
+    # stored in nodes[seq[k]] and the number of following instructions
+    # to remove is returned (None if nothing was done).
+    #
+
+    a = nodes[seq[k]]
+
+    b = None
+    if k + 1 < len(seq) and seq[k + 1] not in targets:
+        b = nodes[seq[k + 1]]
+
+    c = None
+    if b is not None and k + 2 < len(seq) and seq[k + 2] not in targets:
+        c = nodes[seq[k + 2]]
+
+    if a[0] == OP_CODE_CREATETUPLE and a[1] == 0:
+        a[:] = [OP_CODE_SET, (), None]
+        return 0
+
+    if a[0] != OP_CODE_SET or b is None:
+        return None
+
+    x = a[1]
+
+    #
+    # SET(x) SET(y) <binop>
+    #
+    if c is not None and b[0] == OP_CODE_SET and c[0] in BINARY_OPERATORS and c[0] not in _NOT_FOLDED:
+        y = b[1]
+        if _is_constant(x) and _is_constant(y):
+            try:
+                v = BINARY_OPERATORS[c[0]](x, y)
+            except Exception:
+                pass
+            else:
+                a[:] = [OP_CODE_SET, v, None]
+                return 2
+
+    #
+    # SET(x) ... SET(z) CREATETUPLE(m)
+    #
+    m = 0
+    while k + m < len(seq) and nodes[seq[k + m]][0] == OP_CODE_SET and (m == 0 or seq[k + m] not in targets):
+        m += 1
+    if k + m < len(seq) and seq[k + m] not in targets:
+        t = nodes[seq[k + m]]
+        if t[0] == OP_CODE_CREATETUPLE and t[1] == m:
+            a[:] = [OP_CODE_SET, tuple([ nodes[i][1] for i in seq[k : k + m] ]), None]
+            return m
+
+    #
+    # SET(x) <unop>
+    #
+    if b[0] in UNARY_OPERATORS and _is_constant(x):
+        try:
+            v = UNARY_OPERATORS[b[0]](x)
+        except Exception:
+            pass
+        else:
+            a[:] = [OP_CODE_SET, v, None]
+            return 1
+
+    #
+    # SET(x) IFTRUE/IFFALSE: the branch is known
+    #
+    if b[0] in _CONDITIONAL and _is_constant(x):
+        if bool(x) == (b[0] == OP_CODE_IFTRUE):
+            b[0] = OP_CODE_JUMPR
+        else:
+            b[:] = [OP_CODE_PASS, None, None]
+        return 0
+
+    if b[0] in SYMBOL_SUPERINSTRUCTIONS:
+        opcode, operand = SYMBOL_SUPERINSTRUCTIONS[b[0]]
+        a[:] = [opcode, operand(x, b[1]), None]
+        return 1
+
+    if b[0] in BINARY_OPERATORS:
+        a[:] = [OP_CODE_REGOPC, (b[0], x), None]
+        return 1
+
+    return None
@@ -0,0 +1,149 @@
+
+import os
+import asyncio
+import concurrent.futures
+
+from .opcodes import *
+from .vm import *
+from .vm import _vm_state_create, _vm_attach_thread, _vm_detach_thread
+from .engine import vm_load_program
+from .context import VMContext
+from .aio import vm_run_async
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+#
+# Parallel execution on a pool of processes.
+#
+# Threads do not share data, so the runnable threads of a VM can run in
+# different processes. The program is sent once to every worker when the
+# pool is created (vm_create_pool) and linked there. vm_run_parallel()
+# splits the runnable threads in shards, one per worker; a worker runs
+# its shard in a VM of its own until no thread can run and sends back the
+# threads, including the threads forked by the shard.
+#
+# The threads sent back replace the threads of the VM, the forked threads
+# get new ids from the VM. External functions run in the workers: they
+# must be picklable (module level functions) and must not rely on state
+# of the calling process.
+#
+# The base contexts of the threads are sent once per shard (the contexts
+# refer to them) and the threads sent back get the original ones again.
+#
+# The calls of a shard are completed in the worker: batched and offloaded
+# calls by vm_run_all_threads(), awaitables by an asyncio loop (the
+# pending awaitables cannot be sent back).
+#
+
+_worker_program = None
+_worker_base    = None
+
+def _worker_init(program, base_context):
+
+    global _worker_program, _worker_base
+
+    _worker_program = vm_load_program(program)
+    _worker_base    = base_context
+
+def _worker_run(bases, threads, engine, quantum):
+
+    vm = _vm_state_create()
+
+    for thread in threads:
+        _vm_attach_thread(vm, thread)
+
+    # Ids of the threads forked in the worker: replaced by the VM
+    vm['threadid'] = max(vm['threads']) + 1
+
+    vm_run_all_threads(vm, _worker_program, engine, quantum)
+
+    if vm['awaiting']:
+        asyncio.run( vm_run_async(vm, _worker_program, engine, quantum) )
+
+    if vm_status(vm)['calling']:
+        raise VMInvalidOperation("Threads of the shard still waiting for a call: %s" % (sorted(vm['sched'][THREAD_WAIT_CALL]), ))
+
+    # The same objects as the bases of the contexts: see vm_run_parallel()
+    return bases, list(vm['threads'].values())
+
+def _context_bases(threads):
+
+    bases = {}
+
+    for thread in threads:
+        if isinstance(thread.context, VMContext) and thread.context._base is not None:
+            bases[id(thread.context._base)] = thread.context._base
+
+    return list(bases.values())
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+class VMPool(concurrent.futures.ProcessPoolExecutor):
+
+    #
+    # Pool of processes with the program (and the base context used by
+    # vm_run_many) sent once to every worker.
+    #
+    def __init__(self, program, workers=None, base_context=None):
+
+        self.program      = list(program)
+        self.base_context = base_context
+
+        concurrent.futures.ProcessPoolExecutor.__init__(self,
+            max_workers = workers,
+            initializer = _worker_init,
+            initargs    = (self.program, base_context),
+        )
+
+def vm_create_pool(program, workers=None, base_context=None):
+
+    #
+    # The linked program is rebuilt in the workers: the compiled code
+    # cached by the engines cannot be pickled.
+    #
+    return VMPool(program, workers, base_context)
+
+def vm_run_parallel(vm_run_state, pool, engine=ENGINE_SWITCH, quantum=None, shards=None):
+
+    sched = vm_run_state['sched']
+
+    for t in list(sched[THREAD_NEW].values()):
+        t.state = THREAD_RUNNING
+
+    runnable = list(sched[THREAD_RUNNING].values())
+
+    if not runnable:
+        return
+
+    if shards is None:
+        shards = os.cpu_count() or 1
+
+    shards = [ runnable[i::shards] for i in range(shards) if runnable[i::shards] ]
+
+    bases   = [ _context_bases(shard) for shard in shards ]
+    futures = [ pool.submit(_worker_run, b, shard, engine, quantum) for b, shard in zip(bases, shards) ]
+
+    for shard, shard_bases, future in zip(shards, bases, futures):
+
+        ids = set([ t.id for t in shard ])
+
+        copies, threads = future.result()
+
+        originals = dict([ (id(c), b) for c, b in zip(copies, shard_bases) ])
+
+        for thread in threads:
+
+            if isinstance(thread.context, VMContext) and id(thread.context._base) in originals:
+                thread.context._base = originals[ id(thread.context._base) ]
+
+            if thread.id in ids:
+                _vm_detach_thread(vm_run_state, vm_run_state['threads'][thread.id])
+                _vm_attach_thread(vm_run_state, thread)
+            else:
+                vm_add_thread(vm_run_state, thread)
+
+    return
@@ -1,10 +1,24 @@
 if __name__ == "__main__":
 
     import sys
+    import copy
+    import pickle
     import unittest
     
     from svmlib.opcodes import *
+    from svmlib.context import *
     from svmlib.vm import *
+    from svmlib.engine import *
+    from svmlib.optimizer import *
+    from svmlib.compiler import *
+    from svmlib.jit import *
+    from svmlib.parallel import *
+    from svmlib.batch import *
+    from svmlib.lanes import *
+    from svmlib import lanes
+    from svmlib.aio import *
+
+    import asyncio
 
     class BaseTests(unittest.TestCase):
 
@@ -817,4 +831,1972 @@ if __name__ == "__main__":
             self.assertTrue( vm['threads'][0]["r0"] == 'd' )
     '''
 
+    class TableEngineTests(unittest.TestCase):
+
+        def run_engines(self, program, context=None):
+
+            vms = []
+            for engine in (ENGINE_SWITCH, ENGINE_TABLE):
+                vm = vm_create(context)
+                vm_run_all_threads(vm, program, engine=engine)
+                vms.append(vm)
+            return vms
+
+        def test_arith(self):
+
+            program = [
+                SET(7),
+                SET(2),
+                REGMOD(),
+                SET(10),
+                REGMUL(),
+                SET(3),
+                REGSUB(),
+                REGNEG(),
+            ]
+
+            vm1, vm2 = self.run_engines(program)
+
+            self.assertTrue( vm_is_finished(vm2) )
+            self.assertTrue( vm2['threads'][0]['regstack'] == [-7] )
+            self.assertTrue( vm1['threads'][0]['regstack'] == vm2['threads'][0]['regstack'] )
+
+        def test_loop(self):
+
+            context = {
+                'i': 0
+            }
+
+            program = [
+                SET('i'),        # 0
+                LOADSYMLV(),     # 1
+                SET('i'),        # 2
+                LOADSYM(),       # 3
+                SET(1),          # 4
+                REGSUM(),        # 5
+                STORESYM(),      # 6   i = i + 1
+                SET(10),         # 7
+                REGLT(),         # 8
+                IFFALSE(2),      # 9
+                REGFLUSH(),      #10
+                JUMP(0),         #11
+                STOP(0),         #12
+            ]
+
+            vm1, vm2 = self.run_engines(program, context)
+
+            self.assertTrue( vm_is_finished(vm2) )
+            self.assertTrue( vm2['threads'][0]['context']['i'] == 10 )
+            self.assertTrue( vm1['threads'][0]['context']['i'] == 10 )
+
+        def test_fork_call(self):
+
+            def fun_prints(vm_thread, s):
+                vm_thread['output'].append(s)
+
+            program = [
+                FORK([4,7]),            # 0
+                SET('Hello'),           # 1
+                CALL_NATIVE(fun_prints, 1, 0),
+                STOP(0),                # 3
+                SET('Hallo'),           # 4
+                OUTPUT(),               # 5
+                STOP(1),                # 6
+                SET('Salut'),           # 7
+                CALL_SYM(0, 0),         # 8 (symbol 'Salut' not defined)
+            ]
+
+            vm = vm_create({'Salut': lambda thread: 'ok'})
+            vm_run_all_threads(vm, program, engine=ENGINE_TABLE)
+
+            self.assertTrue( vm_is_finished(vm) )
+            self.assertTrue( len(vm['threads']) == 3 )
+            self.assertTrue( vm['threads'][0]['output'] == ['Hello'] )
+            self.assertTrue( vm['threads'][1]['output'] == ['Hallo'] )
+            self.assertTrue( vm['threads'][1]['regstack'] == [1] )
+            self.assertTrue( vm['threads'][2]['regstack'] == ['ok'] )
+
+        def test_input(self):
+
+            program = [
+                INPUT(),
+                OUTPUT(),
+            ]
+
+            vm = vm_create()
+            vm_run_all_threads(vm, program, engine=ENGINE_TABLE)
+
+            self.assertFalse( vm_is_finished(vm) )
+            self.assertTrue( vm['threads'][0]['state'] == THREAD_WAIT_IO )
+
+            vm_thread_set_input(vm['threads'][0], 'data')
+            vm_run_all_threads(vm, program, engine=ENGINE_TABLE)
+
+            self.assertTrue( vm_is_finished(vm) )
+            self.assertTrue( vm['threads'][0]['output'] == ['data'] )
+
+        def test_invalid(self):
+
+            vm = vm_create()
+
+            with self.assertRaises(VMInvalidOperation):
+                vm_run_all_threads(vm, [ JUMP(5) ], engine=ENGINE_TABLE)
+
+            vm = vm_create()
+
+            with self.assertRaises(VMException):
+                vm_run_all_threads(vm, [ (12345, None) ], engine=ENGINE_TABLE)
+
+            for engine in (ENGINE_SWITCH, ENGINE_TABLE):
+
+                vm = vm_create()
+
+                with self.assertRaises(VMException):
+                    vm_run_all_threads(vm, [ SET(1), (-1, None) ], engine=engine)
+
+                with self.assertRaises(VMException):
+                    vm_load_program([ (-1, None) ])
+
+    class LoadProgramTests(unittest.TestCase):
+
+        def test_load(self):
+
+            program = [
+                SET(1),          # 0
+                SET(2),          # 1
+                REGSUM(),        # 2
+                IFTRUE(1),       # 3
+                STOP(-1),        # 4
+                JUMP(6),         # 5
+                FORK([8]),       # 6
+                STOP(3),         # 7
+                STOP(4),         # 8
+            ]
+
+            linked = vm_load_program(program)
+
+            self.assertTrue( isinstance(linked, tuple) )
+            self.assertTrue( len(linked) == len(program) )
+            self.assertTrue( list(linked) == program )
+            self.assertTrue( vm_load_program(linked) is linked )
+
+            for engine in (ENGINE_SWITCH, ENGINE_TABLE):
+
+                vm = vm_create()
+                vm_run_all_threads(vm, linked, engine=engine)
+
+                self.assertTrue( vm_is_finished(vm) )
+                self.assertTrue( vm['threads'][0]['regstack'] == [3] )
+                self.assertTrue( vm['threads'][1]['regstack'] == [4] )
+
+        def test_end_of_program(self):
+
+            linked = vm_load_program([ SET(1), JUMPR(0) ])
+
+            vm = vm_create()
+            vm_run_all_threads(vm, linked, engine=ENGINE_TABLE)
+
+            self.assertTrue( vm_is_finished(vm) )
+            self.assertTrue( vm['threads'][0]['pc'] == 2 )
+            self.assertTrue( vm['threads'][0]['regstack'] == [1] )
+
+        def test_resolve_symbols(self):
+
+            program = [
+                SET('a'),        # 0
+                JUMPR(1),        # 1
+                SET('b'),        # 2
+                LOADSYM(),       # 3  jump target: not resolved
+                SET(2),          # 4
+                SET('f'),        # 5
+                CALL_SYM(1),     # 6
+                SET('c'),        # 7
+                LOADSYMLV(),     # 8
+                SET(5),          # 9
+                STORESYM(),      # 10
+                SET('c'),        # 11
+                LOADSYM(),       # 12
+            ]
+
+            linked = vm_load_program(program)
+
+            self.assertTrue( list(linked) == program )
+            self.assertTrue( linked.code[2][0] is not linked.code[11][0] )
+            self.assertTrue( linked.code[5][1] == ('f', 1, 0) )
+            self.assertTrue( linked.code[7][1] == (None, 'c') )
+            self.assertTrue( linked.code[11][1] == 'c' )
+
+            # Same operands as the superinstructions of the optimizer
+            optimized = vm_optimize_program(program[4:])
+            self.assertTrue( [ params for opcode, params in optimized[1:3] ] == [ ('f', 1, 0), (None, 'c') ] )
+
+            for engine in VM_ENGINES:
+
+                vm = vm_create({ 'a': 1, 'b': 10, 'c': 0, 'f': lambda t, x: x * 3 })
+                vm_run_all_threads(vm, linked, engine=engine)
+
+                self.assertTrue( vm_is_finished(vm) )
+                self.assertTrue( vm['threads'][0]['regstack'] == [1, 6, 5, 5] )
+                self.assertTrue( vm['threads'][0]['context']['c'] == 5 )
+
+        def test_invalid(self):
+
+            invalid_programs = [
+                [ JUMP(1) ],
+                [ JUMP('a') ],
+                [ JUMPR(5) ],
+                [ IFFALSE(-2) ],
+                [ FORK([0, 3]) ],
+                [ FORK(1) ],
+                [ CALL('a', 0) ],
+                [ CALL_NATIVE(None, 0, 0) ],
+                [ CREATETUPLE(None) ],
+                [ (1, 2, 3) ],
+            ]
+
+            for program in invalid_programs:
+                with self.assertRaises(VMInvalidOperation):
+                    vm_load_program(program)
+
+            with self.assertRaises(VMException):
+                vm_load_program([ (12345, None) ])
+
+    class OptimizerTests(unittest.TestCase):
+
+        def run_both(self, program, context=None):
+
+            optimized = vm_optimize_program(program)
+
+            vms = []
+            for p in (program, optimized):
+                for engine in (ENGINE_SWITCH, ENGINE_TABLE):
+                    vm = vm_create(context)
+                    vm_run_all_threads(vm, p, engine=engine)
+                    vms.append(vm)
+
+            for vm in vms[1:]:
+                self.assertTrue( len(vm['threads']) == len(vms[0]['threads']) )
+                for tid, t in vm['threads'].items():
+                    self.assertTrue( t['regstack'] == vms[0]['threads'][tid]['regstack'] )
+                    self.assertTrue( t['output'  ] == vms[0]['threads'][tid]['output'  ] )
+                    self.assertTrue( t['context' ] == vms[0]['threads'][tid]['context' ] )
+
+            return optimized
+
+        def test_folding(self):
+
+            program = [
+                PASS(),
+                SET(1),
+                SET(2),
+                REGSUM(),
+                SET(3),
+                REGMUL(),
+                SET(-1),
+                REGNEG(),
+                SET('k'),
+                SET(4),
+                CREATETUPLE(2),
+                CREATETUPLE(3),
+                SET([1]),
+                SET([2]),
+                REGSUM(),         # not folded: mutable operands
+                PASS(),
+            ]
+
+            optimized = self.run_both(program)
+
+            self.assertTrue( optimized == [
+                SET( (9, 1, ('k', 4)) ),
+                SET([1]),
+                REGOPC(OP_CODE_REGSUM, [2]),
+            ] )
+
+        def test_superinstructions(self):
+
+            def fun_add(thread, a, b):
+                return a + b
+
+            context = {
+                'x'  : 5,
+                'add': fun_add,
+            }
+
+            program = [
+                SET('x'),
+                LOADSYM(),
+                SET(2),
+                SET('add'),
+                CALL_SYM(2, 0),
+                SET(10),
+                REGLT(),
+                REGFLUSH(1),
+                SET('y'),
+                LOADSYMLV(),
+                SET(3),
+                STORESYM(),
+            ]
+
+            optimized = self.run_both(program, context)
+
+            self.assertTrue( optimized == [
+                LOADSYMC('x'),
+                SET(2),
+                CALL_SYMC('add', 2, 0),
+                REGOPC(OP_CODE_REGLT, 10),
+                FLUSHSET(1, (None, 'y')),
+                SET(3),
+                STORESYM(),
+            ] )
+
+        def test_jumps(self):
+
+            context = {
+                'i': 0
+            }
+
+            program = [
+                FORK([12]),      # 0
+                SET('i'),        # 1
+                LOADSYMLV(),     # 2
+                SET('i'),        # 3
+                LOADSYM(),       # 4
+                SET(1),          # 5
+                REGSUM(),        # 6
+                STORESYM(),      # 7
+                SET(10),         # 8
+                REGLT(),         # 9
+                IFFALSE(3),      #10
+                JUMP(15),        #11
+                PASS(),          #12
+                PASS(),          #13
+                JUMP(17),        #14
+                REGFLUSH(),      #15
+                JUMP(18),        #16
+                STOP(-1),        #17
+                JUMP(1),         #18
+            ]
+
+            optimized = self.run_both(program, context)
+
+            self.assertTrue( len(optimized) < len(program) )
+            self.assertTrue( optimized[0] == FORK([ optimized.index(STOP(-1)) ]) )
+            self.assertTrue( JUMP(15) not in optimized )
+
+    class CompilerTests(unittest.TestCase):
+
+        def test_loop(self):
+
+            context = {
+                'i': 0,
+                'd': {},
+            }
+
+            program = vm_load_program([
+                SET('i'),        # 0
+                LOADSYMLV(),     # 1
+                SET('i'),        # 2
+                LOADSYM(),       # 3
+                SET(1),          # 4
+                REGSUM(),        # 5
+                STORESYM(),      # 6   i = i + 1
+                SET('d'),        # 7
+                LOADSYM(),       # 8
+                SET('i'),        # 9
+                LOADSYM(),       #10
+                SET('i'),        #11
+                LOADSYM(),       #12
+                SET(2),          #13
+                REGPOW(),        #14
+                SET('x'),        #15
+                CREATETUPLE(2),  #16
+                DICTSETK(),      #17   d[i] = (i**2, 'x')
+                REGFLUSH(2),     #18
+                SET('i'),        #19
+                LOADSYM(),       #20
+                SET(10),         #21
+                REGLT(),         #22
+                IFTRUE(1),       #23
+                STOP(0),         #24
+                REGNOT(),        #25
+                IFFALSE(-27),    #26
+            ])
+
+            for engine in (ENGINE_SWITCH, ENGINE_COMPILED):
+
+                vm = vm_create(context)
+                vm_run_all_threads(vm, program, engine=engine)
+
+                self.assertTrue( vm_is_finished(vm) )
+                self.assertTrue( vm['threads'][0]['regstack'] == [0] )
+                self.assertTrue( vm['threads'][0]['context']['i'] == 10 )
+                self.assertTrue( vm['threads'][0]['context']['d'][3] == (9, 'x') )
+
+            self.assertTrue( vm_compile_block(program, 0) is program.cache[ENGINE_COMPILED]['blocks'][0] )
+
+        def test_pause_points(self):
+
+            calls = []
+
+            def fun_yield(thread, n):
+                calls.append(n)
+                if len(calls) == 1:
+                    raise StopException()
+                return n * 2
+
+            program = vm_load_program([
+                SET(1),                        # 0
+                SET(20),                       # 1
+                CALL_NATIVE(fun_yield, 1, 0),  # 2   yields the first time
+                SET(21),                       # 3
+                CALL_NATIVE(fun_yield, 1, 0),  # 4
+                REGSUM(),                      # 5
+                INPUT(),                       # 6
+                REGSUM(),                      # 7
+                FORK([10]),                    # 8
+                STOP(-1),                      # 9
+                OUTPUT(),                      #10
+            ])
+
+            vm = vm_create()
+            vm_run_all_threads(vm, program, engine=ENGINE_COMPILED)
+
+            self.assertTrue( calls == [20, 21] )
+            self.assertTrue( vm['threads'][0]['state'] == THREAD_WAIT_IO )
+            self.assertTrue( vm['threads'][0]['regstack'] == [43] )
+
+            vm_thread_set_input(vm['threads'][0], 100)
+            vm_run_all_threads(vm, program, engine=ENGINE_COMPILED)
+
+            self.assertTrue( vm_is_finished(vm) )
+            self.assertTrue( vm['threads'][0]['regstack'] == [-1] )
+            self.assertTrue( vm['threads'][1]['output'] == [143] )
+
+        def test_run_loop_count(self):
+
+            program = vm_load_program([
+                SET(1),
+                JUMP(2),
+                SET(2),
+                JUMP(4),
+                SET(3),
+            ])
+
+            vm = vm_create()
+            thread = vm['threads'][0]
+            thread['state'] = THREAD_RUNNING
+
+            vm_run_thread_compiled(vm, program, thread, run_loop_count=1)
+
+            self.assertTrue( thread['state'] == THREAD_RUNNING )
+            self.assertTrue( thread['pc'] == 2 )
+            self.assertTrue( thread['regstack'] == [1] )
+
+            vm_run_thread_compiled(vm, program, thread)
+
+            self.assertTrue( thread['state'] == THREAD_TERMINATED )
+            self.assertTrue( thread['regstack'] == [1, 2, 3] )
+
+        def test_short_tuple(self):
+
+            program = [
+                SET(1),
+                SET(2),
+                CREATETUPLE(3),
+            ]
+
+            for engine in (ENGINE_SWITCH, ENGINE_TABLE, ENGINE_COMPILED):
+
+                vm = vm_create()
+                vm_run_all_threads(vm, program, engine=engine)
+
+                self.assertTrue( vm['threads'][0]['regstack'] == [(1, 2)] )
+
+        def test_link_once(self):
+
+            program = [
+                FORK([3] * 50),
+                STOP(0),
+                PASS(),
+                SET(1),
+            ]
+
+            linked  = []
+            linker  = VM_LINKERS[ENGINE_COMPILED]
+
+            def counting_linker(program):
+                linked.append(program)
+                return linker(program)
+
+            VM_LINKERS[ENGINE_COMPILED] = counting_linker
+            try:
+                vm = vm_create()
+                vm_run_all_threads(vm, program, engine=ENGINE_COMPILED, quantum=1)
+            finally:
+                VM_LINKERS[ENGINE_COMPILED] = linker
+
+            self.assertTrue( vm_is_finished(vm) )
+            self.assertTrue( len(vm['threads']) == 51 )
+            self.assertTrue( len(linked) == 1 )
+
+    class JitTests(unittest.TestCase):
+
+        def test_hot_loop(self):
+
+            program = vm_load_program([
+                SET('i'),        # 0
+                LOADSYMLV(),     # 1
+                SET('i'),        # 2
+                LOADSYM(),       # 3
+                SET(1),          # 4
+                REGSUM(),        # 5
+                STORESYM(),      # 6   i = i + 1
+                SET(3),          # 7
+                REGMOD(),        # 8
+                IFTRUE(4),       # 9
+                SET('n'),        #10
+                LOADSYMLV(),     #11
+                SET(1),          #12
+                STORESYM(),      #13   n = 1 when i % 3 == 0
+                REGFLUSH(0),     #14
+                SET('i'),        #15
+                LOADSYM(),       #16
+                SET(200),        #17
+                REGLT(),         #18
+                IFTRUE(-20),     #19
+            ])
+
+            results = []
+
+            for engine in (ENGINE_SWITCH, ENGINE_JIT):
+
+                vm = vm_create({'i': 0, 'n': 0})
+                vm_run_all_threads(vm, program, engine=engine)
+
+                self.assertTrue( vm_is_finished(vm) )
+
+                thread = vm['threads'][0]
+                results.append( (thread['regstack'], thread['context']['i'], thread['context']['n']) )
+
+            self.assertTrue( results[0] == results[1] == ([False], 200, 1) )
+            self.assertTrue( 0 in program.cache[ENGINE_JIT]['traces'] )
+
+        def test_pause_in_trace(self):
+
+            program = vm_load_program([
+                INPUT(),         # 0
+                OUTPUT(),        # 1
+                JUMP(0),         # 2
+            ])
+
+            vm = vm_create()
+            thread = vm['threads'][0]
+
+            n = JIT_THRESHOLD + 10
+
+            for i in range(n):
+                vm_thread_set_input(thread, i)
+
+            vm_run_all_threads(vm, program, engine=ENGINE_JIT)
+
+            self.assertTrue( 0 in program.cache[ENGINE_JIT]['traces'] )
+            self.assertTrue( thread['state'] == THREAD_WAIT_IO )
+            self.assertTrue( thread['pc'] == 0 )
+            self.assertTrue( thread['output'] == list(range(n)) )
+
+            vm_thread_set_input(thread, n)
+            vm_run_all_threads(vm, program, engine=ENGINE_JIT)
+
+            self.assertTrue( thread['state'] == THREAD_WAIT_IO )
+            self.assertTrue( thread['output'] == list(range(n + 1)) )
+
+        def test_run_loop_count(self):
+
+            program = vm_load_program([
+                SET(0),          # 0
+                SET(1),          # 1
+                REGSUM(),        # 2
+                REGFLUSH(0),     # 3
+                JUMP(0),         # 4
+            ])
+
+            vm = vm_create()
+            thread = vm['threads'][0]
+            thread['state'] = THREAD_RUNNING
+
+            vm_run_thread_jit(vm, program, thread, run_loop_count=100)
+
+            self.assertTrue( thread['state'] == THREAD_RUNNING )
+            self.assertTrue( thread['pc'] == 1 )
+            self.assertTrue( thread['regstack'] == [0] )
+            self.assertTrue( not program.cache.get(ENGINE_JIT) )
+
+        def test_link_once(self):
+
+            program = [
+                FORK([3] * 50),
+                STOP(0),
+                PASS(),
+                SET(1),
+            ]
+
+            linked  = []
+            linker  = VM_LINKERS[ENGINE_JIT]
+
+            def counting_linker(program):
+                linked.append(program)
+                return linker(program)
+
+            VM_LINKERS[ENGINE_JIT] = counting_linker
+            try:
+                vm = vm_create()
+                vm_run_for(vm, program, engine=ENGINE_JIT, quantum=1)
+            finally:
+                VM_LINKERS[ENGINE_JIT] = linker
+
+            self.assertTrue( vm_is_finished(vm) )
+            self.assertTrue( len(vm['threads']) == 51 )
+            self.assertTrue( len(linked) == 1 )
+
+    class ContextTests(unittest.TestCase):
+
+        def test_layers(self):
+
+            base = { 'l': [1], 'n': 1 }
+
+            c = VMContext({ 'n': 2 }, parents=(base, ))
+
+            self.assertTrue( 'l' in c and 'n' in c and 'x' not in c )
+            self.assertTrue( sorted(c) == ['l', 'n'] and len(c) == 2 )
+            self.assertTrue( c == { 'l': [1], 'n': 2 } )
+            self.assertTrue( c.get('x', 3) == 3 )
+
+            c['l'].append(2)
+
+            self.assertTrue( c['l'] == [1, 2] )
+            self.assertTrue( base['l'] == [1] )
+
+            c2 = copy.deepcopy(c)
+
+            self.assertTrue( type(c2) is VMContext and c2 == c )
+
+            del c['n']
+
+            self.assertTrue( dict(c) == { 'l': [1, 2] } )
+            self.assertTrue( base == { 'l': [1], 'n': 1 } )
+
+        def test_fork(self):
+
+            context = {
+                'l': [],
+                'd': { 'who': None },
+                'x': None,
+            }
+
+            program = [
+                FORK([8]),                      # 0
+                CONTEXT_LPUSH('l', 'parent'),   # 1
+                SET('d'),                       # 2
+                LOADSYM(),                      # 3
+                SET('who'),                     # 4
+                SET('parent'),                  # 5
+                DICTSETK(),                     # 6   d['who'] = 'parent'
+                STOP(0),                        # 7
+
+                CONTEXT_LPUSH('l', 'child'),    # 8
+                SET('x'),                       # 9
+                LOADSYMLV(),                    #10
+                SET('child'),                   #11
+                STORESYM(),                     #12   x = 'child'
+                SET('d'),                       #13
+                LOADSYMLV(),                    #14
+                SET('who'),                     #15
+                GETATTRLV(),                    #16
+                SET('child'),                   #17
+                STORESYM(),                     #18   d.who = 'child'
+            ]
+
+            for engine in VM_ENGINES:
+
+                vm = vm_create(context)
+                vm_run_all_threads(vm, program, engine=engine)
+
+                self.assertTrue( vm_is_finished(vm) )
+
+                parent = vm['threads'][0]['context']
+                child  = vm['threads'][1]['context']
+
+                self.assertTrue( parent == { 'l': ['parent'], 'd': { 'who': 'parent' }, 'x': None } )
+                self.assertTrue( child  == { 'l': ['child' ], 'd': { 'who': 'child'  }, 'x': 'child' } )
+
+            self.assertTrue( context == { 'l': [], 'd': { 'who': None }, 'x': None } )
+
+        def test_fork_shares_layers(self):
+
+            table = dict([ (i, [i]) for i in range(1000) ])
+
+            vm = vm_create({ 'table': table })
+
+            vm_run_all_threads(vm, [ FORK(list(range(1, 11))) ] + [ PASS() ] * 10)
+
+            layers = [ t['context']._parents for t in vm['threads'].values() ]
+
+            self.assertTrue( len(vm['threads']) == 11 )
+            self.assertTrue( all([ l[-1] is layers[0][-1] for l in layers ]) )
+            self.assertTrue( vm['threads'][5]['context']['table'] == table )
+
+        def test_fork_reads_share(self):
+
+            table = dict([ (i, [i]) for i in range(1000) ])
+
+            program = [
+                FORK([2] * 10),     # 0
+                STOP(0),            # 1
+                SET('table'),       # 2
+                LOADSYM(),          # 3
+                SET(7),             # 4
+                GETATTR(),          # 5
+            ]
+
+            for engine in VM_ENGINES:
+
+                vm = vm_create({ 'table': table })
+                vm_run_all_threads(vm, program, engine=engine)
+
+                tables = [ t['context']['table'] for t in vm['threads'].values() ]
+
+                self.assertTrue( vm['threads'][3]['regstack'] == [[7]] )
+                self.assertTrue( all([ t is tables[0] for t in tables ]) )
+
+        def test_copy_on_write(self):
+
+            def fun_push(thread, l, v):
+                l.append(v)
+                return l
+
+            context = {
+                't'   : { 'a': { 'x': 1 } },
+                'l'   : [],
+                'push': fun_push,
+            }
+
+            program = [
+                FORK([3, 11]),                  # 0
+                SET('t'),                       # 1
+                STOP(0),                        # 2
+
+                SET('t'),                       # 3
+                LOADSYM(),                      # 4
+                SET('a'),                       # 5
+                GETATTR(),                      # 6
+                SET('x'),                       # 7
+                SET(2),                         # 8
+                DICTSETK(),                     # 9   t['a']['x'] = 2
+                STOP(0),                        #10
+
+                SET('l'),                       #11
+                LOADSYM(),                      #12
+                SET(1),                         #13
+                CALL_SYMC('push', 2, 0),        #14   push(l, 1)
+            ]
+
+            for engine in VM_ENGINES:
+
+                vm = vm_create(context)
+                vm_run_all_threads(vm, program, engine=engine)
+
+                parent, child1, child2 = [ vm['threads'][i]['context'] for i in range(3) ]
+
+                self.assertTrue( parent['t'] == { 'a': { 'x': 1 } } and parent['l'] == [] )
+                self.assertTrue( child1['t'] == { 'a': { 'x': 2 } } and child1['l'] == [] )
+                self.assertTrue( child2['t'] == { 'a': { 'x': 1 } } and child2['l'] == [1] )
+                self.assertTrue( vm['threads'][2]['regstack'] == [[1]] )
+
+                # push() can change the context: child2 got its copy
+                self.assertTrue( parent['t'] is not child2['t'] and child2['t'] == { 'a': { 'x': 1 } } )
+
+                # In place changes from external code
+                l = vm_context_own(parent, parent['l'])
+                l.append(0)
+
+                self.assertTrue( parent['l'] == [0] and child1['l'] == [] )
+
+            self.assertTrue( context['t'] == { 'a': { 'x': 1 } } and context['l'] == [] )
+
+        def test_copy_aliases(self):
+
+            program = [
+                SET('t'),        # 0
+                LOADSYM(),       # 1
+                SET('t'),        # 2
+                LOADSYM(),       # 3
+                SET('x'),        # 4
+                SET(1),          # 5
+                DICTSETK(),      # 6  the copy replaces both registers
+                REGFLUSH(1),     # 7
+                SET('x'),        # 8
+                GETATTR(),       # 9
+                OUTPUT(),        #10
+            ]
+
+            for engine in VM_ENGINES:
+
+                vm = vm_create({ 't': {} })
+                vm_run_all_threads(vm, program, engine=engine)
+
+                self.assertTrue( vm['threads'][0].output == [1] )
+                self.assertTrue( vm['threads'][0]['context']['t'] == { 'x': 1 } )
+
+        def test_external_isolation(self):
+
+            def append(thread, l, v):
+                l.append(v)
+                return None
+
+            def append_context(thread, v):
+                thread['context']['l'].append(v)
+
+            def size(thread, t):
+                return len(t)
+
+            program = [
+                FORK([3]),                      # 0
+                SET(0),                         # 1
+                JUMP(4),                        # 2
+                SET(1),                         # 3
+                CALL_NATIVE(append_context, 1, 0),
+                REGFLUSH(0),                    # 5
+                SET('l'),                       # 6
+                LOADSYM(),                      # 7
+                SET('l'),                       # 8
+                LOADSYM(),                      # 9
+                SET(9),                         #10
+                CALL_NATIVE(append, 2, 0),      #11  the register aliasing l sees the change
+                REGFLUSH(1),                    #12
+                OUTPUT(),                       #13
+                SET('t'),                       #14
+                LOADSYM(),                      #15
+                CALL_NATIVE(vm_readonly(size), 1, 0),
+            ]
+
+            for engine in VM_ENGINES:
+
+                vm = vm_create({ 'l': [], 't': {} })
+                vm_run_all_threads(vm, program, engine=engine)
+
+                parent, child = vm['threads'][0], vm['threads'][1]
+
+                self.assertTrue( parent.output == [[0, 9]] and child.output == [[1, 9]] )
+                self.assertTrue( parent['context']['l'] == [0, 9] and child['context']['l'] == [1, 9] )
+
+            # A read only function gets the shared values
+            program = [
+                FORK([2]),                      # 0
+                PASS(),                         # 1
+                SET('t'),                       # 2
+                LOADSYM(),                      # 3
+                CALL_NATIVE(vm_readonly(size), 1, 0),
+            ]
+
+            for engine in VM_ENGINES:
+
+                vm = vm_create({ 't': { 'a': 1 } })
+                vm_run_all_threads(vm, program, engine=engine)
+
+                parent, child = vm['threads'][0]['context'], vm['threads'][1]['context']
+
+                self.assertTrue( vm['threads'][1].regstack == [1] and parent['t'] is child['t'] )
+
+        def test_copy_layer_aliases(self):
+
+            inner = {}
+
+            program = [
+                FORK([2]),       # 0
+                PASS(),          # 1
+                SET('d'),        # 2
+                LOADSYM(),       # 3
+                SET('x'),        # 4
+                GETATTR(),       # 5
+                SET('z'),        # 6
+                SET(1),          # 7
+                DICTSETK(),      # 8  d['x']['z'] = 1
+                REGFLUSH(0),     # 9
+                SET('q'),        #10
+                LOADSYM(),       #11  q is d['x']
+                OUTPUT(),        #12
+            ]
+
+            for engine in VM_ENGINES:
+
+                vm = vm_create({ 'd': { 'x': inner }, 'q': inner })
+                vm_run_all_threads(vm, program, engine=engine)
+
+                self.assertTrue( [ t.output for t in vm['threads'].values() ] == [ [{ 'z': 1 }] ] * 2 )
+
+            self.assertTrue( inner == {} )
+
+    class BaseContextTests(unittest.TestCase):
+
+        def test_shared(self):
+
+            base = {
+                'table': { 'a': 1, 'b': 2 },
+                'n'    : 10,
+            }
+
+            program = [
+                SET('table'),    # 0
+                LOADSYM(),       # 1
+                SET('b'),        # 2
+                GETATTR(),       # 3
+                SET('n'),        # 4
+                LOADSYM(),       # 5
+                REGSUM(),        # 6
+                SET('n'),        # 7
+                LOADSYMLV(),     # 8
+                SET(0),          # 9
+                STORESYM(),      #10   n = 0 (shadows the base)
+                FORK([13]),      #11
+                STOP(-1),        #12
+                SET('n'),        #13
+                LOADSYM(),       #14
+            ]
+
+            for engine in VM_ENGINES:
+
+                vm = vm_create({ 'x': [] }, base_context=base)
+                vm_run_all_threads(vm, program, engine=engine)
+
+                self.assertTrue( vm_is_finished(vm) )
+
+                main  = vm['threads'][0]
+                child = vm['threads'][1]
+
+                self.assertTrue( main['context']['n'] == 0 and child['context']['n'] == 0 )
+                self.assertTrue( child['regstack'] == [12, 0, 0] )
+                self.assertTrue( main['context']['table'] is base['table'] )
+                self.assertTrue( child['context']['table'] is base['table'] )
+                self.assertTrue( sorted(child['context']) == ['n', 'table', 'x'] )
+
+            self.assertTrue( base == { 'table': { 'a': 1, 'b': 2 }, 'n': 10 } )
+
+    class ThreadTests(unittest.TestCase):
+
+        def test_dict_access(self):
+
+            thread = vm_thread_create(pc=3, context={ 'a': 1 })
+
+            self.assertTrue( type(thread) is VMThread )
+            self.assertTrue( thread['pc'] == thread.pc == 3 )
+            self.assertTrue( "%(id)s %(state)s" % thread == "None NEW" )
+
+            thread['clock'] = 10
+            thread['user']  = 'data'
+
+            self.assertTrue( thread.clock == 10 )
+            self.assertTrue( 'user' in thread and 'other' not in thread )
+            self.assertTrue( thread.get('other', 1) == 1 )
+            self.assertTrue( dict(thread)['user'] == 'data' )
+            self.assertTrue( len(thread) == len(thread.keys()) == 10 )
+
+            with self.assertRaises(KeyError):
+                thread['other']
+
+            del thread['user']
+
+            self.assertTrue( 'user' not in thread )
+
+        def test_copy(self):
+
+            thread = vm_thread_create(context={ 'a': [1] })
+            thread['user'] = 'data'
+
+            for t in (copy.deepcopy(thread), pickle.loads(pickle.dumps(thread))):
+                self.assertTrue( t['user'] == 'data' )
+                self.assertTrue( t.context == { 'a': [1] } )
+                self.assertTrue( t.context is not thread.context )
+
+        def test_sched(self):
+
+            program = [
+                FORK([1]),
+                INPUT(),
+                STOP(0),
+            ]
+
+            vm = vm_create()
+
+            vm_run_all_threads(vm, program)
+
+            sched = vm['sched']
+
+            self.assertTrue( sorted(sched[THREAD_WAIT_IO]) == [0, 1] )
+            self.assertTrue( not sched[THREAD_RUNNING] and not sched[THREAD_NEW] )
+
+            vm_thread_set_input(vm['threads'][1], 'data')
+
+            self.assertTrue( list(sched[THREAD_RUNNING]) == [1] )
+
+            vm_run_all_threads(vm, program)
+
+            self.assertTrue( list(sched[THREAD_WAIT_IO]) == [0] )
+            self.assertTrue( list(sched[THREAD_TERMINATED]) == [1] )
+            self.assertTrue( vm['threads'][1]['regstack'] == [0] )
+
+        def test_status(self):
+
+            program = [
+                FORK([1]),
+                INPUT(),
+                STOP(0),
+            ]
+
+            vm = vm_create()
+
+            self.assertTrue( vm_status(vm)['states'][THREAD_NEW] == 1 )
+
+            vm_run_all_threads(vm, program)
+
+            status = vm_status(vm)
+
+            self.assertTrue( status['threads'] == status['live'] == status['waiting'] == 2 )
+            self.assertTrue( status['running'] == status['terminated'] == 0 )
+
+            for t in vm['threads'].values():
+                vm_thread_set_input(t, 'data')
+
+            vm_run_all_threads(vm, program)
+
+            status = vm_status(vm)
+
+            self.assertTrue( status['live'] == 0 and status['terminated'] == 2 )
+            self.assertTrue( vm_is_finished(vm) )
+
+        def test_reap(self):
+
+            program = [
+                SET('a'),
+                OUTPUT(),
+                FORK([4]),
+                STOP(1),
+                INPUT(),
+            ]
+
+            vm = vm_create()
+
+            vm_run_all_threads(vm, program)
+
+            self.assertTrue( vm_reap_threads(vm) == 1 )
+            self.assertTrue( vm['results'] == { 0: (1, ['a']) } )
+            self.assertTrue( list(vm['threads']) == [1] )
+            self.assertTrue( not vm_is_finished(vm) )
+
+            reaped = []
+
+            vm_thread_set_input(vm['threads'][1], 'b')
+            vm_run_all_threads(vm, program)
+
+            self.assertTrue( vm_is_finished(vm) )
+            self.assertTrue( vm_reap_threads(vm, lambda *r: reaped.append(r)) == 1 )
+            self.assertTrue( reaped == [ (1, 'b', []) ] )
+            self.assertTrue( vm_status(vm)['reaped'] == 2 and not vm['threads'] )
+
+            vm_add_thread(vm, vm_thread_create())
+
+            self.assertTrue( list(vm['threads']) == [2] )
+
+        def test_inputs(self):
+
+            program = [
+                INPUT(),
+                FORK([2]),
+                INPUT(),
+                INPUT(),
+                STOP(0),
+            ]
+
+            vm = vm_create()
+            main = vm['threads'][0]
+
+            vm_thread_set_inputs(main, range(3))
+
+            self.assertTrue( main.state == THREAD_RUNNING and len(main.input) == 3 )
+
+            vm_run_all_threads(vm, program)
+
+            child = vm['threads'][1]
+
+            self.assertTrue( main.state == THREAD_TERMINATED )
+            self.assertTrue( main.input == child.input == [] )
+            self.assertTrue( main.regstack == child.regstack == [0] )
+
+            with self.assertRaises(Exception):
+                vm_thread_set_inputs(child, [1])
+
+            thread = vm_thread_create()
+
+            with self.assertRaises(IndexError):
+                thread.input.popleft()
+
+            self.assertTrue( thread.input._queue is None and len(thread.input) == 0 )
+
+            thread.input.extend([1, 2])
+            thread2 = vm_thread_create()
+            thread2.input = VMInput(shared=tuple(thread.input))
+            thread2.input.append(3)
+
+            self.assertTrue( [ thread2.input.popleft() for i in range(3) ] == [1, 2, 3] )
+            self.assertTrue( thread.input == [1, 2] and not thread2.input )
+
+        def test_input_timeout(self):
+
+            program = [
+                FORK([1, 1]),
+                INPUT(),
+                STOP(0),
+            ]
+
+            vm = vm_create(clock=0)
+
+            vm_run_all_threads(vm, program)
+
+            for tid, timeout in ((0, 10), (1, 20), (2, None)):
+                vm['threads'][tid].input_timeout = timeout
+                vm['threads'][tid].state = THREAD_RUNNING
+
+            vm_run_all_threads(vm, program)
+
+            self.assertTrue( sorted(vm['timers']) == [ (10, 0), (20, 1) ] )
+
+            vm_set_clock(vm, 15)
+
+            self.assertTrue( list(vm['sched'][THREAD_RUNNING]) == [0] )
+            self.assertTrue( vm['timers'] == [ (20, 1) ] )
+
+            vm_run_all_threads(vm, program)
+
+            self.assertTrue( vm['threads'][0].state == THREAD_TERMINATED )
+
+            vm_thread_set_input(vm['threads'][1], 'data')
+            vm_run_all_threads(vm, program)
+            vm_set_clock(vm, 30)
+
+            self.assertTrue( vm['threads'][1].regstack == [0] )
+            self.assertTrue( vm['threads'][2].state == THREAD_WAIT_IO )
+            self.assertTrue( vm['timers'] == [] )
+
+        def test_timers_bounded(self):
+
+            program = [
+                INPUT(),         # 0
+                REGFLUSH(0),     # 1
+                JUMP(0),         # 2
+            ]
+
+            vm = vm_create(clock=0)
+            thread = vm['threads'][0]
+            thread.input_timeout = 10 ** 9
+
+            for i in range(1000):
+                vm_thread_set_input(thread, i)
+                vm_run_all_threads(vm, program)
+
+            self.assertTrue( thread.state == THREAD_WAIT_IO )
+            self.assertTrue( vm['timers'] == [ (10 ** 9, 0) ] )
+
+            # A new deadline at every wait: the heap is compacted
+            for i in range(1000):
+                thread.input_timeout = 10 ** 9 + i
+                vm_thread_set_input(thread, i)
+                vm_run_all_threads(vm, program)
+
+            self.assertTrue( len(vm['timers']) <= 2 + TIMERS_COMPACT_MIN )
+            self.assertTrue( vm_next_deadline(vm) == 10 ** 9 + 999 )
+
+    class MailboxTests(unittest.TestCase):
+
+        def test_deliver(self):
+
+            program = [
+                FORK([4]),       # 0
+                SET('a'),        # 1
+                JUMP(5),         # 2
+                PASS(),          # 3
+                SET('b'),        # 4
+                MAILBOX(),       # 5
+                INPUT(),         # 6
+                OUTPUT(),        # 7
+            ]
+
+            for engine in (ENGINE_SWITCH, ENGINE_TABLE, ENGINE_COMPILED, ENGINE_JIT):
+
+                vm = vm_create()
+                vm_run_all_threads(vm, program, engine=engine)
+
+                self.assertTrue( sorted(vm['mailboxes']) == ['a', 'b'] )
+                self.assertTrue( vm_deliver(vm, 'c', 'data') == 0 )
+                self.assertTrue( vm_deliver(vm, 'b', 'data') == 1 )
+                self.assertTrue( vm_status(vm)['running'] == 1 )
+
+                vm_run_all_threads(vm, program, engine=engine)
+
+                self.assertTrue( vm['threads'][1]['output'] == ['data'] )
+                self.assertTrue( vm['threads'][1]['state'] == THREAD_TERMINATED )
+                self.assertTrue( vm['threads'][0]['state'] == THREAD_WAIT_IO )
+                self.assertTrue( list(vm['mailboxes']) == ['a'] )
+
+        def test_api(self):
+
+            vm = vm_create()
+            thread = vm['threads'][0]
+
+            vm_thread_set_mailbox(vm, thread, 'k1')
+            vm_thread_set_mailbox(vm, thread, 'k2')
+
+            self.assertTrue( vm['mailboxes'] == { 'k2': { 0: thread } } )
+
+            vm_thread_set_mailbox(vm, thread, None)
+
+            self.assertTrue( vm['mailboxes'] == {} )
+
+    class TimerTests(unittest.TestCase):
+
+        def test_sleep_without_clock(self):
+
+            for engine in VM_ENGINES:
+                for opcode in (SLEEP(), WAIT_UNTIL()):
+
+                    vm = vm_create()
+
+                    with self.assertRaises(VMInvalidOperation):
+                        vm_run_all_threads(vm, [ SET(10), opcode ], engine=engine)
+
+        def test_vm_clock(self):
+
+            program = [
+                FORK([2] * 10),  # 0
+                PASS(),          # 1
+                SET(100),        # 2
+                SLEEP(),         # 3
+            ]
+
+            vm = vm_create(clock=0)
+            vm_run_all_threads(vm, program)
+
+            # One clock for the VM: the threads are not visited
+            vm_set_clock(vm, 50)
+
+            self.assertTrue( vm['clock'] == 50 and all([ t.clock == 50 for t in vm['threads'].values() ]) )
+            self.assertTrue( vm_status(vm)['sleeping'] == 11 )
+
+            vm_set_clock(vm, 100)
+            vm_run_all_threads(vm, program)
+
+            self.assertTrue( vm_is_finished(vm) )
+
+            threads = list(vm['threads'].values())
+            vm_reap_threads(vm)
+            vm_set_clock(vm, 200)
+
+            # Threads out of the VM keep the clock they had
+            self.assertTrue( all([ t.clock == 100 for t in threads ]) )
+            self.assertTrue( pickle.loads(pickle.dumps(threads[0])).clock == 100 )
+
+        def test_sleep(self):
+
+            program = [
+                FORK([5]),       # 0
+                SET(3600),       # 1
+                SLEEP(),         # 2
+                SET('main'),     # 3
+                STOP(0),         # 4
+                SET(100),        # 5
+                WAIT_UNTIL(),    # 6
+                SET(0),          # 7
+                SLEEP(),         # 8  no wait
+                SET('child'),    # 9
+                OUTPUT(),        #10
+            ]
+
+            for engine in (ENGINE_SWITCH, ENGINE_TABLE, ENGINE_COMPILED, ENGINE_JIT):
+
+                vm = vm_create(clock=10)
+                vm_run_all_threads(vm, program, engine=engine)
+
+                self.assertTrue( vm_status(vm)['sleeping'] == 2 )
+
+                vm_set_clock(vm, 100)
+
+                self.assertTrue( list(vm['sched'][THREAD_RUNNING]) == [1] )
+
+                vm_run_all_threads(vm, program, engine=engine)
+
+                self.assertTrue( vm['threads'][1]['output'] == ['child'] )
+                self.assertTrue( vm['threads'][1]['state'] == THREAD_TERMINATED )
+                self.assertTrue( vm['threads'][0]['state'] == THREAD_SLEEP )
+
+                vm_set_clock(vm, 3610)
+                vm_run_all_threads(vm, program, engine=engine)
+
+                self.assertTrue( vm_is_finished(vm) )
+
+        def test_discrete(self):
+
+            program = [
+                SET(86400),      # 0
+                SLEEP(),         # 1
+                SET('i'),        # 2
+                LOADSYMLV(),     # 3
+                SET('i'),        # 4
+                LOADSYM(),       # 5
+                SET(1),          # 6
+                REGSUM(),        # 7
+                STORESYM(),      # 8   i = i + 1
+                SET(365),        # 9
+                REGLT(),         #10
+                IFFALSE(2),      #11
+                REGFLUSH(),      #12
+                JUMP(0),         #13
+                STOP(0),         #14
+            ]
+
+            vm = vm_create({ 'i': 0 }, clock=0)
+
+            self.assertTrue( vm_run_discrete(vm, program, until=86400 * 10) == 86400 * 10 )
+            self.assertTrue( vm['threads'][0]['context']['i'] == 10 )
+
+            self.assertTrue( vm_run_discrete(vm, program) == 86400 * 365 )
+            self.assertTrue( vm['threads'][0]['context']['i'] == 365 )
+            self.assertTrue( vm_is_finished(vm) )
+
+    class QuantumTests(unittest.TestCase):
+
+        def run_vm(self, quantum=None, priority=None, engine=ENGINE_SWITCH):
+
+            log = []
+
+            def record(thread):
+                log.append(thread.id)
+
+            program = [
+                SET('i'),        # 0
+                LOADSYMLV(),     # 1
+                SET('i'),        # 2
+                LOADSYM(),       # 3
+                SET(1),          # 4
+                REGSUM(),        # 5
+                STORESYM(),      # 6   i = i + 1
+                REGFLUSH(),      # 7
+                CALL_NATIVE(record, 0, 0),
+                REGFLUSH(),      # 9
+                SET('i'),        #10
+                LOADSYM(),       #11
+                SET(3),          #12
+                REGLT(),         #13
+                IFFALSE(2),      #14
+                REGFLUSH(),      #15
+                JUMP(0),         #16
+                STOP(0),         #17
+            ]
+
+            vm = vm_create({ 'i': 0 })
+            vm_add_thread(vm, vm_thread_create(context={ 'i': 0 }))
+
+            if priority is not None:
+                vm_thread_set_priority(vm, vm['threads'][1], priority)
+
+            vm_run_all_threads(vm, program, engine=engine, quantum=quantum)
+
+            self.assertTrue( vm_is_finished(vm) )
+
+            return log
+
+        def test_round_robin(self):
+
+            self.assertTrue( self.run_vm() == [0, 0, 0, 1, 1, 1] )
+
+            for engine in (ENGINE_SWITCH, ENGINE_TABLE, ENGINE_JIT):
+                self.assertTrue( self.run_vm(17, engine=engine) == [0, 1, 0, 1, 0, 1] )
+
+            self.assertTrue( self.run_vm(17, priority=1) == [1, 0, 1, 0, 1, 0] )
+
+        def test_run_for(self):
+
+            program = [
+                SET(0),          # 0
+                JUMP(0),         # 1
+            ]
+
+            vm = vm_create()
+
+            self.assertFalse( vm_run_for(vm, program, max_instructions=100, quantum=30) )
+            self.assertTrue( vm['threads'][0].state == THREAD_RUNNING )
+            self.assertTrue( len(vm['threads'][0].regstack) == 50 )
+
+            self.assertFalse( vm_run_for(vm, program, max_seconds=0.01) )
+            self.assertTrue( vm['threads'][0].state == THREAD_RUNNING )
+
+            vm = vm_create()
+            vm_add_thread(vm, vm_thread_create(pc=2))
+
+            self.assertFalse( vm_run_for(vm, program, max_instructions=10, quantum=10) )
+            self.assertTrue( list(vm['sched'][THREAD_RUNNING]) == [1, 0] )
+            self.assertFalse( vm_run_for(vm, program, max_instructions=1) )
+            self.assertTrue( vm['threads'][1].state == THREAD_TERMINATED )
+            self.assertTrue( vm_run_for(vm_create(), [ STOP(0) ], max_instructions=1) )
+
+    # External functions of the workers must be picklable
+    async def _parallel_fetch(thread, n):
+        await asyncio.sleep(0.001)
+        return n * 10
+
+    class ParallelTests(unittest.TestCase):
+
+        def test_calls(self):
+
+            program = [
+                FORK([2] * 3),       # 0
+                STOP(0),             # 1
+                SET('n'),            # 2
+                LOADSYM(),           # 3
+                CALL_SYMC('fetch', 1, 0),
+                SET('n'),            # 5
+                LOADSYM(),           # 6
+                REGSUM(),            # 7
+            ]
+
+            context = { 'n': 2, 'fetch': _parallel_fetch }
+
+            vm = vm_create(context)
+            vm_run_for(vm, program, max_instructions=1)
+
+            self.assertTrue( vm['threads'][0]['context']['fetch'] is _parallel_fetch )
+
+            with vm_create_pool(program, workers=2) as pool:
+                vm_run_parallel(vm, pool, shards=2)
+
+            # The calls are completed in the workers
+            self.assertTrue( vm_is_finished(vm) and vm_status(vm)['calling'] == 0 )
+            self.assertTrue( [ vm['threads'][i].regstack for i in range(1, 4) ] == [ [22] ] * 3 )
+
+        def test_parallel(self):
+
+            program = [
+                SET('main'),         # 0
+                STOP(0),             # 1
+                SET('n'),            # 2
+                LOADSYM(),           # 3
+                SET(2),              # 4
+                REGMUL(),            # 5
+                OUTPUT(),            # 6
+                INPUT(),             # 7
+            ]
+
+            vm = vm_create()
+
+            for i in range(3):
+                vm_add_thread(vm, vm_thread_create(pc=2, context={ 'n': 21 }))
+
+            vm_thread_set_mailbox(vm, vm['threads'][3], 'key')
+
+            with vm_create_pool(program, workers=2) as pool:
+                vm_run_parallel(vm, pool, shards=2)
+
+            threads = vm['threads']
+
+            self.assertTrue( sorted(threads) == [0, 1, 2, 3] )
+            self.assertTrue( threads[0].regstack == [0] and threads[0].state == THREAD_TERMINATED )
+
+            for tid in (1, 2, 3):
+                self.assertTrue( threads[tid].output == [42] )
+                self.assertTrue( threads[tid].state == THREAD_WAIT_IO )
+
+            self.assertTrue( vm_status(vm)['waiting'] == 3 )
+            self.assertTrue( vm['mailboxes'] == { 'key': { 3: threads[3] } } )
+
+            vm_deliver(vm, 'key', 'data')
+            vm_run_all_threads(vm, program)
+
+            self.assertTrue( threads[3].regstack == ['data'] )
+
+        def test_fork(self):
+
+            program = [
+                FORK([2]),           # 0
+                STOP(0),             # 1
+                STOP(1),             # 2
+            ]
+
+            vm = vm_create()
+
+            with vm_create_pool(program, workers=1) as pool:
+                vm_run_parallel(vm, pool)
+
+            self.assertTrue( vm_is_finished(vm) and len(vm['threads']) == 2 )
+            self.assertTrue( vm['threads'][1].regstack == [1] and vm['threadid'] == 2 )
+
+        def test_base_context(self):
+
+            base = { 'table': dict([ (i, str(i)) for i in range(1000) ]) }
+
+            program = [
+                FORK([2] * 7),       # 0
+                STOP(0),             # 1
+                SET('table'),        # 2
+                LOADSYM(),           # 3
+                SET(7),              # 4
+                GETATTR(),           # 5
+            ]
+
+            vm = vm_create({ 'n': 1 }, base_context=base)
+            vm_run_for(vm, program, max_instructions=1)
+
+            # The base is pickled once for all the contexts
+            size = len(pickle.dumps(list(vm['threads'].values())))
+            self.assertTrue( size < 2 * len(pickle.dumps(base)) )
+
+            with vm_create_pool(program, workers=2) as pool:
+                vm_run_parallel(vm, pool, shards=2)
+
+            self.assertTrue( vm_is_finished(vm) and len(vm['threads']) == 8 )
+
+            for thread in vm['threads'].values():
+                self.assertTrue( thread.context._base is base )
+                self.assertTrue( 'table' not in dict(dict.items(thread.context)) )
+                self.assertTrue( thread.context['n'] == 1 )
+
+            self.assertTrue( vm['threads'][3].regstack == ['7'] )
+
+    class BatchTests(unittest.TestCase):
+
+        def test_contexts(self):
+
+            program = [
+                SET('n'),            # 0
+                LOADSYM(),           # 1
+                SET('k'),            # 2
+                LOADSYM(),           # 3
+                REGMUL(),            # 4
+            ]
+
+            events  = [ { 'n': n } for n in range(10) ]
+            results = [ n * 3 for n in range(10) ]
+
+            self.assertTrue( vm_run_many(program, events, base_context={ 'k': 3 }) == results )
+
+            base = { 'k': 3 }
+
+            with vm_create_pool(program, workers=2, base_context=base) as pool:
+
+                self.assertTrue( vm_run_many(program, events, pool=pool, chunksize=3) == results )
+                self.assertTrue( vm_run_many(program, events, base_context=base, pool=pool) == results )
+
+                with self.assertRaises(VMInvalidOperation):
+                    vm_run_many(program[:-1], events, pool=pool)
+
+                with self.assertRaises(VMInvalidOperation):
+                    vm_run_many(program, events, base_context={ 'k': 4 }, pool=pool)
+
+        def test_inputs(self):
+
+            program = [
+                INPUT(),             # 0
+                SET('k'),            # 1
+                LOADSYM(),           # 2
+                REGSUM(),            # 3
+            ]
+
+            results = vm_run_many(program, range(5), engine=ENGINE_TABLE, context={ 'k': 10 }, inputs=True)
+
+            self.assertTrue( results == [10, 11, 12, 13, 14] )
+
+            # The context is frozen once: the VMs of the events share it
+            tables = []
+
+            def record(thread, table):
+                tables.append(table)
+                return len(table)
+
+            program = [
+                SET('table'),        # 0
+                LOADSYM(),           # 1
+                CALL_NATIVE(vm_readonly(record), 1, 0),
+            ]
+
+            table = dict([ (i, i) for i in range(100) ])
+
+            self.assertTrue( vm_run_many(program, range(5), context={ 'table': table }, inputs=True) == [100] * 5 )
+            self.assertTrue( tables[0] == table and tables[0] is not table )
+            self.assertTrue( all([ t is tables[0] for t in tables ]) )
+
+    class LanesTests(unittest.TestCase):
+
+        program = [
+            SET('x'),            # 0
+            LOADSYM(),           # 1
+            SET('limit'),        # 2
+            LOADSYM(),           # 3
+            REGLT(),             # 4
+            IFFALSE(3),          # 5
+            LOADSYMC('x'),       # 6
+            REGOPC(OP_CODE_REGMUL, 2),
+            STOP(1),             # 8  (replaced below)
+            STOP(-1),            # 9
+        ]
+
+        def scalar(self, program, records, context):
+            return [ vm_run_many(program, [ dict(context, **r) ])[0] for r in records ]
+
+        def test_lanes(self):
+
+            program = list(self.program)
+            program[8] = JUMP(10)
+            program += [
+                SET('y'),            #10
+                LOADSYM(),           #11
+                REGSUM(),            #12
+            ]
+
+            columns = { 'x': [1, 5, 2, 8], 'y': [10, 20, 30, 40] }
+            records = [ { 'x': x, 'y': y } for x, y in zip(columns['x'], columns['y']) ]
+
+            results = vm_run_lanes(program, columns, context={ 'limit': 4 })
+
+            self.assertTrue( results == [12, -1, 34, -1] )
+            self.assertTrue( results == self.scalar(program, records, { 'limit': 4 }) )
+
+        def test_fallback(self):
+
+            program = [
+                SET('x'),            # 0
+                LOADSYM(),           # 1
+                SET(2),              # 2
+                REGGT(),             # 3
+                IFFALSE(2),          # 4
+                SET('big'),          # 5
+                OUTPUT(),            # 6  scalar engine
+                SET('x'),            # 7
+                LOADSYM(),           # 8
+                SET(10),             # 9
+                REGMUL(),            #10
+            ]
+
+            columns = { 'x': [1, 2, 3, 4] }
+
+            self.assertTrue( vm_run_lanes(program, columns) == [10, 20, 30, 40] )
+            self.assertTrue( vm_run_lanes(program[:2] + program[7:], { 'x': ['a', 'b'] }) == ['a' * 10, 'b' * 10] )
+
+            numpy = lanes.numpy
+            try:
+                lanes.numpy = None
+                self.assertTrue( vm_run_lanes(program, columns) == [10, 20, 30, 40] )
+            finally:
+                lanes.numpy = numpy
+
+        def test_scalar_semantics(self):
+
+            program = [
+                SET('x'),            # 0
+                LOADSYM(),           # 1
+                SET('y'),            # 2
+                LOADSYM(),           # 3
+                REGMUL(),            # 4
+                SET('x'),            # 5
+                LOADSYM(),           # 6
+                REGSUM(),            # 7
+            ]
+
+            # bools are added as ints
+            columns = { 'x': [True, False], 'y': [True, True] }
+            records = [ { 'x': True, 'y': True }, { 'x': False, 'y': True } ]
+            self.assertTrue( vm_run_lanes(program, columns) == [2, 0] )
+            self.assertTrue( vm_run_lanes(program, columns) == self.scalar(program, records, {}) )
+
+            # int64 overflows continue on the scalar engine
+            columns = { 'x': [3, 1], 'y': [2 ** 62, 5] }
+            self.assertTrue( vm_run_lanes(program, columns) == [3 * 2 ** 62 + 3, 6] )
+
+            program[4] = REGMOD()
+            self.assertRaises(ZeroDivisionError, vm_run_lanes, program, { 'x': [3, 1], 'y': [1, 0] })
+
+        def test_non_numeric_operands(self):
+
+            columns = { 'a': [1, 2] }
+            records = [ { 'a': 1 }, { 'a': 2 } ]
+
+            programs = [
+                [ SET('a'), LOADSYM(), SET((1, 2)), REGEQ() ],
+                [ SET('a'), LOADSYM(), SET((1, 2)), REGMUL() ],
+                [ SET('a'), LOADSYM(), SET('x'), REGMUL() ],
+                [ SET('a'), LOADSYM(), SET('t'), LOADSYM(), REGSUM() ],
+            ]
+
+            expected = [
+                [False, False],
+                [(1, 2), (1, 2, 1, 2)],
+                ['x', 'xx'],
+            ]
+
+            context = { 't': [10, 20] }
+
+            for program, results in zip(programs, expected):
+                self.assertTrue( vm_run_lanes(program, columns) == results )
+                self.assertTrue( vm_run_lanes(program, columns) == self.scalar(program, records, {}) )
+
+            # A list is not broadcast: TypeError like the scalar engine
+            self.assertRaises(TypeError, vm_run_lanes, programs[3], columns, context)
+            self.assertRaises(TypeError, self.scalar, programs[3], records, context)
+
+    class AsyncTests(unittest.TestCase):
+
+        def test_async_calls(self):
+
+            calls = { 'pending': 0, 'max': 0 }
+
+            async def fetch(thread, n):
+                calls['pending'] += 1
+                calls['max'] = max(calls['max'], calls['pending'])
+                await asyncio.sleep(0.01 * n)
+                calls['pending'] -= 1
+                return n * 10
+
+            def double(thread, n):
+                return n * 2
+
+            program = [
+                FORK([3, 5]),        # 0
+                SET(3),              # 1
+                JUMP(6),             # 2
+                SET(3),              # 3
+                JUMP(6),             # 4
+                SET(1),              # 5
+                CALL_SYMC('fetch', 1, 0),
+                CALL_SYMC('double', 1, 0),
+                OUTPUT(),            # 8
+            ]
+
+            vm = vm_create({ 'fetch': fetch, 'double': double })
+
+            vm_run_all_threads(vm, program)
+
+            self.assertTrue( vm_status(vm)['calling'] == 3 and len(vm['awaiting']) == 3 )
+
+            asyncio.run( vm_run_async(vm, program) )
+
+            self.assertTrue( vm_is_finished(vm) and calls['max'] == 3 )
+            self.assertTrue( [ vm['threads'][i].output for i in range(3) ] == [ [60], [60], [20] ] )
+
+        def test_input_while_calling(self):
+
+            async def fetch(thread, n):
+                await asyncio.sleep(0.01)
+                return n * 10
+
+            program = [
+                SET(1),              # 0
+                CALL_SYMC('fetch', 1, 0),
+                INPUT(),             # 2
+                REGSUM(),            # 3
+                OUTPUT(),            # 4
+            ]
+
+            vm = vm_create({ 'fetch': fetch })
+
+            vm_thread_set_mailbox(vm, vm['threads'][0], 'box')
+
+            vm_run_all_threads(vm, program)
+
+            thread = vm['threads'][0]
+
+            vm_thread_set_input(thread, 1)
+            vm_deliver(vm, 'box', 2)
+            vm_thread_set_inputs(thread, [3])
+
+            self.assertTrue( thread.state == THREAD_WAIT_CALL and len(vm['awaiting']) == 1 )
+
+            asyncio.run( vm_run_async(vm, program) )
+
+            self.assertTrue( vm_is_finished(vm) and thread.output == [11] and list(thread.input) == [2, 3] )
+
+        def test_offload(self):
+
+            import threading
+
+            started = threading.Barrier(3, timeout=5)
+
+            def blocking(thread, n):
+                started.wait()            # the 3 calls run at the same time
+                return n + 1
+
+            program = [
+                FORK([2, 2]),        # 0
+                PASS(),              # 1
+                SET('n'),            # 2
+                LOADSYM(),           # 3
+                CALL_SYMC('blocking', 1, 0),
+                OUTPUT(),            # 5
+            ]
+
+            for engine in (ENGINE_SWITCH, ENGINE_TABLE):
+
+                vm = vm_create({ 'n': 1, 'blocking': vm_offload(blocking) })
+                vm_run_all_threads(vm, program, engine=engine)
+
+                self.assertTrue( vm_is_finished(vm) and not vm['offloaded'] )
+                self.assertTrue( [ t.output for t in vm['threads'].values() ] == [ [2], [2], [2] ] )
+
+                started.reset()
+
+            vm = vm_create({ 'n': 1, 'blocking': vm_offload(blocking) })
+            asyncio.run( vm_run_async(vm, program) )
+
+            self.assertTrue( [ t.output for t in vm['threads'].values() ] == [ [2], [2], [2] ] )
+
+        def test_batch(self):
+
+            batches = []
+
+            def lookup(calls):
+                batches.append(calls)
+                return [ n * 10 for (n, ) in calls ]
+
+            program = [
+                FORK([2, 2, 2, 2]),  # 0
+                PASS(),              # 1
+                SET('n'),            # 2
+                LOADSYM(),           # 3
+                SET('lookup'),       # 4
+                CALL_SYM(1, 0),      # 5
+                OUTPUT(),            # 6
+            ]
+
+            for engine in (ENGINE_SWITCH, ENGINE_TABLE, ENGINE_COMPILED):
+
+                del batches[:]
+
+                vm = vm_create({ 'n': 4, 'lookup': vm_batch(lookup) })
+                vm_run_all_threads(vm, program, engine=engine)
+
+                self.assertTrue( vm_is_finished(vm) )
+                self.assertTrue( [ t.output for t in vm['threads'].values() ] == [ [40] ] * 5 )
+                self.assertTrue( [ len(calls) for calls in batches ] == [1, 4] )
+
+            vm = vm_create({ 'n': 4, 'lookup': vm_batch(lookup) })
+
+            self.assertTrue( vm_run_for(vm, program, max_instructions=10000, quantum=100) )
+            self.assertTrue( [ t.output for t in vm['threads'].values() ] == [ [40] ] * 5 )
+
+        def test_batch_error(self):
+
+            failures = [1]
+
+            def lookup(calls):
+                if failures:
+                    failures.pop()
+                    raise ValueError("lookup")
+                return [ n * 10 for (n, ) in calls ]
+
+            program = [
+                FORK([2, 2]),        # 0
+                PASS(),              # 1
+                SET('n'),            # 2
+                LOADSYM(),           # 3
+                CALL_SYMC('lookup', 1, 0),
+                OUTPUT(),            # 5
+            ]
+
+            vm = vm_create({ 'n': 4, 'lookup': vm_batch(lookup) })
+
+            self.assertRaises(ValueError, vm_run_all_threads, vm, program)
+
+            # The calls stay queued: the threads are not stranded
+            self.assertTrue( vm_status(vm)['calling'] == 1 and vm['batches'] == { lookup: [ (0, (4, )) ] } )
+
+            self.assertTrue( vm_flush_batches(vm) == 1 )
+            self.assertTrue( vm_run_for(vm, program) )
+            self.assertTrue( [ t.output for t in vm['threads'].values() ] == [ [40] ] * 3 )
+
+        def test_run_for_waiting(self):
+
+            async def fetch(thread, n):
+                return n
+
+            program = [
+                SET(1),              # 0
+                CALL_SYMC('fetch', 1, 0),
+            ]
+
+            vm = vm_create({ 'fetch': fetch })
+
+            self.assertFalse( vm_run_for(vm, program) )
+            self.assertFalse( vm_run_for(vm, program, max_seconds=0) )
+            self.assertTrue( vm_status(vm)['calling'] == 1 )
+
+            asyncio.run( vm_run_async(vm, program) )
+
+            self.assertTrue( vm_is_finished(vm) and vm['threads'][0].regstack == [1] )
+
+        def test_pure(self):
+
+            calls = []
+
+            def square(thread, n, scale=1):
+                calls.append(n)
+                return n * n * scale
+
+            pure = vm_pure(square, maxsize=2)
+
+            program = [
+                FORK([1, 1, 1]),     # 0
+                SET(3),              # 1
+                CALL_NATIVE(pure, 1, 0),
+                SET(4),              # 3
+                SET('square'),       # 4
+                CALL_SYM(1, 0),      # 5
+                OUTPUT(),            # 6
+            ]
+
+            vm = vm_create({ 'square': pure })
+            vm_run_all_threads(vm, program)
+
+            self.assertTrue( [ t.output for t in vm['threads'].values() ] == [ [16] ] * 4 )
+            self.assertTrue( calls == [3, 4] )
+            self.assertTrue( pure.cache_info()['hits'] == 6 and pure.cache_info()['misses'] == 2 )
+
+            self.assertTrue( pure(None, 5, scale=2) == 50 and pure(None, 5, scale=2) == 50 )
+            self.assertTrue( pure.cache_info()['entries'] == 2 )
+
+            length = vm_pure(lambda thread, l: len(l))
+
+            self.assertTrue( length(None, [1, 2]) == 2 and length.cache_info()['entries'] == 0 )
+
+            pure.cache_clear()
+
+            self.assertTrue( pure.cache_info()['entries'] == 0 and pure.cache_info()['bytes'] == 0 )
+
+            small = vm_pure(square, maxsize=None, maxbytes=1)
+            small(None, 2)
+
+            self.assertTrue( small.cache_info()['entries'] == 0 )
+
+            # Positional and keyword arguments with the same values
+            echo = vm_pure(lambda thread, *args, **kwargs: (args, kwargs))
+
+            kwargs = echo(None, 5, scale=2)
+            args   = echo(None, (5, ), frozenset([ ('scale', 2) ]))
+
+            self.assertTrue( kwargs == ((5, ), { 'scale': 2 }) and args == (((5, ), frozenset([ ('scale', 2) ])), {}) )
+            self.assertTrue( echo(None, 5, scale=2) == kwargs and echo.cache_info()['hits'] == 1 )
+
+        def test_exception(self):
+
+            async def fail(thread):
+                raise ValueError()
+
+            vm = vm_create({ 'fail': fail })
+
+            with self.assertRaises(ValueError):
+                asyncio.run( vm_run_async(vm, [ CALL_SYMC('fail', 0, 0) ], engine=ENGINE_TABLE) )
+
     unittest.main()
@@ -1,5 +1,8 @@
 
+import operator
+
 from . import opcodes
+from .opcodes import *
 
 #----------------------------------------------------------------------#
 #                                                                      #
@@ -22,3 +25,36 @@ def PFORMAT(p):
         s += "%4s %-10s %s\n" % (n, OPCODE_NAME[r[0]], r[1] if r[1] is not None else '')
     return s
 
+
+#----------------------------------------------------------------------#
+#                                                                      #
+#----------------------------------------------------------------------#
+
+#
+# Python operators implementing the REG* opcodes
+#
+BINARY_OPERATORS = {
+    OP_CODE_REGSUM    : operator.add,
+    OP_CODE_REGSUB    : operator.sub,
+    OP_CODE_REGMUL    : operator.mul,
+    OP_CODE_REGDIV    : operator.truediv,
+    OP_CODE_REGMOD    : operator.mod,
+    OP_CODE_REGPOW    : operator.pow,
+    OP_CODE_REGLSHIFT : operator.lshift,
+    OP_CODE_REGRSHIFT : operator.rshift,
+    OP_CODE_REGBITAND : operator.and_,
+    OP_CODE_REGBITXOR : operator.xor,
+    OP_CODE_REGBITOR  : operator.or_,
+    OP_CODE_REGEQ     : operator.eq,
+    OP_CODE_REGNEQ    : operator.ne,
+    OP_CODE_REGLT     : operator.lt,
+    OP_CODE_REGLTE    : operator.le,
+    OP_CODE_REGGT     : operator.gt,
+    OP_CODE_REGGTE    : operator.ge,
+}
+
+UNARY_OPERATORS = {
+    OP_CODE_REGNEG    : operator.neg,
+    OP_CODE_REGBITONE : operator.invert,
+    OP_CODE_REGNOT    : operator.not_,
+}
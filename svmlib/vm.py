@@ -1,10 +1,18 @@
 
+import sys
 import time
 import copy
 import types
+import heapq
+import asyncio
+import collections
+import concurrent.futures
+
+from inspect import isawaitable
 
 from .opcodes import *
-from .utils import OPCODE_NAME
+from .utils import OPCODE_NAME, BINARY_OPERATORS
+from .context import vm_context_create, vm_context_fork, vm_context_own, _own_arguments
 
 #----------------------------------------------------------------------#
 #                                                                      #
@@ -47,26 +55,55 @@ class StopException(VMException):
 # Virtual Machine state                                                #
 #----------------------------------------------------------------------#
 
-def vm_create(initial_context=None, clock=None):
+def vm_create(initial_context=None, clock=None, base_context=None):
     
     #
     # Alloc
     #
-    vm_state = {
-        'threads' : {},
-        
-        'threadid': 0,                   # Last assigned thread id
-    }
+    vm_state = _vm_state_create()
     
     #
     # Create the first main thread
     #
-    main_thread = vm_thread_create(clock=clock, context=initial_context)
+    main_thread = vm_thread_create(clock=clock, context=initial_context, base_context=base_context)
     
     vm_add_thread(vm_state, main_thread)
 
     return vm_state
 
+def _vm_state_create():
+
+    # VM without threads
+    return {
+        'threads' : {},
+        
+        'threadid': 0,                   # Last assigned thread id
+
+        'sched'   : {                    # state -> { thread id -> thread }
+            THREAD_NEW       : {},
+            THREAD_RUNNING   : {},
+            THREAD_WAIT_IO   : {},
+            THREAD_SLEEP     : {},
+            THREAD_WAIT_CALL : {},
+            THREAD_TERMINATED: {},
+        },
+
+        'results' : {},                  # Reaped threads: id -> (result, output)
+        'reaped'  : 0,                   # Number of reaped threads
+
+        'mailboxes': {},                 # key -> { thread id -> thread }
+
+        'timers'  : [],                  # Heap of (deadline, thread id)
+
+        'clock'   : None,                # Clock of the threads
+
+        'priorities': False,             # Some thread has a priority
+
+        'awaiting': {},                  # Threads in WAIT_CALL: id -> awaitable
+        'offloaded': {},                 # Threads in WAIT_CALL: future -> id
+        'batches' : {},                  # Threads in WAIT_CALL: function -> [ (id, args) ]
+    }
+
 #----------------------------------------------------------------------#
 # Threads                                                              #
 #----------------------------------------------------------------------#
@@ -74,38 +111,236 @@ def vm_create(initial_context=None, clock=None):
 THREAD_NEW        = "NEW"
 THREAD_RUNNING    = "RUN"
 THREAD_WAIT_IO    = "I/O"
+THREAD_SLEEP      = "SLEEP"
+THREAD_WAIT_CALL  = "CALL"
 THREAD_TERMINATED = "TERMINATED"
 
-def vm_thread_create(pc=0, clock=0, context=None):
+class VMInput(object):
 
-    if context is not None:
-        context = copy.deepcopy(context)
-    else:
-        context = {}
+    #
+    # Thread input queue: O(1) append and consume.
+    #
+    # The items pending on FORK are frozen once in a tuple shared by all
+    # the children; each child consumes it with its own index and queues
+    # the new items in its own deque.
+    #
+    # The deque is created by the first item queued: most threads never
+    # receive input, or only wait for it.
+    #
+    __slots__ = ('_shared', '_pos', '_queue')
+
+    def __init__(self, data=(), shared=()):
+        self._shared = shared
+        self._pos    = 0
+        self._queue  = collections.deque(data) if data else None
+
+    def append(self, item):
+        if self._queue is None:
+            self._queue = collections.deque()
+        self._queue.append(item)
+
+    def extend(self, items):
+        if self._queue is None:
+            self._queue = collections.deque()
+        self._queue.extend(items)
+
+    def popleft(self):
+        pos = self._pos
+        if pos < len(self._shared):
+            self._pos = pos + 1
+            return self._shared[pos]
+        if self._shared:
+            self._shared = ()
+            self._pos    = 0
+        if not self._queue:
+            raise IndexError("pop from an empty input")
+        return self._queue.popleft()
+
+    def __len__(self):
+        return len(self._shared) - self._pos + (len(self._queue) if self._queue else 0)
+
+    def __bool__(self):
+        return self._pos < len(self._shared) or bool(self._queue)
+
+    def __iter__(self):
+        for i in range(self._pos, len(self._shared)):
+            yield self._shared[i]
+        if self._queue:
+            for item in self._queue:
+                yield item
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+class VMThread(object):
 
-    thread = {
-        'id'             : None,             # internal ID
+    #
+    # Thread record. The fields are attributes, thread['field'] is still
+    # supported (external functions, '%(id)s' % thread). Keys that are not
+    # fields are stored in a dictionary created on first use.
+    #
+    # Setting the state moves the thread in the scheduler of its VM.
+    #
+    __slots__ = (
+        'id',                                # internal ID
         #
         # Execution state
-        #        
-        'state'          : THREAD_NEW,       # Thread state
-        'clock'          : clock,            # Current execution clock
-        'pc'             : pc,               # Program counter
-        'regstack'       : [],               # Registers
         #
-        # 
+        '_state',                            # Thread state
+        '_clock',                            # Clock out of a VM
+        'pc',                                # Program counter
+        'regstack',                          # Registers
+        #
         #
-        'context'        : context,          # Global vars 
+        #
+        'context',                           # Global vars
         #
         # I/O
         #
-        'output'         : [],               # Output data
-        
-        'input'          : [],               # Input to consume 
-        'input_timeout'  : None,
-    }
+        'output',                            # Output data
+        'input',                             # Input to consume
+        'input_timeout',
+        #
+        #
+        #
+        '_extra',                            # Other keys
+        '_vm',                               # VM running the thread
+        '_mailbox',                          # Mailbox key
+        '_wakeup',                           # Clock ending SLEEP
+        '_timer',                            # Deadline in the timer heap
+        '_priority',                         # Order in the turn (higher first)
+    )
+
+    def __init__(self, pc=0, clock=0, context=None):
+        self._vm           = None
+        self._mailbox      = None
+        self._wakeup       = None
+        self._timer        = None
+        self._priority     = 0
+        self.id            = None
+        self._state        = THREAD_NEW
+        self._clock        = clock
+        self.pc            = pc
+        self.regstack      = []
+        self.context       = context
+        self.output        = []
+        self.input         = VMInput()
+        self.input_timeout = None
+        self._extra        = None
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        if self._vm is not None and state != self._state:
+            _vm_sched_update(self._vm, self, self._state, state)
+        self._state = state
+
+    #
+    # The threads of a VM read the clock of the VM: setting the clock of
+    # a thread sets the clock of its VM
+    #
+    @property
+    def clock(self):
+        vm = self._vm
+        return vm['clock'] if vm is not None else self._clock
+
+    @clock.setter
+    def clock(self, clock):
+        if self._vm is not None:
+            self._vm['clock'] = clock
+        else:
+            self._clock = clock
+
+    #
+    # Copies are not in a VM
+    #
+    def __getstate__(self):
+        state = dict([ (k, getattr(self, k)) for k in VMThread.__slots__ if k != '_vm' ])
+        state['_clock'] = self.clock
+        return state
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+        self._vm = None
+
+    #
+    # dict interface
+    #
+    def __getitem__(self, key):
+        if key in _THREAD_FIELDS:
+            return getattr(self, key)
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in _THREAD_FIELDS:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if self._extra is None or key not in self._extra:
+            raise KeyError(key)
+        del self._extra[key]
+
+    def __contains__(self, key):
+        return key in _THREAD_FIELDS or (self._extra is not None and key in self._extra)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def keys(self):
+        keys = list(_THREAD_FIELDS_ORDER)
+        if self._extra is not None:
+            keys.extend(self._extra)
+        return keys
+
+    def values(self):
+        return [ self[k] for k in self.keys() ]
 
-    return thread
+    def items(self):
+        return [ (k, self[k]) for k in self.keys() ]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+_THREAD_FIELDS_ORDER = ('id', 'state', 'clock', 'pc', 'regstack', 'context', 'output', 'input', 'input_timeout')
+_THREAD_FIELDS       = frozenset(_THREAD_FIELDS_ORDER)
+
+def vm_thread_create(pc=0, clock=0, context=None, base_context=None):
+
+    #
+    # base_context is shared, never copied (see context.py)
+    #
+    context = vm_context_create(context, base_context)
+
+    return VMThread(pc, clock, context)
 
 #----------------------------------------------------------------------#
 #                                                                      #
@@ -119,32 +354,210 @@ def vm_add_thread(vm_run_state, thread):
     tid = vm_run_state['threadid']
     vm_run_state['threadid'] += 1
 
-    thread['id'] = tid
+    thread.id = tid
 
+    _vm_attach_thread(vm_run_state, thread)
+
+def _vm_attach_thread(vm_run_state, thread):
 
-    
     #
-    # Add to the VM
+    # Add to the VM a thread with an id: scheduler, timers, mailbox
     #
+    tid = thread.id
+
     vm_run_state['threads'][tid] = thread
 
+    # A VM without clock takes the clock of the thread
+    if vm_run_state['clock'] is None:
+        vm_run_state['clock'] = thread._clock
+
+    thread._vm = vm_run_state
+
+    vm_run_state['sched'].setdefault(thread.state, {})[tid] = thread
+
+    # Timer entries of another VM
+    thread._timer = None
+    _vm_arm_timer(vm_run_state, thread, _thread_deadline(thread, thread.state))
+
+    key = thread._mailbox
+    if key is not None:
+        thread._mailbox = None
+        vm_thread_set_mailbox(vm_run_state, thread, key)
+
+    if thread._priority:
+        vm_run_state['priorities'] = True
+
+def _vm_detach_thread(vm_run_state, thread):
+
+    #
+    # Remove a thread from the VM (its timer entries become stale)
+    #
+    vm_thread_set_mailbox(vm_run_state, thread, None)
+
+    del vm_run_state['sched'][thread.state][thread.id]
+    del vm_run_state['threads'][thread.id]
+
+    thread._clock = vm_run_state['clock']
+    thread._vm    = None
+
+def _thread_clock(thread, pc):
+
+    # SLEEP and WAIT_UNTIL need the clock of the VM (vm_create(clock=...))
+    if thread.clock is None:
+        raise VMInvalidOperation("Thread %s has no clock: SLEEP/WAIT_UNTIL need vm_create(clock=...) (pc:%s)" % (thread.id, pc))
+
+    return thread.clock
+
+def _thread_deadline(thread, state):
+
+    #
+    # Clock waking up a thread in the given state (None: no timer)
+    #
+    if state == THREAD_WAIT_IO:
+        return thread.input_timeout
+    if state == THREAD_SLEEP:
+        return thread._wakeup
+    return None
+
+# Stale timer entries tolerated before compacting the heap (see _vm_arm_timer)
+TIMERS_COMPACT_MIN = 64
+
+def _vm_arm_timer(vm_run_state, thread, deadline):
+
+    #
+    # A thread has one live entry in the timer heap: waiting again with
+    # the same deadline reuses it. Entries left by a changed deadline are
+    # stale; the heap is compacted when they outnumber the threads.
+    #
+    if deadline is None or deadline == thread._timer:
+        return
+
+    timers = vm_run_state['timers']
+
+    thread._timer = deadline
+    heapq.heappush(timers, (deadline, thread.id))
+
+    if len(timers) > 2 * len(vm_run_state['threads']) + TIMERS_COMPACT_MIN:
+        threads = vm_run_state['threads']
+        timers[:] = set([ (d, tid) for (d, tid) in timers if tid in threads and threads[tid]._timer == d ])
+        heapq.heapify(timers)
+
+def _vm_sched_update(vm_run_state, thread, old_state, new_state):
+
+    sched = vm_run_state['sched']
+
+    del sched[old_state][thread.id]
+
+    sched.setdefault(new_state, {})[thread.id] = thread
+
+    if new_state == THREAD_TERMINATED and thread._mailbox is not None:
+        vm_thread_set_mailbox(vm_run_state, thread, None)
+
+    _vm_arm_timer(vm_run_state, thread, _thread_deadline(thread, new_state))
+
+def vm_thread_fork(vm_run_state, thread, regstack, addresses):
+
+    #
+    # The children share the variables of the thread: see context.py
+    #
+    contexts = vm_context_fork(thread.context, len(addresses))
+
+    # The pending input is frozen once and shared: see VMInput
+    t2_input = tuple(thread.input) if thread.input is not None else None
+
+    for jump, context in zip(addresses, contexts):
+
+        thread2 = VMThread(jump, thread.clock, context)
+
+        thread2.state         = THREAD_RUNNING
+        thread2.regstack      = copy.deepcopy(regstack)
+
+        thread2.input = VMInput(shared=t2_input) if t2_input is not None else None
+
+        thread2.input_timeout = thread.input_timeout
+        thread2._priority     = thread._priority
+
+        vm_add_thread( vm_run_state, thread2 )
+
 #----------------------------------------------------------------------#
 #                                                                      #
 #----------------------------------------------------------------------#
 
 def vm_is_finished( vm_run_state ):
 
-    n = len(vm_run_state['threads'])
+    sched = vm_run_state['sched']
 
-    count = 0
-    for t in vm_run_state['threads'].values():
-        if t['state'] == THREAD_TERMINATED:
-            count +=1
-    
-    if count == n:
-        return True
-    else:
-        return False
+    return len(sched[THREAD_TERMINATED]) == len(vm_run_state['threads'])
+
+def vm_status( vm_run_state ):
+
+    #
+    # Thread counters, read from the scheduler: O(1)
+    #
+    sched = vm_run_state['sched']
+
+    states = dict([ (state, len(threads)) for state, threads in sched.items() ])
+
+    n          = len(vm_run_state['threads'])
+    terminated = states[THREAD_TERMINATED]
+
+    return {
+        'threads'   : n,
+        'live'      : n - terminated,
+        'running'   : states[THREAD_RUNNING] + states[THREAD_NEW],
+        'waiting'   : states[THREAD_WAIT_IO],
+        'sleeping'  : states[THREAD_SLEEP],
+        'calling'   : states[THREAD_WAIT_CALL],
+        'terminated': terminated,
+        'reaped'    : vm_run_state['reaped'],
+        'states'    : states,
+    }
+
+#----------------------------------------------------------------------#
+# REAPING                                                              #
+#----------------------------------------------------------------------#
+
+def vm_thread_result( thread ):
+
+    regstack = thread.regstack
+
+    return regstack[-1] if regstack else None
+
+def vm_reap_threads( vm_run_state, callback=None ):
+
+    #
+    # Removes the terminated threads from the VM. The result (top of the
+    # registers) and the output of every thread are passed to
+    # callback(thread_id, result, output) or, without a callback, saved
+    # in vm_run_state['results'].
+    #
+    # Thread ids are never reused: vm_run_state['threadid'] keeps counting.
+    #
+    sched      = vm_run_state['sched']
+    threads    = vm_run_state['threads']
+    terminated = sched[THREAD_TERMINATED]
+
+    results = vm_run_state['results']
+
+    for tid, thread in terminated.items():
+
+        del threads[tid]
+
+        thread._clock = vm_run_state['clock']
+        thread._vm    = None
+
+        if callback is not None:
+            callback(tid, vm_thread_result(thread), thread.output)
+        else:
+            results[tid] = (vm_thread_result(thread), thread.output)
+
+    n = len(terminated)
+
+    sched[THREAD_TERMINATED] = {}
+
+    vm_run_state['reaped'] += n
+
+    return n
 
 #----------------------------------------------------------------------#
 # CLOCK                                                                #
@@ -152,10 +565,75 @@ def vm_is_finished( vm_run_state ):
 
 def vm_set_clock( vm_run_state, clock=None ):
 
+    #
+    # The threads read the clock of the VM: only the expired timers are
+    # visited
+    #
     clock = clock if clock is not None else time.time()
 
-    for t in vm_run_state['threads'].values():
-        t['clock'] = clock
+    vm_run_state['clock'] = clock
+
+    vm_expire_timers( vm_run_state, clock )
+
+def vm_expire_timers( vm_run_state, clock ):
+
+    #
+    # Wakes up the sleeping threads and the threads waiting for input
+    # whose input_timeout expired: INPUT terminates them when they run.
+    # Only the expired entries of the timer heap are visited.
+    #
+    # Entries are not removed when a thread stops waiting: an entry is
+    # stale if the thread is gone or has a different deadline, and is
+    # skipped if the thread is no longer waiting.
+    #
+    timers  = vm_run_state['timers']
+    threads = vm_run_state['threads']
+
+    expired = 0
+
+    while timers and timers[0][0] <= clock:
+
+        deadline, tid = heapq.heappop(timers)
+
+        thread = threads.get(tid)
+
+        if thread is None or thread._timer != deadline:
+            continue
+
+        thread._timer = None
+
+        if _thread_deadline(thread, thread.state) != deadline:
+            continue
+
+        thread._wakeup = None
+        thread.state   = THREAD_RUNNING
+        expired += 1
+
+    return expired
+
+def vm_next_deadline( vm_run_state ):
+
+    #
+    # First clock waking up a thread (None: no timers). Drops the stale
+    # entries on top of the heap.
+    #
+    timers  = vm_run_state['timers']
+    threads = vm_run_state['threads']
+
+    while timers:
+
+        deadline, tid = timers[0]
+
+        thread = threads.get(tid)
+
+        if thread is not None and thread._timer == deadline:
+            if _thread_deadline(thread, thread.state) == deadline:
+                return deadline
+            thread._timer = None
+
+        heapq.heappop(timers)
+
+    return None
 
 #----------------------------------------------------------------------#
 # IO                                                                   #
@@ -163,55 +641,540 @@ def vm_set_clock( vm_run_state, clock=None ):
             
 def vm_thread_set_input( thread, input_data):
 
-    if thread['state'] == THREAD_TERMINATED:
-        raise Exception("Thread %s not valid for input" % (thread['id']))
+    if thread.state == THREAD_TERMINATED:
+        raise Exception("Thread %s not valid for input" % (thread.id))
         
-    thread['input'].append( input_data )
+    thread.input.append( input_data )
     
-    thread['state'] = THREAD_RUNNING
+    # A sleeping thread or a thread waiting on a call reads the input
+    # when it resumes
+    if thread.state != THREAD_SLEEP and thread.state != THREAD_WAIT_CALL:
+        thread.state = THREAD_RUNNING
+
+def vm_thread_set_inputs( thread, inputs):
+
+    if thread.state == THREAD_TERMINATED:
+        raise Exception("Thread %s not valid for input" % (thread.id))
+
+    n = len(thread.input)
+
+    thread.input.extend( inputs )
+
+    if len(thread.input) > n and thread.state != THREAD_SLEEP and thread.state != THREAD_WAIT_CALL:
+        thread.state = THREAD_RUNNING
+
+#----------------------------------------------------------------------#
+# MAILBOXES                                                            #
+#----------------------------------------------------------------------#
+
+#
+# A thread registered on a mailbox key receives the input delivered to
+# the key. Threads are indexed by key, so vm_deliver() only touches the
+# threads of the key. Terminated threads leave their mailbox; forked
+# threads do not inherit it.
+#
+
+def vm_thread_set_mailbox( vm_run_state, thread, key ):
+
+    mailboxes = vm_run_state['mailboxes']
+
+    old_key = thread._mailbox
+
+    if old_key is not None:
+        mailbox = mailboxes[old_key]
+        del mailbox[thread.id]
+        if not mailbox:
+            del mailboxes[old_key]
+
+    thread._mailbox = key
+
+    if key is not None:
+        mailboxes.setdefault(key, {})[thread.id] = thread
+
+def vm_deliver( vm_run_state, key, input_data ):
+
+    #
+    # Returns the number of threads that received the data
+    #
+    threads = list(vm_run_state['mailboxes'].get(key, {}).values())
+
+    for thread in threads:
+        vm_thread_set_input( thread, input_data )
+
+    return len(threads)
+
+#----------------------------------------------------------------------#
+# EXTERNAL CALLS                                                       #
+#----------------------------------------------------------------------#
+
+#
+# An external function can return an awaitable: the engines park the
+# calling thread in WAIT_CALL (pc after the call) and register the
+# awaitable in vm_run_state['awaiting']. The runner owning the event
+# loop (see aio.py) awaits it and calls vm_thread_resume() with the
+# result, pushed on the registers as the return value of the call.
+#
+
+def vm_thread_await( vm_run_state, thread, awaitable ):
+
+    if isinstance(awaitable, VMOffloadedCall):
+        vm_run_state['offloaded'][awaitable.future] = thread.id
+    elif isinstance(awaitable, VMBatchedCall):
+        vm_run_state['batches'].setdefault(awaitable.fun, []).append( (thread.id, awaitable.args) )
+    else:
+        vm_run_state['awaiting'][thread.id] = awaitable
+
+def vm_thread_resume( thread, result ):
+
+    if thread.state != THREAD_WAIT_CALL:
+        raise Exception("Thread %s not waiting for a call" % (thread.id))
+
+    thread.regstack.append( result )
+
+    thread.state = THREAD_RUNNING
+
+#
+# Offloaded calls.
+#
+# A function wrapped by vm_offload() runs in a pool of threads (blocking
+# calls releasing the GIL: C libraries, files, sockets). The wrapper
+# returns at once a VMOffloadedCall: the calling thread waits in WAIT_CALL
+# and the other threads keep running. vm_run_all_threads() resumes the
+# thread when the call completes and, when no thread can run, waits for
+# the first offloaded call to complete.
+#
+
+VM_OFFLOAD_WORKERS = None                # Default pool: concurrent.futures default
+
+_offload_executor = None
+
+def _default_executor():
+
+    global _offload_executor
+
+    if _offload_executor is None:
+        _offload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=VM_OFFLOAD_WORKERS)
+
+    return _offload_executor
+
+class VMOffloadedCall(object):
+
+    __slots__ = ('future', )
+
+    def __init__(self, future):
+        self.future = future
+
+    def __await__(self):
+        return asyncio.wrap_future(self.future).__await__()
+
+def vm_offload( fun, executor=None ):
+
+    def offloaded(thread, *args, **kwargs):
+        pool = executor if executor is not None else _default_executor()
+        return VMOffloadedCall( pool.submit(fun, thread, *args, **kwargs) )
+
+    offloaded.__name__ = getattr(fun, '__name__', 'offloaded')
+
+    return offloaded
+
+#
+# Batched calls.
+#
+# A function wrapped by vm_batch() is called once per turn with the
+# arguments of all the threads that called it in the turn:
+#
+#     fun([ args, ... ]) -> [ result, ... ]
+#
+# Every call returns a VMBatchedCall and the thread waits in WAIT_CALL.
+# At the end of the turn vm_flush_batches() calls the function and
+# resumes the threads with their results.
+#
+
+class VMBatchedCall(object):
+
+    __slots__ = ('fun', 'args')
+
+    def __init__(self, fun, args):
+        self.fun  = fun
+        self.args = args
+
+    def __await__(self):
+        raise VMException("Batched call awaited outside of a VM")
+
+def vm_batch( fun ):
+
+    def batched(thread, *args, **kwargs):
+        if kwargs:
+            raise VMInvalidOperation("Batched function %s called with named arguments" % (fun, ))
+        return VMBatchedCall(fun, args)
+
+    batched.__name__ = getattr(fun, '__name__', 'batched')
+
+    return batched
+
+def vm_flush_batches( vm_run_state ):
+
+    #
+    # Calls every batched function once. Returns the number of threads
+    # resumed.
+    #
+    # A batch is removed only when its function succeeds: on error the
+    # calls stay queued and the threads stay in WAIT_CALL.
+    #
+    batches = vm_run_state['batches']
+    threads = vm_run_state['threads']
+
+    n = 0
+
+    while batches:
+
+        fun, calls = next(iter(batches.items()))
+
+        results = fun([ args for tid, args in calls ])
+
+        if len(results) != len(calls):
+            raise VMException("Batched function %s returned %s results for %s calls" % (fun, len(results), len(calls)))
+
+        del batches[fun]
+
+        for (tid, args), result in zip(calls, results):
+            vm_thread_resume( threads[tid], result )
+
+        n += len(calls)
+
+    return n
+
+#
+# Read only functions.
+#
+# A function wrapped by vm_readonly() does not change its arguments nor
+# the context of the thread in place: it is called with the values the
+# thread shares with the other threads, without copying them first.
+#
+
+class VMReadOnlyFunction(object):
+
+    __slots__ = ('fun', '__name__')
+
+    vm_readonly = True
+
+    def __init__(self, fun):
+        self.fun      = fun
+        self.__name__ = getattr(fun, '__name__', 'readonly')
+
+    def __call__(self, thread, *args, **kwargs):
+        return self.fun(thread, *args, **kwargs)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+def vm_readonly( fun ):
+    return VMReadOnlyFunction(fun)
+
+#
+# Pure functions.
+#
+# The results of a function wrapped by vm_pure() depend only on its
+# arguments (not on the calling thread): they are kept in a LRU cache
+# bounded by number of entries and by an estimate of their size in
+# bytes. Calls with arguments that are not hashable are not cached.
+# Pure functions are read only (see vm_readonly).
+#
+
+VM_PURE_MAXSIZE  = 1024
+VM_PURE_MAXBYTES = None
+
+# Separates the positional and the keyword arguments in the cache keys
+_KWD_MARK = object()
+
+class VMPureFunction(object):
+
+    __slots__ = ('fun', 'maxsize', 'maxbytes', 'cache', 'bytes', 'hits', 'misses', '__name__')
+
+    vm_readonly = True
+
+    def __init__(self, fun, maxsize=VM_PURE_MAXSIZE, maxbytes=VM_PURE_MAXBYTES):
+        self.fun      = fun
+        self.maxsize  = maxsize
+        self.maxbytes = maxbytes
+        self.cache    = collections.OrderedDict()   # key -> (result, size)
+        self.bytes    = 0
+        self.hits     = 0
+        self.misses   = 0
+        self.__name__ = getattr(fun, '__name__', 'pure')
+
+    def __call__(self, thread, *args, **kwargs):
+
+        key = args + (_KWD_MARK, ) + tuple(sorted(kwargs.items())) if kwargs else args
+
+        cache = self.cache
+
+        try:
+            result, size = cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Arguments not hashable
+            return self.fun(thread, *args, **kwargs)
+        else:
+            cache.move_to_end(key)
+            self.hits += 1
+            return result
+
+        self.misses += 1
+
+        result = self.fun(thread, *args, **kwargs)
+
+        if isawaitable(result):
+            return result
+
+        size = sys.getsizeof(key) + sys.getsizeof(result)
+
+        cache[key]  = (result, size)
+        self.bytes += size
+
+        while cache and ((self.maxsize is not None and len(cache) > self.maxsize) or
+                         (self.maxbytes is not None and self.bytes > self.maxbytes)):
+            k, (r, s) = cache.popitem(last=False)
+            self.bytes -= s
+
+        return result
+
+    #
+    # Contexts are copied: the copies share the cache
+    #
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def cache_info(self):
+        return {
+            'hits'   : self.hits,
+            'misses' : self.misses,
+            'entries': len(self.cache),
+            'bytes'  : self.bytes,
+        }
+
+    def cache_clear(self):
+        self.cache.clear()
+        self.bytes = 0
+
+def vm_pure( fun, maxsize=VM_PURE_MAXSIZE, maxbytes=VM_PURE_MAXBYTES ):
+    return VMPureFunction(fun, maxsize, maxbytes)
+
+def vm_resume_offloaded( vm_run_state, wait=False ):
+
+    #
+    # Resumes the threads whose offloaded call completed. With wait=True
+    # blocks until a call completes. Returns the number of threads resumed.
+    #
+    offloaded = vm_run_state['offloaded']
+
+    if not offloaded:
+        return 0
+
+    done, pending = concurrent.futures.wait(
+        list(offloaded),
+        timeout     = None if wait else 0,
+        return_when = concurrent.futures.FIRST_COMPLETED,
+    )
+
+    threads = vm_run_state['threads']
+
+    for future in done:
+        tid = offloaded.pop(future)
+        vm_thread_resume( threads[tid], future.result() )
+
+    return len(done)
 
 #----------------------------------------------------------------------#
 # THREAD EXECUTIONS                                                    #
 #----------------------------------------------------------------------#
 
-def vm_run_all_threads(vm_run_state, program):
+ENGINE_SWITCH = "switch"
 
-    for t in  vm_run_state['threads'].values():
+def vm_thread_set_priority( vm_run_state, thread, priority ):
 
-        if t['state'] == THREAD_TERMINATED: 
-            continue
+    #
+    # Threads with higher priority run first in every turn. Forked
+    # threads inherit the priority.
+    #
+    thread._priority = priority
+
+    if priority:
+        vm_run_state['priorities'] = True
 
-        if t['state'] == THREAD_WAIT_IO:
-            if t['input']:
-                t['state'] = THREAD_RUNNING
+def _thread_priority(thread):
+    return thread._priority
 
-        if t['state'] == THREAD_NEW:
-            t['state'] = THREAD_RUNNING
+def vm_run_all_threads(vm_run_state, program, engine=ENGINE_SWITCH, quantum=None, wait_calls=True):
 
-    threads_to_execute = [ t for t in  vm_run_state['threads'].values() if t['state'] == THREAD_RUNNING ]
+    run_thread = VM_ENGINES[engine]
+    program    = _vm_link_program(program, engine)
+
+    #
+    # The scheduler keeps the threads by state: a turn only looks at the
+    # running threads. Threads waiting for I/O are woken up by
+    # vm_thread_set_input().
+    #
+    sched   = vm_run_state['sched']
+    running = sched[THREAD_RUNNING]
 
-    while threads_to_execute:
+    for t in list(sched[THREAD_NEW].values()):
+        t.state = THREAD_RUNNING
+
+    #
+    # With a quantum every thread executes 'quantum' instructions per turn
+    # (the compiled engine rounds it to its blocks) and is then preempted
+    # (it stays RUNNING): the threads run in round-robin and a busy thread
+    # does not starve the others.
+    #
+    run_loop_count = quantum - 1 if quantum is not None else None
+
+    #
+    # Threads waiting for a batched or offloaded call are resumed between
+    # the turns. With wait_calls the run returns only when no offloaded
+    # call is pending.
+    #
+    offloaded = vm_run_state['offloaded']
+    batches   = vm_run_state['batches']
+
+    while True:
+
+        # Calls to batched functions collected in the last turn
+        if batches:
+            vm_flush_batches(vm_run_state)
+
+        if offloaded:
+            vm_resume_offloaded(vm_run_state, wait=wait_calls and not running)
+
+        if not running:
+            break
 
         DEBUG("TURN")
         
-        for thread in threads_to_execute:
-            vm_run_thread(vm_run_state, program, thread)
-            DEBUG_SLEEP()
+        # Threads forked in this turn run in the next one
+        threads = list(running.values())
+
+        if vm_run_state['priorities']:
+            threads.sort(key=_thread_priority, reverse=True)
 
-        # Execute only running threads
-        threads_to_execute = [ t for t in vm_run_state['threads'].values() if t['state'] == THREAD_RUNNING ]
+        for thread in threads:
+            run_thread(vm_run_state, program, thread, run_loop_count)
+            DEBUG_SLEEP()
 
     return 
 
 
+VM_RUN_FOR_QUANTUM = 1000
+
+def vm_run_for(vm_run_state, program, engine=ENGINE_SWITCH, max_seconds=None, max_instructions=None, quantum=VM_RUN_FOR_QUANTUM):
+
+    #
+    # Budgeted execution: runs the threads in slices of 'quantum'
+    # instructions and returns when no thread can run or at the first
+    # slice boundary past the budget. The budget is checked between two
+    # slices, so a run can exceed max_seconds by one slice. The engines
+    # never exceed max_instructions, except ENGINE_COMPILED: it runs
+    # whole basic blocks, so a slice ends at the end of the block that
+    # exceeds it (the budget is rounded up to block boundaries).
+    #
+    # The running threads are a round-robin queue: a preempted thread
+    # goes to the end, so the next call resumes with the threads that
+    # did not run.
+    #
+    # Returns True if no thread can run and no thread waits on a call
+    # (offloaded, batched or awaited: the run is complete).
+    #
+    run_thread = VM_ENGINES[engine]
+    program    = _vm_link_program(program, engine)
+
+    sched   = vm_run_state['sched']
+    running = sched[THREAD_RUNNING]
+
+    for t in list(sched[THREAD_NEW].values()):
+        t.state = THREAD_RUNNING
+
+    deadline = time.perf_counter() + max_seconds if max_seconds is not None else None
+
+    offloaded = vm_run_state['offloaded']
+    batches   = vm_run_state['batches']
+
+    while running or offloaded or batches:
+
+        # Batches grow until no thread can run
+        if batches and not running:
+            vm_flush_batches(vm_run_state)
+            continue
+
+        if offloaded:
+            vm_resume_offloaded(vm_run_state)
+            if not running:
+                return False
+
+        if max_instructions is not None:
+            if max_instructions <= 0:
+                return False
+            n = min(quantum, max_instructions)
+            max_instructions -= n
+        else:
+            n = quantum
+
+        tid, thread = next(iter(running.items()))
+
+        run_thread(vm_run_state, program, thread, n - 1)
+
+        if thread.state == THREAD_RUNNING and tid in running:
+            del running[tid]
+            running[tid] = thread
+
+        if deadline is not None and time.perf_counter() >= deadline:
+            return not running and not sched[THREAD_WAIT_CALL]
+
+    return not sched[THREAD_WAIT_CALL]
+
+def vm_run_discrete(vm_run_state, program, engine=ENGINE_SWITCH, until=None, quantum=None):
+
+    #
+    # Discrete-event execution: runs the threads and, when no thread can
+    # run, moves the clock straight to the next timer (SLEEP, WAIT_UNTIL,
+    # input_timeout) instead of waiting for it. Stops when there are no
+    # timers left or the next one is after 'until'.
+    #
+    # Returns the clock of the last timer reached (None: no timer).
+    #
+    clock   = None
+    program = _vm_link_program(program, engine)
+
+    while True:
+
+        vm_run_all_threads(vm_run_state, program, engine, quantum)
+
+        deadline = vm_next_deadline(vm_run_state)
+
+        if deadline is None or (until is not None and deadline > until):
+            break
+
+        clock = deadline
+
+        vm_set_clock(vm_run_state, clock)
+
+    return clock
+
 def vm_run_thread(vm_run_state, program, thread, run_loop_count=None):
 
-    DEBUG("\tTHREAD: id=%(id)s  state=%(state)s  pc=%(pc)s  clock=%(clock)s  regstack=%(regstack)s  input=%(input)s" % thread)
+    if __debug__:
+        DEBUG("\tTHREAD: id=%(id)s  state=%(state)s  pc=%(pc)s  clock=%(clock)s  regstack=%(regstack)s  input=%(input)s" % thread)
 
-    thread_context  = thread['context']
-    thread_state    = thread['state']
-    pc              = thread['pc']
-    thread_regstack = thread['regstack']
+    thread_context  = thread.context
+    thread_state    = thread.state
+    pc              = thread.pc
+    thread_regstack = thread.regstack
     
     loop_count = 0
     
@@ -230,7 +1193,8 @@ def vm_run_thread(vm_run_state, program, thread, run_loop_count=None):
                 
             opcode, params = program[pc]
 
-            DEBUG( "\t", "\t pc=%s/%s -> opcode=%s params=%s regstack=%s" % (pc, len(program), OPCODE_NAME[opcode], params, thread_regstack) )
+            if __debug__:
+                DEBUG( "\t", "\t pc=%s/%s -> opcode=%s params=%s regstack=%s" % (pc, len(program), OPCODE_NAME.get(opcode, opcode), params, thread_regstack) )
 
             pc += 1
 
@@ -244,6 +1208,7 @@ def vm_run_thread(vm_run_state, program, thread, run_loop_count=None):
 
                 thread_regstack = [r]
                 thread_state = THREAD_TERMINATED
+                break
 
             elif opcode == OP_CODE_REGFLUSH:
 
@@ -298,6 +1263,8 @@ def vm_run_thread(vm_run_state, program, thread, run_loop_count=None):
                 k = thread_regstack.pop()
                 d = thread_regstack.pop()
                 
+                d = vm_context_own(thread_context, d, thread_regstack)
+
                 d[k] = v
                 
                 thread_regstack.append( d )
@@ -441,6 +1408,14 @@ def vm_run_thread(vm_run_state, program, thread, run_loop_count=None):
                 
                 thread_regstack.append( v1 >= v2 )
 
+            elif opcode == OP_CODE_REGOPC:
+
+                op, v2 = params
+
+                v1 = thread_regstack.pop()
+
+                thread_regstack.append( BINARY_OPERATORS[op](v1, v2) )
+
             elif opcode == OP_CODE_LOADSYM:
 
                 symbol = thread_regstack.pop()
@@ -449,6 +1424,14 @@ def vm_run_thread(vm_run_state, program, thread, run_loop_count=None):
                 
                 thread_regstack.append( v )
 
+            elif opcode == OP_CODE_LOADSYMC:
+
+                symbol = params
+
+                v = thread_context[ symbol ]
+
+                thread_regstack.append( v )
+
             elif opcode == OP_CODE_LOADSYMLV:
 
                 symbol = thread_regstack.pop()
@@ -488,9 +1471,9 @@ def vm_run_thread(vm_run_state, program, thread, run_loop_count=None):
                 sym2 = v2
                 
                 if context1 is None:
-                    context1 = thread_context
-
-                v1 = context1[sym1]
+                    v1 = vm_context_own(thread_context, thread_context[sym1], thread_regstack)
+                else:
+                    v1 = context1[sym1]
                 
                 val = ( v1, sym2 )
                     
@@ -503,13 +1486,13 @@ def vm_run_thread(vm_run_state, program, thread, run_loop_count=None):
 
                 symbol, value = params
                 
-                thread_context.get(symbol, thread_context.setdefault(symbol, [])).append( value )
+                vm_context_own(thread_context, thread_context.get(symbol, thread_context.setdefault(symbol, [])), thread_regstack).append( value )
 
             elif opcode == OP_CODE_CONTEXT_LPOP:
 
                 symbol = params
                 
-                thread_context[symbol].pop()
+                vm_context_own(thread_context, thread_context[symbol], thread_regstack).pop()
 
             #
             # JUMPS
@@ -549,35 +1532,13 @@ def vm_run_thread(vm_run_state, program, thread, run_loop_count=None):
 
             elif opcode == OP_CODE_FORK:
 
-                thread_id = thread['id']
+                thread_id = thread.id
                 
                 #thread['fork_chain'].append(thread_id)
 
                 addresses = params
 
-                for jump in addresses:
-
-                    thread2 = vm_thread_create(jump)
-
-                    #thread2['parent_id'     ] = thread_id
-                    #thread2['fork_chain'    ] = list(thread['fork_chain']) # duplicate
-
-                    thread2['state'         ] = THREAD_RUNNING
-                    thread2['pc'            ] = jump
-                    
-                    thread2['clock'         ] = thread['clock']
-                    thread2['regstack'      ] = copy.deepcopy(thread_regstack)
-                    
-                    thread2['context'       ] = copy.deepcopy(thread['context'])
-                    
-                    t2_input = None
-                    if thread['input'] is not None:
-                        t2_input = list( thread['input'] )
-                    thread2['input'] = t2_input
-
-                    thread2['input_timeout' ] = thread['input_timeout']
-                                        
-                    vm_add_thread( vm_run_state, thread2 )
+                vm_thread_fork( vm_run_state, thread, thread_regstack, addresses )
 
             #
             # CALL
@@ -594,12 +1555,20 @@ def vm_run_thread(vm_run_state, program, thread, run_loop_count=None):
                 
                 args   =      stacked_params[          : n_args ]  if n_args   else list()
                 kwargs = dict(stacked_params[ -n_kwargs:        ]) if n_kwargs else dict()
+
+                _own_arguments(thread_context, fun_callable, args, kwargs, thread_regstack)
                 
                 try:
-                    DEBUG( "CALLING %s args=%s:%r  kargs=%s:%r" % (fun_callable, n_args, args, n_kwargs, kwargs))
+                    if __debug__:
+                        DEBUG( "CALLING %s args=%s:%r  kargs=%s:%r" % (fun_callable, n_args, args, n_kwargs, kwargs))
                     
                     ret = fun_callable(thread, *args, **kwargs)
-                    
+
+                    if isawaitable(ret):
+                        vm_thread_await(vm_run_state, thread, ret)
+                        thread_state = THREAD_WAIT_CALL
+                        break
+
                     thread_regstack.append(ret)
                     
                 except StopException as se:
@@ -621,17 +1590,58 @@ def vm_run_thread(vm_run_state, program, thread, run_loop_count=None):
                 fun_callable = thread_context[ fun_sym ]
                 args   =      stacked_params[          : n_args ]  if n_args   else list()
                 kwargs = dict(stacked_params[ -n_kwargs:        ]) if n_kwargs else dict()
+
+                _own_arguments(thread_context, fun_callable, args, kwargs, thread_regstack)
                 
                 try:
-                    DEBUG( "CALLING %s args=%s:%r  kargs=%s:%r" % (fun_callable, n_args, args, n_kwargs, kwargs))
+                    if __debug__:
+                        DEBUG( "CALLING %s args=%s:%r  kargs=%s:%r" % (fun_callable, n_args, args, n_kwargs, kwargs))
                     
                     ret = fun_callable(thread, *args, **kwargs)
-                    
+
+                    if isawaitable(ret):
+                        vm_thread_await(vm_run_state, thread, ret)
+                        thread_state = THREAD_WAIT_CALL
+                        break
+
                     thread_regstack.append(ret)
                     
                 except StopException as se:
                     break
 
+            #
+            # CALL_SYMC
+            #
+            elif opcode == OP_CODE_CALL_SYMC:
+
+                fun_sym, n_args, n_kwargs = params
+
+                stacked_params = thread_regstack[-(n_args + n_kwargs): ]
+
+                del thread_regstack[-(n_args + n_kwargs): ]
+
+                fun_callable = thread_context[ fun_sym ]
+                args   =      stacked_params[          : n_args ]  if n_args   else list()
+                kwargs = dict(stacked_params[ -n_kwargs:        ]) if n_kwargs else dict()
+
+                _own_arguments(thread_context, fun_callable, args, kwargs, thread_regstack)
+
+                try:
+                    if __debug__:
+                        DEBUG( "CALLING %s args=%s:%r  kargs=%s:%r" % (fun_callable, n_args, args, n_kwargs, kwargs))
+
+                    ret = fun_callable(thread, *args, **kwargs)
+
+                    if isawaitable(ret):
+                        vm_thread_await(vm_run_state, thread, ret)
+                        thread_state = THREAD_WAIT_CALL
+                        break
+
+                    thread_regstack.append(ret)
+
+                except StopException as se:
+                    break
+
             elif opcode == OP_CODE_CALL_NATIVE:
 
                 fun_callable, n_args, n_kwargs = params
@@ -642,12 +1652,20 @@ def vm_run_thread(vm_run_state, program, thread, run_loop_count=None):
                 
                 args   =      stacked_params[          : n_args ]  if n_args   else list()
                 kwargs = dict(stacked_params[ -n_kwargs:        ]) if n_kwargs else dict()
+
+                _own_arguments(thread_context, fun_callable, args, kwargs, thread_regstack)
                 
                 try:
-                    DEBUG( "CALLING %s args=%s:%r  kargs=%s:%r" % (fun_callable, n_args, args, n_kwargs, kwargs))
+                    if __debug__:
+                        DEBUG( "CALLING %s args=%s:%r  kargs=%s:%r" % (fun_callable, n_args, args, n_kwargs, kwargs))
                     
                     ret = fun_callable(thread, *args, **kwargs)
-                    
+
+                    if isawaitable(ret):
+                        vm_thread_await(vm_run_state, thread, ret)
+                        thread_state = THREAD_WAIT_CALL
+                        break
+
                     thread_regstack.append(ret)
                     
                 except StopException as se:
@@ -699,15 +1717,15 @@ def vm_run_thread(vm_run_state, program, thread, run_loop_count=None):
             elif opcode == OP_CODE_OUTPUT:
 
                 data = thread_regstack.pop()
-                thread['output'].append(data)
+                thread.output.append(data)
 
             elif opcode == OP_CODE_INPUT:
 
                 # Input? Try to consume it.
-                if not thread['input']:
+                if not thread.input:
 
-                    if thread['input_timeout'] is not None:
-                        if thread['clock'] >= thread['input_timeout']:
+                    if thread.input_timeout is not None:
+                        if thread.clock >= thread.input_timeout:
                             thread_state = THREAD_TERMINATED
                             break
  
@@ -716,10 +1734,29 @@ def vm_run_thread(vm_run_state, program, thread, run_loop_count=None):
                     
                     break
 
-                data = thread['input'].pop(0)
+                data = thread.input.popleft()
                 
                 thread_regstack.append(data)
 
+            elif opcode == OP_CODE_SLEEP or opcode == OP_CODE_WAIT_UNTIL:
+
+                t = thread_regstack.pop()
+
+                clock = _thread_clock(thread, pc)
+
+                wakeup = clock + t if opcode == OP_CODE_SLEEP else t
+
+                if wakeup > clock:
+                    thread._wakeup = wakeup
+                    thread_state   = THREAD_SLEEP
+                    break
+
+            elif opcode == OP_CODE_MAILBOX:
+
+                key = thread_regstack.pop()
+
+                vm_thread_set_mailbox( vm_run_state, thread, key )
+
             
             else:
                 raise VMException("Invalid opcode: %s (pc:%s)" % (opcode, pc))
@@ -728,16 +1765,42 @@ def vm_run_thread(vm_run_state, program, thread, run_loop_count=None):
     # Update thread state
     #
 
-    thread['pc'      ] = pc
-    thread['state'   ] = thread_state
-    thread['regstack'] = thread_regstack 
-    thread['context' ] = thread_context
+    thread.pc       = pc
+    thread.state    = thread_state
+    thread.regstack = thread_regstack 
+    thread.context  = thread_context
 
-    if thread_state == THREAD_TERMINATED:
+    if __debug__ and thread_state == THREAD_TERMINATED:
         DEBUG("THREAD TERMINATED")
-        DEBUG('    pc       = %s' % ( thread['pc'      ] ) )
-        DEBUG('    state    = %s' % ( thread['state'   ] ) )
-        DEBUG('    regstack = %s' % ( thread['regstack'] ) )
-        DEBUG('    context  = %s' % ( thread['context' ] ) )
+        DEBUG('    pc       = %s' % ( thread.pc ) )
+        DEBUG('    state    = %s' % ( thread.state ) )
+        DEBUG('    regstack = %s' % ( thread.regstack ) )
+        DEBUG('    context  = %s' % ( thread.context ) )
    
     return
+
+#----------------------------------------------------------------------#
+# ENGINES                                                              #
+#----------------------------------------------------------------------#
+
+#
+# Thread execution engines selectable in vm_run_all_threads().
+#
+# Every engine has the same signature and the same semantics of
+# vm_run_thread(). Other engines register themselves here.
+#
+VM_ENGINES = {
+    ENGINE_SWITCH : vm_run_thread,
+}
+
+#
+# Engines running linked programs register the linker here: the run
+# functions link the program once per run instead of once per thread.
+#
+VM_LINKERS = {}
+
+def _vm_link_program(program, engine):
+    linker = VM_LINKERS.get(engine)
+    if linker is None:
+        return program
+    return linker(program)